@@ -4,9 +4,13 @@ Demonstration file : Produce a scan along one axis of the transverse SDW in Chro
 
 import numpy as np
 import mandy as md
+import logging
 from mandy import mandyCrystal as mc
 import matplotlib.pyplot as plt
 
+# show the crystal being built and other progress reported by mandy
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 ### setup ###
 # modulation parameters:
 # SDW wavevector
@@ -3,10 +3,14 @@ Demonstration file : Produce a 2D scan of the Bragg peaks in the h=0 plane of th
 """
 import numpy as np 
 import mandy as md
+import logging
 from mandy import mandyCrystal as mc
 from datetime import datetime
 import matplotlib.pyplot as plt
 
+# show the crystal being built and other progress reported by mandy
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 ### setup ###
 # output file name
 out_filename='~/Documents/python/test_mandy/diffraction/data/Cr_2DScan_[4,4,22]'
@@ -39,14 +43,16 @@ crystal.build()
 crystal.createModulation( qSDW , u, v , 1 , 1, n )
 
 ### calculation ###
-z = np.empty((ny,nz))
-for iy in range(ny):
-    for iz in range(nz):
-            print((iy*nz + iz) / (nz*ny))
-            print([ [x1] , [y1 + iy*step] , [z1 + iz*step] ] )
-            result = md.diffraction.magnetic_calc(crystal , np.array( [ [x1] , [y1 + iy*step] , [z1 + iz*step] ] ))[0]
-            # result = [np.exp((iy))]
-            z[iy,iz]=result[0]
+# scan the h=x1 plane adaptively, refining from cells 8 steps wide down to the step only around the peaks, which are
+# seeded from the lattice and the modulation as the cells are wider than the peaks (about half of the pixels are evaluated),
+# then resample onto the full grid, rows follow the b-direction and columns the c-direction
+# (md.diffraction.intensity_map evaluates every pixel instead)
+axes = [ y1 + step*np.arange(ny) , z1 + step*np.arange(nz) ]
+scan = md.adaptive.adaptive_map( crystal , axes , vectors=[[0,1,0],[0,0,1]] , origin=[x1,0,0] , levels=3 , relative=1e-2 )
+print('{} of {} pixels evaluated'.format(scan.evaluations, ny*nz))
+z = scan.resample()
+# convolve with a Gaussian instrument resolution, here 0.02 r.l.u. (b) by 0.01 r.l.u. (c) standard deviations
+z = md.resolution.convolve_map( z , axes , covariance=np.diag([0.02,0.01])**2 )
 
 ### output ###
 # concatenate file name with current date+time such that previous simulations are not clobbered.
@@ -59,7 +65,7 @@ vmax = min(z.max()  , round(np.average(z) + (n_std*np.std(z)), 0))
 vmin = max(0        , round(np.average(z) - (n_std*np.std(z)), 0))
 # figure parameters
 plt.rcParams['figure.figsize'] = [16, 9]
-plt.imshow(z, cmap='turbo', interpolation='kaiser', vmin=vmin, vmax=vmax)
+plt.imshow(z, cmap='turbo', interpolation='nearest', vmin=vmin, vmax=vmax)
 ax = plt.gca()
 ax.invert_yaxis()
 ax.grid(which='major', alpha=0.5)
@@ -3,10 +3,14 @@ Demonstration file : Produce a 2D scan of the Bragg peaks in the k=0 plane of a
 """
 import numpy as np 
 import mandy as md
+import logging
 from datetime import datetime
 from mandy import mandyCrystal as mc
 import matplotlib.pyplot as plt
 
+# show the crystal being built and other progress reported by mandy
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 ### setup ###
 out_filename='./data/NbFe2_2DScan_[2,2,11]'
 # modulation parameters
@@ -38,13 +42,17 @@ crystal.createModulation( qSDW , u, v , 1 , 1, n )
 ### calculation ###
 # construct grid of miller indicies
 indices = [[x1 + step*ix for ix in range(nx)] , [y1] , [z1 + step*iz for iz in range(nz)]]
-# perform calculation
-intensity, positions = md.diffraction.magnetic_calc(crystal, indices)
+# perform calculation, reporting progress and the time spent in each stage
+with md.profiling.profile() as report:
+    intensity, positions = md.diffraction.magnetic_calc(crystal, indices, progress=lambda done, total: print('{} of {} Q-points'.format(done, total)))
+print(report)
 # reshape and process output such that it may be plotted
 z = np.reshape(np.real(np.array(intensity)) , (nx,nz) )
 
 ### output ###
-np.save(out_filename+'_'+str(datetime.now())[:-7].replace(':','-').replace(' ','_'), z)
+# indexed result store of the Miller indices, intensities and crystal description, reopened with md.results.open_results
+# and queried with store.lookup([[h,k,l], ...]), the date+time in the name keeping previous simulations
+store = md.results.save_results(out_filename+'_'+str(datetime.now())[:-7].replace(':','-').replace(' ','_'), positions, intensity, crystal.metadata())
 
 ### plotting ###
 # clamp intensities above and below 3 std deviations in order to better visualise relevant peaks
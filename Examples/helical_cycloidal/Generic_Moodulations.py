@@ -4,9 +4,13 @@ Demonstration file: Produce cycloidal and helical magnetic structures via the 'r
 
 import numpy as np 
 import mandy as md
+import logging
 from mandy import mandyCrystal as mc
 import matplotlib.pyplot as plt
 
+# show the crystal being built and other progress reported by mandy
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 ### setup ###
 
 # modulation parameters:
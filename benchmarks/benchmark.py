@@ -0,0 +1,164 @@
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+"""
+Benchmark suite for the hot paths of mandy: building crystals, creating modulations, evaluating form factors and
+computing diffraction intensities.
+
+The Chromium and NbFe2 structures of the Examples directory are used as fixtures, shared with the tests through
+tests/conftest.py, with their site name files so nothing is prompted for. Every benchmark reports its best wall time
+over a few repeats, the peak memory allocated during one run (tracemalloc, which numpy reports its arrays to) and, where
+it applies, the throughput in Q-points times atoms per second. Results are saved as JSON so that runs of different
+versions can be compared with --compare.
+Correctness (import time, precision, agreement of the backends) is checked by the tests, not here.
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --quick --compare results.json
+"""
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import mandy as md
+from tests.conftest import CRYSTALS, built
+
+def measure(function, repeats=3):
+    """
+    Peak memory allocated by a first, untimed call of function, then its best wall time over repeats calls.
+
+    Returns
+    -------
+    seconds : FLOAT
+        Shortest wall time.
+    peakBytes : INT
+        Peak memory traced by tracemalloc during the first call.
+    result
+        Return value of the last call.
+    """
+    tracemalloc.start()
+    result = function()
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), peakBytes, result
+
+def record(results, name, seconds, peakBytes, work=None, **params):
+    """
+    Appends a benchmark result, with its throughput in Q-points x atoms per second when work (Q-points x atoms) is given.
+    """
+    entry = {'name':name, 'params':params, 'seconds':seconds, 'peakBytes':int(peakBytes)}
+    if(work is not None):
+        entry['throughput'] = work/seconds
+    results.append(entry)
+    throughput = '  {:.3g} Q.atoms/s'.format(entry['throughput']) if 'throughput' in entry else ''
+    print('{:<22s} {:<56s} {:10.4f} s  {:8.1f} MB{}'.format(name, ', '.join('{}={}'.format(k,v) for k,v in params.items()),
+                                                           seconds, peakBytes/2**20, throughput))
+
+def bench_build(results, repeats):
+    for name in CRYSTALS:
+        for cache in (False, True):
+            def build():
+                crystalObj = CRYSTALS[name][0]()
+                crystalObj.build(cache=cache)
+                return crystalObj
+            seconds, peak, crystalObj = measure(build, repeats)
+            record(results, 'build', seconds, peak, fixture=name, cache=cache, atoms=len(crystalObj.positions))
+
+def bench_modulation(results, repeats, sizes):
+    for name in CRYSTALS:
+        crystalObj = built(name)
+        factory, q, u = CRYSTALS[name]
+        for length in sizes:
+            n = np.array([2,2,length])
+            seconds, peak, _ = measure(lambda: crystalObj.createModulation(q, u, np.zeros(3), 1, 1, n), repeats)
+            record(results, 'createModulation', seconds, peak, fixture=name, n=n.tolist(), atoms=len(crystalObj.positions))
+
+def bench_form_factor(results, repeats, counts):
+    for count in counts:
+        q = np.linspace(0, 1, count)
+        seconds, peak, _ = measure(lambda: md.ReadFormFactor.form_factor('Fe2', q, 2, 2), repeats)
+        record(results, 'form_factor', seconds, peak, ion='Fe2', points=count)
+
+def bench_magnetic_calc(results, repeats, counts, length):
+    for name in CRYSTALS:
+        for dtype in (None, np.float32):
+            crystalObj = built(name, (2,2,length), dtype)
+            atoms = len(crystalObj.positions)
+            for count in counts:
+                # Lines along l through the (0,0,l) and (1,0,l) rows, as scanned in the examples
+                millerIndices = [[0,1], [0], np.linspace(-3, 3, max(count//2,1)).tolist()]
+                seconds, peak, _ = measure(lambda: md.diffraction.magnetic_calc(crystalObj, millerIndices), repeats)
+                record(results, 'magnetic_calc', seconds, peak, 2*len(millerIndices[2])*atoms, fixture=name, atoms=atoms,
+                       qPoints=2*len(millerIndices[2]), precision='single' if dtype else 'double')
+
+def bench_backends(results, repeats, count, length):
+    """
+    magnetic_calc with every available structure-factor kernel.
+    """
+    crystalObj = built('Cr', (2,2,length))
+    atoms = len(crystalObj.positions)
+    millerIndices = [[0,1], [0], np.linspace(-3, 3, max(count//2,1)).tolist()]
+    for name in md.backends.available_backends():
+        # The pure-Python reference is only timed on a few Q-points
+        indices = millerIndices if name!='python' else [[0], [0], millerIndices[2][:10]]
+        qPoints = len(indices[0])*len(indices[2])
+        seconds, peak, _ = measure(lambda: md.diffraction.magnetic_calc(crystalObj, indices, backend=name), repeats)
+        record(results, 'backend', seconds, peak, qPoints*atoms, backend=name, fixture='Cr', atoms=atoms, qPoints=qPoints)
+
+def compare(results, path):
+    """
+    Prints the ratio of each time to the matching entry of a previous run, > 1 meaning slower now.
+    """
+    with open(path) as f:
+        previous = {(entry['name'], json.dumps(entry['params'], sort_keys=True)):entry for entry in json.load(f)['results']}
+    print('\nCompared with {}'.format(path))
+    for entry in results:
+        old = previous.get((entry['name'], json.dumps(entry['params'], sort_keys=True)))
+        if(old is not None and 'seconds' in entry and old.get('seconds')):
+            print('{:<22s} {:<56s} {:6.2f}x'.format(entry['name'], ', '.join('{}={}'.format(k,v) for k,v in entry['params'].items()),
+                                                   entry['seconds']/old['seconds']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the mandy hot paths.')
+    parser.add_argument('--output', help='JSON file to save the results to.')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare the times with.')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes and a single repeat.')
+    args = parser.parse_args(argv)
+
+    repeats = 1 if args.quick else 3
+    sizes = (22, 88) if args.quick else (22, 88, 352, 1408)
+    counts = (10**2, 10**3) if args.quick else (10**2, 10**3, 10**4)
+    ffCounts = (10**3, 10**5) if args.quick else (10**3, 10**5, 10**7)
+
+    results = []
+    bench_build(results, repeats)
+    bench_modulation(results, repeats, sizes)
+    bench_form_factor(results, repeats, ffCounts)
+    bench_magnetic_calc(results, repeats, counts, 22)
+    bench_backends(results, repeats, counts[-1], 22)
+
+    metadata = {'date':datetime.datetime.now().isoformat(timespec='seconds'), 'python':platform.python_version(),
+                'numpy':np.__version__, 'platform':platform.platform(), 'processor':platform.processor(),
+                'cpus':os.cpu_count(), 'quick':args.quick}
+    if(args.output):
+        with open(args.output, 'w') as f:
+            json.dump({'metadata':metadata, 'results':results}, f, indent=1)
+    if(args.compare):
+        compare(results, args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-import math
+import re
 import pathlib
 import numpy as np
 
@@ -6,6 +6,37 @@ import numpy as np
 Sub-routine containing methods for calculating magnetic form factors.
 """
 
+# Coefficient table indexed by (ion, order), filled on first use by load_table()
+_coeffTable = None
+
+# Matches e.g. 'FFj0A= 0.2512' or 'FFj2c=-0.0286', capturing the order and the value
+_coeffPattern = re.compile(r'FFj(\d)[A-Za-z]=\s*(-?[\d.]+)')
+
+def load_table():
+    """
+    Parses FormFactorData.dat once and caches the coefficients.
+
+    Returns
+    -------
+    DICT
+        Mapping of (ion, order) e.g. ('Fe2','0') to a NUMPY ARRAY of the seven expansion coefficients.
+
+    """
+    global _coeffTable
+    if(_coeffTable is None):
+        table = {}
+        filename = pathlib.Path(__file__).parent.joinpath("FormFactorData.dat")
+        with open(filename,"rt") as fFactor:
+            for line in fFactor:
+                if(not line.startswith('{')):
+                    continue
+                ion = line.split()[1].rstrip('}')
+                matches = _coeffPattern.findall(line)
+                order = matches[0][0]
+                # Keep the first entry for an ion, as the original line scan did
+                table.setdefault((ion,order), np.array([float(val) for _,val in matches]))
+        _coeffTable = table
+    return _coeffTable
 
 def form_factor_coeffs(element, order):
     """
@@ -20,20 +51,20 @@ def form_factor_coeffs(element, order):
 
     Returns
     -------
-    LIST
-        List of the coefficients.
+    NUMPY ARRAY
+        Array of the coefficients.
 
     """
-    
-    # reading file
-    filename = pathlib.Path(__file__).parent.joinpath("FormFactorData.dat")
-    fFactor = open(filename,"rt")
-    
-    values = [line for i,line in enumerate(fFactor) if all(elem in line for elem in [element,order]) ]
+    try:
+        return load_table()[(element,str(order))]
+    except KeyError:
+        raise KeyError('No <j{}> form factor coefficients for "{}".'.format(order,element)) from None
 
-    nextString = values[0].split()
-
-    return [nextString[m].rpartition("=")[2] for m,val in enumerate(nextString) if "." in val]
+def real_type(q):
+    """
+    Floating point type in which to evaluate the form factor, float32 for single precision arrays and float64 otherwise.
+    """
+    return np.float32 if getattr(q, 'dtype', None)==np.float32 else np.float64
 
 def jZero(q2,coeff):
     """
@@ -41,19 +72,20 @@ def jZero(q2,coeff):
 
     Parameters
     ----------
-    q2 : FLOAT 
+    q2 : FLOAT or NUMPY ARRAY
         |Q|/4pi.
-    coeff : LIST
+    coeff : ARRAY-LIKE
         Coefficients for the zero'th order term.
 
     Returns
     -------
-    FLOAT
+    FLOAT or NUMPY ARRAY
         j0 for position q2.
 
     """
-    coeff = [float(elem) for elem in coeff]
-    return coeff[0]*math.exp(-coeff[1]*q2*q2) + coeff[2]*math.exp(-coeff[3]*q2*q2) + coeff[4]*math.exp(-coeff[5]*q2*q2) + coeff[6]
+    coeff = np.asarray(coeff, dtype=real_type(q2))
+    s2 = np.square(q2)
+    return coeff[0]*np.exp(-coeff[1]*s2) + coeff[2]*np.exp(-coeff[3]*s2) + coeff[4]*np.exp(-coeff[5]*s2) + coeff[6]
 
 def jTwo(q2,coeff):
     """
@@ -61,27 +93,24 @@ def jTwo(q2,coeff):
 
     Parameters
     ----------
-    q2 : FLOAT 
+    q2 : FLOAT or NUMPY ARRAY
         |Q|/4pi.
-    coeff : LIST
-        Coefficients for the zero'th order term.
+    coeff : ARRAY-LIKE
+        Coefficients for the second order term.
 
     Returns
     -------
-    FLOAT
+    FLOAT or NUMPY ARRAY
         j2 for position q2.
 
     """
-    coeff = [float(elem) for elem in coeff]
-    return (q2**2)*(coeff[0]*math.exp(-coeff[1]*q2*q2) + coeff[2]*math.exp(-coeff[3]*q2*q2) + coeff[4]*math.exp(-coeff[5]*q2*q2) + coeff[6])
-
-# Vectorising above functions to avoid repeated calls 
+    coeff = np.asarray(coeff, dtype=real_type(q2))
+    s2 = np.square(q2)
+    return s2*(coeff[0]*np.exp(-coeff[1]*s2) + coeff[2]*np.exp(-coeff[3]*s2) + coeff[4]*np.exp(-coeff[5]*s2) + coeff[6])
 
-j0_vector = np.vectorize(jZero)
-j0_vector.excluded.add(1)
-
-j2_vector = np.vectorize(jTwo,excluded=['coeff'])
-j2_vector.excluded.add(1)
+# jZero and jTwo operate on arrays directly, kept under their previous names
+j0_vector = jZero
+j2_vector = jTwo
 
 def form_factor(elem,q,l,s):
     """
@@ -91,8 +120,8 @@ def form_factor(elem,q,l,s):
     ----------
     elem : STRING
         Name of the form factor, e.g. 'Fe2'.
-    q : FLOAT
-        |Q|/4pi.
+    q : FLOAT or NUMPY ARRAY
+        |Q|/4pi, any shape.
     l : FLOAT
         L Quantum number corresponding to elem.
     s : FLOAT
@@ -100,12 +129,13 @@ def form_factor(elem,q,l,s):
 
     Returns
     -------
-    FLOAT
-        Form factor.
+    FLOAT or NUMPY ARRAY
+        Form factor, same shape as q, in single precision if q is.
 
     """
-    return ( (l+2*s)*j0_vector(q,form_factor_coeffs(elem, "0")) + l*j2_vector(q, form_factor_coeffs(elem, "2")) )
-    
+    dtype = real_type(q)
+    return ( dtype(l+2*s)*jZero(q,form_factor_coeffs(elem, "0")) + dtype(l)*jTwo(q, form_factor_coeffs(elem, "2")) )
+
 def form_factor_squared(elem,q,l,s):
     """
     Calculates the squared form factor in the dipole approximation in the manner specified by the ILL
@@ -114,8 +144,8 @@ def form_factor_squared(elem,q,l,s):
     ----------
     elem : STRING
         Name of the form factor, e.g. 'Fe2'.
-    q : FLOAT
-        |Q|/4pi.
+    q : FLOAT or NUMPY ARRAY
+        |Q|/4pi, any shape.
     l : FLOAT
         L Quantum number corresponding to elem.
     s : FLOAT
@@ -123,10 +153,7 @@ def form_factor_squared(elem,q,l,s):
 
     Returns
     -------
-    FLOAT
-        Squaredorm factor.
+    FLOAT or NUMPY ARRAY
+        Squared form factor, same shape as q.
     """
-    return ( (l+2*s)*j0_vector(q,form_factor_coeffs(elem, "0")) + l*j2_vector(q, form_factor_coeffs(elem, "2")) )**2    
-
-
-
+    return form_factor(elem,q,l,s)**2
@@ -1,3 +1,17 @@
-from . import diffraction
-from . import requestNIST
-from . import mandyCrystal
+import importlib
+import logging
+
+# Submodules are imported on first access, such that importing mandy (or a single submodule in a worker process)
+# does not pay for the plotting, CIF and network dependencies of the others.
+_submodules = ('diffraction','requestNIST','mandyCrystal','ReadFormFactor','parallel','scanstore','plan','refine','symmetry','adaptive','resolution','nufft','profiling','backends','domains','sweep','results')
+
+# Progress and diagnostics are logged under 'mandy', silent unless the application configures logging
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+def __getattr__(name):
+    if(name in _submodules):
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
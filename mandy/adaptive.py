@@ -0,0 +1,243 @@
+import itertools
+import logging
+import numpy as np
+from dataclasses import dataclass
+from . import diffraction
+
+"""
+Sub-routine to scan reciprocal space adaptively, refining a coarse grid only where there is intensity.
+
+The scan is defined on a regular target grid, as for diffraction.intensity_map. It starts from cells 2^levels grid
+steps wide, evaluates their corners and centres, and splits every cell with enough intensity (or a steep enough
+change in intensity, or containing a seed reflection) into 2^d children, down to single grid steps. The cells that
+were not split form a quad/octree whose leaves are interpolated to resample the map onto the full target grid.
+"""
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class adaptiveMap:
+    """
+    Result of an adaptive scan, the intensity at the evaluated points of the target grid and the leaf cells of the tree.
+
+    coords, vectors and origin define the target grid as in diffraction.intensity_map. indices (K,d) are the grid
+    indices of the K evaluated points and intensity (K,) their intensities. leafLower (C,d) and leafStride (C,) are the
+    lower corner and width (in grid steps) of every leaf cell.
+    """
+    coords: list
+    vectors: np.ndarray
+    origin: np.ndarray
+    indices: np.ndarray
+    intensity: np.ndarray
+    leafLower: np.ndarray
+    leafStride: np.ndarray
+
+    @property
+    def shape(self):
+        return tuple(len(coord) for coord in self.coords)
+
+    @property
+    def evaluations(self):
+        """
+        Number of structure-factor evaluations made by the scan.
+        """
+        return len(self.intensity)
+
+    @property
+    def hkl(self):
+        """
+        Miller index of every evaluated point, (K,3).
+        """
+        return grid_hkl(self.indices, self.coords, self.vectors, self.origin)
+
+    def resample(self):
+        """
+        Resamples the scan onto the full target grid for plotting.
+
+        Each leaf cell is filled by multilinear interpolation of its corners, finer cells overwriting coarser ones
+        where they meet, and every evaluated point keeps its exact intensity.
+
+        Returns
+        -------
+        NUMPY ARRAY (n0,n1,...)
+            Intensity of every pixel of the target grid.
+        """
+        shape = np.array(self.shape)
+        out = np.zeros(self.shape)
+        flat = np.ravel_multi_index(tuple(self.indices.T), self.shape)
+        order = np.argsort(flat)
+        lookup = lambda index: self.intensity[order[np.searchsorted(flat[order], np.ravel_multi_index(tuple(np.moveaxis(index,-1,0)), self.shape))]]
+
+        for stride in np.unique(self.leafStride)[::-1]:
+            lower = self.leafLower[self.leafStride==stride]
+            local = np.stack(np.meshgrid(*[np.arange(stride+1) if length>1 else [0] for length in shape], indexing='ij'), -1).reshape(-1,len(shape))
+            weights = local / stride
+            points = lower[:,None,:] + local[None,:,:]
+            value = np.zeros(points.shape[:2])
+            for corner in corner_offsets(shape):
+                cornerIndex = np.minimum(lower + corner*stride, shape-1)
+                weight = np.prod(np.where(corner, weights, 1-weights), axis=1)
+                value += weight[None,:] * lookup(cornerIndex)[:,None]
+            inside = np.all(points < shape, axis=-1)
+            out[tuple(points[inside].T)] = value[inside]
+
+        out[tuple(self.indices.T)] = self.intensity
+        return out
+
+def corner_offsets(shape):
+    """
+    Corners of a unit cell of the grid, {0,1} along every axis longer than one point, (2^d,d).
+    """
+    return np.array(list(itertools.product(*[[0,1] if length>1 else [0] for length in shape])), dtype=int).reshape(-1,len(shape))
+
+def grid_hkl(indices, coords, vectors, origin):
+    """
+    Miller indices of points of the target grid given by their grid indices (K,d).
+    """
+    hkl = np.broadcast_to(np.asarray(origin, dtype=float), (len(indices),3)).copy()
+    for axis,(coord,vector) in enumerate(zip(coords, vectors)):
+        hkl += coord[indices[:,axis]][:,None] * vector
+    return hkl
+
+def reflection_seeds(crystalObj, hklMin, hklMax):
+    """
+    Predicted reflections inside the box hklMin..hklMax, every lattice point G and, for a modulated crystal, the
+    satellites G+q and G-q, whichever the mode of createModulation.
+    """
+    applied = getattr(crystalObj, 'appliedModulation', None)
+    q = None if applied is None else np.asarray(applied[1].q, dtype=float)
+    shifts = [np.zeros(3)] if q is None else [np.zeros(3), q, -q]
+    seeds = []
+    for shift in shifts:
+        ranges = [np.arange(np.ceil(low - s - 1e-9), np.floor(high - s + 1e-9) + 1) for low,high,s in zip(hklMin, hklMax, shift)]
+        grid = np.stack(np.meshgrid(*ranges, indexing='ij'), -1).reshape(-1,3)
+        seeds.append(grid + shift)
+    return np.concatenate(seeds)
+
+def seed_positions(seeds, coords, vectors, origin, tol=1e-6):
+    """
+    Fractional grid indices (K,d) of the seeds which lie in the plane (or line) of the map.
+    """
+    steps = np.array([coord[1]-coord[0] if len(coord)>1 else 1.0 for coord in coords])
+    starts = np.array([coord[0] for coord in coords])
+    offset = np.asarray(seeds, dtype=float).reshape(-1,3) - np.asarray(origin, dtype=float)
+    t = np.linalg.lstsq(vectors.T, offset.T, rcond=None)[0].T
+    inPlane = np.linalg.norm(t @ vectors - offset, axis=1) <= tol
+    return (t[inPlane] - starts) / steps
+
+def adaptive_map(crystalObj, axes, vectors=None, origin=(0,0,0), levels=3, threshold=None, relative=1e-3, gradient=None,
+                 seeds=None, buffer=1, chunkSize=None, workers=None, symmetry=None, nufft=None):
+    """
+    Computes a 1D/2D/3D map adaptively, refining a coarse grid towards the target grid only where there is intensity.
+
+    Peaks narrower than the coarse cells can fall between their corners and centres, so when the coarse step
+    (2^levels target steps) is wider than the peak width 1/n of the crystal along any hkl direction the predicted
+    reflections are seeded, unless seeds is given.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    axes, vectors, origin
+        Target grid, see diffraction.intensity_map. Axes given as arrays must be evenly spaced.
+    levels : INT, optional
+        Number of refinements, the coarse cells are 2^levels target steps wide.
+    threshold : FLOAT, optional
+        Cells with an intensity at or above threshold are refined, by default relative times the largest intensity found.
+    relative : FLOAT, optional
+        Threshold relative to the largest intensity when threshold is not given.
+    gradient : FLOAT, optional
+        Cells whose intensity changes by at least gradient per target step are also refined.
+    seeds : BOOL or ARRAY-LIKE (K,3), optional
+        Miller indices of expected reflections, the cells containing them are always refined.
+        True predicts them from the crystal (lattice points and modulation satellites), by default only when the coarse
+        cells are wider than the peaks. False never seeds.
+    buffer : INT, optional
+        Cells within this many cells of a refined cell are refined too, catching the finite-size fringes around peaks.
+    chunkSize, workers, symmetry, nufft
+        Passed on to diffraction.intensities for each batch.
+
+    Returns
+    -------
+    adaptiveMap
+        The evaluated points and leaf cells, resample() gives the map on the target grid.
+    """
+    coords = diffraction.map_axes(axes)
+    for coord in coords:
+        if(len(coord)>2 and not np.allclose(np.diff(coord), coord[1]-coord[0])):
+            raise ValueError('Adaptive scans need evenly spaced axes.')
+    vectors = np.eye(3)[:len(coords)] if vectors is None else np.asarray(vectors, dtype=float).reshape(len(coords),3)
+    origin = np.asarray(origin, dtype=float)
+    shape = np.array([len(coord) for coord in coords])
+    corners = corner_offsets(shape)
+
+    # Peaks fall to their first zero 1/n r.l.u. from their centre, a coarser cell could step over them entirely unless
+    # the cells holding the predicted reflections are refined whatever their sampled intensity
+    n = np.asarray(crystalObj.n, dtype=float)
+    widest = max([(coord[1]-coord[0]) * (np.abs(vector) * n).max() for coord,vector in zip(coords, vectors) if len(coord)>1], default=0)
+    if(widest>0 and 2**int(levels) * widest > 1):
+        if(seeds is None):
+            logger.info('Coarse cells of 2^%d steps are wider than the peaks (1/n r.l.u.), seeding the predicted reflections.', int(levels))
+            seeds = True
+        elif(seeds is False):
+            logger.warning('Coarse cells of 2^%d steps are wider than the peaks (1/n r.l.u.) and seeds=False, reflections between '
+                           'the coarse samples may be missed.', int(levels))
+
+    if(seeds is True):
+        gridHkl = diffraction.map_hkl([coord[[0,-1]] for coord in coords], vectors, origin).reshape(-1,3)
+        seeds = reflection_seeds(crystalObj, gridHkl.min(axis=0), gridHkl.max(axis=0))
+    seedIndex = None if seeds is None or seeds is False else seed_positions(seeds, coords, vectors, origin)
+
+    # Evaluated points as sorted flat grid indices and their intensities
+    known = np.zeros(0, dtype=np.int64)
+    values = np.zeros(0)
+
+    def evaluate(points):
+        nonlocal known, values
+        flat = np.unique(np.ravel_multi_index(tuple(points.reshape(-1,len(shape)).T), tuple(shape)))
+        new = flat[~np.isin(flat, known)]
+        if(len(new)):
+            newIntensity = diffraction.intensities(crystalObj, grid_hkl(np.stack(np.unravel_index(new, tuple(shape)), -1), coords, vectors, origin),
+                                                   chunkSize, workers, symmetry, nufft)
+            known = np.concatenate([known, new])
+            values = np.concatenate([values, newIntensity])
+            order = np.argsort(known)
+            known, values = known[order], values[order]
+        return values[np.searchsorted(known, np.ravel_multi_index(tuple(np.moveaxis(points,-1,0)), tuple(shape)))]
+
+    stride = 2**int(levels)
+    lower = np.stack(np.meshgrid(*[np.arange(0, max(length-1,1), stride) for length in shape], indexing='ij'), -1).reshape(-1,len(shape))
+    leafLower, leafStride = [], []
+    while(len(lower)):
+        cornerPoints = np.minimum(lower[:,None,:] + corners[None,:,:]*stride, shape-1)
+        if(stride>1):
+            cornerPoints = np.concatenate([cornerPoints, np.minimum(lower + np.where(shape>1, stride//2, 0), shape-1)[:,None,:]], axis=1)
+        cellValues = evaluate(cornerPoints)
+        if(stride==1):
+            leafLower.append(lower)
+            leafStride.append(np.ones(len(lower), dtype=int))
+            break
+
+        limit = threshold if threshold is not None else relative * values.max()
+        refine = cellValues.max(axis=1) >= limit if limit>0 else np.zeros(len(lower), dtype=bool)
+        if(gradient is not None):
+            refine |= (cellValues.max(axis=1) - cellValues.min(axis=1)) / stride >= gradient
+        if(seedIndex is not None and len(seedIndex)):
+            inside = np.all((seedIndex[None,:,:] >= lower[:,None,:] - 1e-9) & (seedIndex[None,:,:] <= (lower + stride)[:,None,:] + 1e-9), axis=2)
+            refine |= inside.any(axis=1)
+        if(buffer and refine.any()):
+            # Neighbours of the flagged cells at this level, found through the flat index of their lower corners
+            reach = np.stack(np.meshgrid(*[np.arange(-buffer, buffer+1) if length>1 else [0] for length in shape], indexing='ij'), -1).reshape(-1,len(shape))
+            neighbours = (lower[refine][:,None,:] + reach[None,:,:]*stride).reshape(-1,len(shape))
+            neighbours = neighbours[np.all((neighbours >= 0) & (neighbours < shape), axis=1)]
+            refine |= np.isin(np.ravel_multi_index(tuple(lower.T), tuple(shape)), np.ravel_multi_index(tuple(neighbours.T), tuple(shape)))
+
+        leafLower.append(lower[~refine])
+        leafStride.append(np.full((~refine).sum(), stride, dtype=int))
+        stride //= 2
+        children = (lower[refine][:,None,:] + corners[None,:,:]*stride).reshape(-1,len(shape))
+        lower = children[np.all((children < np.maximum(shape-1,1)), axis=1)]
+
+    indices = np.stack(np.unravel_index(known, tuple(shape)), -1)
+    return adaptiveMap(coords=coords, vectors=vectors, origin=origin, indices=indices, intensity=values,
+                       leafLower=np.concatenate(leafLower).reshape(-1,len(shape)), leafStride=np.concatenate(leafStride))
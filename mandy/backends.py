@@ -0,0 +1,156 @@
+import os
+import cmath
+import importlib.util
+import numpy as np
+
+"""
+Sub-routine to select the implementation of the structure-factor kernel.
+
+A kernel evaluates one block of the sum F(Q) = sum_j f_j(|Q|) m_j exp(-iQ.r_j) into a preallocated array, the
+chunking, precision and bookkeeping being left to diffraction.structure_factor. Three kernels are registered:
+    'numpy'   BLAS matrix products over the phase matrix of the block.
+    'numba'   a JIT-compiled loop, parallel over Q, only available when numba is installed.
+    'python'  plain loops, slow but simple enough to serve as the reference for check_backends.
+Further kernels can be added with register_backend. A kernel is chosen by name through the backend argument of the
+diffraction routines, otherwise by DEFAULT, where 'auto' picks the fastest kernel available.
+"""
+
+# Kernel used when no backend is named, 'auto' or any registered name, may be set with the MANDY_BACKEND variable
+DEFAULT = os.environ.get('MANDY_BACKEND', 'auto')
+# Order of preference of 'auto'
+AUTO_ORDER = ('numba', 'numpy')
+
+# name -> (kernel, available) with available a function telling whether the kernel can run here
+_backends = {}
+
+def register_backend(name, kernel, available=None):
+    """
+    Registers a structure-factor kernel under a name, replacing any kernel of that name.
+
+    Parameters
+    ----------
+    name : STRING
+        Name by which the kernel is selected.
+    kernel : CALLABLE
+        kernel(qVecs, positions, moments, siteIds, formFactors, out) writing F(Q) for the block into out (M,K), with the
+        arguments as for diffraction.structure_factor. moments (N,K) may be real or complex, K being 3 or a multiple
+        of 3 when several structures are summed over the same positions.
+    available : CALLABLE, optional
+        Returns whether the kernel can run, e.g. whether an optional dependency is installed, by default always.
+    """
+    _backends[name] = (kernel, available if available is not None else (lambda: True))
+
+def available_backends():
+    """
+    Names of the registered kernels which can run in this environment.
+    """
+    return [name for name,(kernel,available) in _backends.items() if available()]
+
+def get_backend(name=None):
+    """
+    Kernel registered under name, None meaning DEFAULT and 'auto' the first available of AUTO_ORDER.
+    """
+    name = DEFAULT if name is None else name
+    if(name=='auto'):
+        name = next(candidate for candidate in AUTO_ORDER if candidate in available_backends())
+    if(name not in _backends):
+        raise ValueError('Unknown backend "{}", expected one of {}.'.format(name, sorted(_backends)))
+    kernel, available = _backends[name]
+    if(not available()):
+        raise ImportError('Backend "{}" is not available, its optional dependency is not installed.'.format(name))
+    return kernel
+
+def numpy_kernel(qVecs, positions, moments, siteIds, formFactors, out):
+    # Phase matrix exp(-iQ.R) for the block, weighted by the form factor of each position ### removing 2pi factor
+    # Cosine and sine parts are summed separately, as real cos/sin vectorise far better than complex exp in float32
+    angle = qVecs @ positions.T
+    weights = formFactors[:,siteIds]
+    out[...] = (np.cos(angle) * weights) @ moments - 1j*((np.sin(angle) * weights) @ moments)
+
+def python_kernel(qVecs, positions, moments, siteIds, formFactors, out):
+    for i,q in enumerate(qVecs.tolist()):
+        total = [0j]*moments.shape[1]
+        for r,m,s in zip(positions.tolist(), moments.tolist(), siteIds.tolist()):
+            phase = formFactors[i,s] * cmath.exp(-1j * (q[0]*r[0] + q[1]*r[1] + q[2]*r[2]))
+            for column in range(len(total)):
+                total[column] += phase * m[column]
+        out[i] = total
+
+# Replaced by numba.prange when the loop below is compiled, numba reading globals at compile time
+prange = range
+
+def numba_loop(qVecs, positions, moments, siteIds, formFactors, out):
+    """
+    Loop of numba_kernel, compiled by numba on first use.
+
+    Each row is accumulated in the precision of out, as in numpy_kernel, complex64 for single precision. The angle is
+    computed in the precision of the inputs, while the product of the phase and the moment is formed in double
+    precision before being rounded into the accumulator.
+    """
+    for i in prange(qVecs.shape[0]):
+        total = np.zeros_like(out[i])
+        for j in range(positions.shape[0]):
+            angle = qVecs[i,0]*positions[j,0] + qVecs[i,1]*positions[j,1] + qVecs[i,2]*positions[j,2]
+            weight = formFactors[i,siteIds[j]]
+            phase = complex(weight*np.cos(angle), -weight*np.sin(angle))
+            for column in range(moments.shape[1]):
+                total[column] += phase*moments[j,column]
+        out[i,:] = total
+
+_numbaLoop = None
+
+def numba_kernel(qVecs, positions, moments, siteIds, formFactors, out):
+    global _numbaLoop, prange
+    if(_numbaLoop is None):
+        # Compiled once per combination of argument types and cached on disk beside this module, numba is only imported
+        # when the kernel is first used
+        import numba
+        prange = numba.prange
+        _numbaLoop = numba.njit(parallel=True, cache=True)(numba_loop)
+    _numbaLoop(np.ascontiguousarray(qVecs), np.ascontiguousarray(positions), np.ascontiguousarray(moments),
+               np.ascontiguousarray(siteIds), np.ascontiguousarray(formFactors), out)
+
+register_backend('numpy', numpy_kernel)
+register_backend('numba', numba_kernel, lambda: importlib.util.find_spec('numba') is not None)
+register_backend('python', python_kernel)
+
+def check_backends(names=None, qPoints=40, atoms=30, sites=3, tol=1e-10, seed=0):
+    """
+    Checks every available kernel against the 'python' reference on random real moments and on several sets of
+    complex moments at once, in double precision.
+
+    Parameters
+    ----------
+    names : LIST, optional
+        Kernels to check, by default every available one.
+    qPoints, atoms, sites : INT, optional
+        Size of the random problem.
+    tol : FLOAT, optional
+        Largest relative difference from the reference accepted.
+    seed : INT, optional
+        Seed of the random problem.
+
+    Returns
+    -------
+    DICT
+        Largest relative difference of each kernel from the reference.
+    """
+    rng = np.random.default_rng(seed)
+    qVecs = rng.uniform(-5, 5, (qPoints,3))
+    positions = rng.uniform(-20, 20, (atoms,3))
+    siteIds = rng.integers(0, sites, atoms)
+    formFactors = rng.uniform(0, 1, (qPoints,sites))
+    errors = {}
+    for name in (available_backends() if names is None else names):
+        error = 0.0
+        for moments in (rng.normal(size=(atoms,3)), rng.normal(size=(atoms,6)) + 1j*rng.normal(size=(atoms,6))):
+            reference = np.empty((qPoints,moments.shape[1]), dtype=complex)
+            result = np.empty((qPoints,moments.shape[1]), dtype=complex)
+            python_kernel(qVecs, positions, moments, siteIds, formFactors, reference)
+            get_backend(name)(qVecs, positions, moments, siteIds, formFactors, result)
+            error = max(error, np.abs(result - reference).max() / np.abs(reference).max())
+        errors[name] = float(error)
+    failed = {name:error for name,error in errors.items() if not error <= tol}
+    if(failed):
+        raise RuntimeError('Backends disagree with the reference: {}'.format(failed))
+    return errors
@@ -1,20 +1,643 @@
 from . import ReadFormFactor as RFF
+from . import profiling
+from . import backends
+import logging
 import numpy as np
-import math,cmath
 
 """
 Sub-routine to perform the diffraction calculation.
 """
-def magnetic_calc(crystalObj,millerIndices):
+
+# Upper bound (in bytes) on the complex phase matrix held in memory at any one time.
+CHUNK_BYTES = 2**27
+
+logger = logging.getLogger(__name__)
+
+def miller_list(millerIndices):
+    """
+    Expands the per-direction Miller index lists into the full list of indices, in the order h, k, l (l fastest).
+
+    Parameters
+    ----------
+    millerIndices : LIST
+        List of Miller Indices to be simulated in each direction.
+
+    Returns
+    -------
+    braggPosition : LIST
+        List of [h,k,l] lists.
+
+    """
+    return [[hVal,kVal,lVal] for hVal in millerIndices[0] for kVal in millerIndices[1] for lVal in millerIndices[2]]
+
+def crystal_arrays(crystalObj):
+    """
+    Recovers the magnetic supercell of a crystal as contiguous arrays.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+
+    Returns
+    -------
+    positions : NUMPY ARRAY (N,3)
+        Cartesian positions of every site.
+    moments : NUMPY ARRAY (N,3)
+        Moment on every site.
+    siteIds : NUMPY ARRAY (N,)
+        Index into crystalObj.sites for every site.
+
+    """
+    if(getattr(crystalObj, 'stream', None) is not None):
+        raise ValueError('The supercell of createModulation(mode=\'stream\') is not held in memory, use diffraction.intensities '
+                         'or createModulation(mode=\'supercell\').')
+    return crystalObj.positions, crystalObj.moments, crystalObj.siteIds
+
+def complex_type(dtype):
+    """
+    Complex type matching a floating point type, complex64 for float32 and complex128 otherwise.
+    """
+    return np.complex64 if np.dtype(dtype)==np.float32 else np.complex128
+
+def normalised_form_factors(sites, qMag):
+    """
+    Evaluates the magnetic form factor of every site, normalised to its Q = 0 value.
+
+    Parameters
+    ----------
+    sites : LIST
+        List of site objects.
+    qMag : NUMPY ARRAY (M,)
+        |Q|/4pi for each scattering vector.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,S)
+        Normalised form factor of each site at each |Q|, in the precision of qMag.
+
+    """
+    with profiling.stage('form_factor'):
+        ffList = [RFF.form_factor(site.ion_name, qMag, site.l_s[0], site.l_s[1]) / RFF.form_factor(site.ion_name, 0, site.l_s[0], site.l_s[1]) for site in sites]
+        return np.stack(ffList, axis=-1).astype(RFF.real_type(qMag), copy=False)
+
+def chunk_length(nAtoms, chunkSize=None, itemSize=16):
+    """
+    Number of scattering vectors processed together such that the phase matrix, of itemSize bytes per entry, stays
+    within CHUNK_BYTES.
+    """
+    if(chunkSize is not None):
+        return max(1, int(chunkSize))
+    return max(1, CHUNK_BYTES // (itemSize*max(1,nAtoms)))
+
+def structure_factor(qVecs, positions, moments, siteIds, formFactors, chunkSize=None, backend=None):
+    """
+    Computes the magnetic structure factor for a batch of scattering vectors.
+
+    The sum is evaluated in the precision of qVecs, complex64 for float32 inputs and complex128 otherwise, block by
+    block with the kernel of the chosen backend.
+
+    Parameters
+    ----------
+    qVecs : NUMPY ARRAY (M,3)
+        Scattering vectors in A^-1.
+    positions : NUMPY ARRAY (N,3)
+        Cartesian positions of every site.
+    moments : NUMPY ARRAY (N,3)
+        Moment on every site, or (N,K) to sum K/3 sets of (complex) moments in one pass.
+    siteIds : NUMPY ARRAY (N,)
+        Index of each position into the columns of formFactors.
+    formFactors : NUMPY ARRAY (M,S)
+        Normalised form factor of each site at each scattering vector.
+    chunkSize : INT, optional
+        Number of scattering vectors per block, by default chosen from CHUNK_BYTES.
+    backend : STRING, optional
+        Structure-factor kernel, 'numpy', 'numba' or 'python', by default backends.DEFAULT (the fastest available).
+
+    Returns
+    -------
+    MTotal : NUMPY ARRAY (M,3)
+        Complex structure factor for each scattering vector, (M,K) for (N,K) moments.
+
+    """
+    kernel = backends.get_backend(backend)
+    dtype = complex_type(qVecs.dtype)
+    MTotal = np.empty((len(qVecs),moments.shape[1]), dtype=dtype)
+    step = chunk_length(len(positions), chunkSize, np.dtype(dtype).itemsize)
+
+    for start in range(0, len(qVecs), step):
+        stop = min(start+step, len(qVecs))
+        logger.debug('computing Q-points %d-%d of %d ...', start+1, stop, len(qVecs))
+        with profiling.stage('phase_sum'):
+            kernel(qVecs[start:stop], positions, moments, siteIds, formFactors[start:stop], MTotal[start:stop])
+
+    return MTotal
+
+def lattice_sum(hkl, n):
+    """
+    Closed form of the sum over the n[0] x n[1] x n[2] block of unit cells, sum_T exp(-iQ.T).
+
+    Parameters
+    ----------
+    hkl : NUMPY ARRAY (M,3)
+        Scattering vectors in reciprocal lattice units, such that Q.a_i = 2pi*hkl_i.
+    n : ARRAY-LIKE (3,)
+        Number of unit cells in each direction.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Complex lattice sum for each scattering vector.
+
+    """
+    n = np.asarray(n, dtype=hkl.dtype if hkl.dtype==np.float32 else float)
+    # Reduce to the nearest reciprocal lattice point first such that exact Bragg conditions are recovered without cancellation
+    x = 2*np.pi*(hkl - np.round(hkl))
+    halfSin = np.sin(x/2)
+    onLattice = halfSin==0
+    # sum_{t=0}^{n-1} exp(-itx) = exp(-i(n-1)x/2) sin(nx/2) / sin(x/2)
+    ratio = np.where(onLattice, n, np.sin(n*x/2) / np.where(onLattice, 1, halfSin))
+    return np.prod(np.exp(-0.5j*(n-1)*x) * ratio, axis=1)
+
+def modulated_structure_factor(hkl, qVecs, reciprocal, positions, moments, siteIds, formFactors, mod, n, chunkSize=None, backend=None):
+    """
+    Computes the structure factor of a single-k modulation over n unit cells without building the supercell.
+
+    The moment on site j of cell T is Re[ c_j exp(-iq.(r_j+T)) ] with c_j = m_j*(m1*u + i*m2*v), so the sum over the
+    supercell splits into unit cell structure factors at the Q+q and Q-q satellites, each multiplied by a lattice sum.
+
+    Parameters
+    ----------
+    hkl : NUMPY ARRAY (M,3)
+        Miller indices to be simulated.
+    qVecs : NUMPY ARRAY (M,3)
+        Scattering vectors in A^-1.
+    reciprocal : NUMPY ARRAY (3,3)
+        Rows are the reciprocal lattice vectors b1, b2, b3.
+    positions, moments, siteIds : NUMPY ARRAY
+        Unit cell arrays as returned by crystal_arrays.
+    formFactors : NUMPY ARRAY (M,S)
+        Normalised form factor of each site at each scattering vector.
+    mod : modulation object
+        The modulation applied to the unit cell.
+    n : ARRAY-LIKE (3,)
+        Number of unit cells in each direction.
+    chunkSize : INT, optional
+        Number of scattering vectors per block, by default chosen from CHUNK_BYTES.
+    backend : STRING, optional
+        Structure-factor kernel, see structure_factor.
+
+    Returns
+    -------
+    MTotal : NUMPY ARRAY (M,3)
+        Complex structure factor for each scattering vector.
+
+    """
+    dtype = complex_type(qVecs.dtype)
+    envelope = mod.m1*mod.u + 1j*mod.m2*mod.v
+    if(mod.rotate):
+        amplitude = np.linalg.norm(moments, axis=1)[:,None] * envelope
+    else:
+        amplitude = moments * envelope
+    amplitude = amplitude.astype(dtype, copy=False)
+
+    qMod = (mod.q @ reciprocal).astype(qVecs.dtype)
+    modHkl = np.asarray(mod.q, dtype=hkl.dtype)
+    MTotal = np.zeros((len(qVecs),3), dtype=dtype)
+    # Re[c exp(-iq.R)] = ( c exp(-iq.R) + c* exp(+iq.R) ) / 2
+    for sign, amp in ((1, amplitude), (-1, np.conj(amplitude))):
+        satellite = structure_factor(qVecs + sign*qMod, positions, amp, siteIds, formFactors, chunkSize, backend)
+        MTotal += 0.5 * satellite * lattice_sum(hkl + sign*modHkl, n)[:,None]
+    return MTotal
+
+def perpendicular_intensity(qVecs, MTotal):
+    """
+    Projects the structure factor perpendicular to Q and returns the intensity |M_perp|^2.
+
+    Parameters
+    ----------
+    qVecs : NUMPY ARRAY (M,3)
+        Scattering vectors in A^-1, (000) entries return zero intensity.
+    MTotal : NUMPY ARRAY (M,3)
+        Complex structure factor for each scattering vector.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each scattering vector.
+
+    """
+    with profiling.stage('projection'):
+        qSquared = np.einsum('ij,ij->i', qVecs, qVecs)
+        nonZero = qSquared > 0
+        qHat = np.zeros_like(qVecs)
+        qHat[nonZero] = qVecs[nonZero] / np.sqrt(qSquared[nonZero])[:,None]
+
+        # (1/q^2) q x (M x q) = M - q^(q^.M)
+        MTotalOrth = MTotal - qHat * np.einsum('ij,ij->i', qHat, MTotal)[:,None]
+        intensity = np.einsum('ij,ij->i', np.conj(MTotalOrth), MTotalOrth).real
+        intensity[~nonZero] = 0.0
+        return intensity
+
+def intensity_block(hkl, reciprocal, positions, moments, siteIds, sites, mod=None, n=(1,1,1), chunkSize=None, dtype=None, backend=None):
+    """
+    Computes the diffracted intensity for a block of Miller indices from the crystal arrays alone.
+
+    Parameters
+    ----------
+    hkl : NUMPY ARRAY (M,3)
+        Miller indices to be simulated.
+    reciprocal : NUMPY ARRAY (3,3)
+        Rows are the reciprocal lattice vectors b1, b2, b3.
+    positions, moments, siteIds : NUMPY ARRAY
+        Crystal arrays as returned by crystal_arrays.
+    sites : LIST
+        List of site objects indexed by siteIds.
+    mod : modulation object, optional
+        Modulation evaluated analytically over n unit cells, if any.
+    n : ARRAY-LIKE (3,)
+        Number of unit cells in each direction, used with mod.
+    chunkSize : INT, optional
+        Number of scattering vectors per block, by default chosen from CHUNK_BYTES.
+    dtype : DTYPE, optional
+        Floating point type of the calculation, np.float32 for single precision, by default that of positions.
+    backend : STRING, optional
+        Structure-factor kernel, see structure_factor.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each Miller index, in the precision of the calculation.
+
+    """
+    dtype = np.dtype(positions.dtype if dtype is None else dtype)
+    hkl, reciprocal, positions, moments = (np.asarray(array, dtype=dtype) for array in (hkl, reciprocal, positions, moments))
+
+    # Find q in A^-1
+    qVecs = hkl @ reciprocal
+
+    # Find the magnitude of q, divide by 4pi to match (sin theta / lambda) = (q / 4pi)
+    qMag = np.sqrt(np.einsum('ij,ij->i', qVecs, qVecs)) / (4 * np.pi)
+    formFactors = normalised_form_factors(sites, qMag)
+
+    # Form factors are evaluated at Q itself, as for the tiled supercell
+    if(mod is not None):
+        MTotal = modulated_structure_factor(hkl, qVecs, reciprocal, positions, moments, siteIds, formFactors, mod, n, chunkSize, backend)
+    else:
+        MTotal = structure_factor(qVecs, positions, moments, siteIds, formFactors, chunkSize, backend)
+    return perpendicular_intensity(qVecs, MTotal)
+
+def streamed_intensities(crystalObj, hkl, chunkSize=None, dtype=None, progress=None, backend=None):
+    """
+    Computes the diffracted intensity of a crystal whose supercell is streamed, see createModulation(mode='stream').
+
+    For each block of Miller indices the supercell is generated block by block and the partial structure factors of
+    the blocks are accumulated, so the memory in use is bounded by the size of a block of the supercell and the phase
+    matrix of one block against one block of Miller indices, whatever the size of the supercell. Regenerating the
+    supercell for each block of Miller indices costs O(N) against O(N x block) for the sum.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Crystal with a streamed supercell.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices to be simulated.
+    chunkSize, dtype, progress, backend
+        See intensities, by default in the precision of the stream.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each Miller index.
+    """
+    stream = crystalObj.stream
+    dtype = np.dtype(stream.dtype if dtype is None else dtype)
+    hkl = np.asarray(hkl, dtype=dtype).reshape(-1,3)
+    qVecs = hkl @ np.asarray(crystalObj.reciprocal, dtype=dtype)
+    qMag = np.sqrt(np.einsum('ij,ij->i', qVecs, qVecs)) / (4 * np.pi)
+
+    blockPositions = min(stream.blockCells, stream.cells) * len(stream.cellPositions)
+    step = chunk_length(blockPositions, chunkSize, np.dtype(complex_type(dtype)).itemsize)
+    intensity = np.zeros(len(hkl), dtype=dtype)
+    for start in range(0, len(hkl), step):
+        stop = min(start+step, len(hkl))
+        formFactors = normalised_form_factors(crystalObj.sites, qMag[start:stop])
+        MTotal = np.zeros((stop-start,3), dtype=complex_type(dtype))
+        for positions, siteIds, moments in stream.blocks():
+            MTotal += structure_factor(qVecs[start:stop], positions.astype(dtype, copy=False), moments.astype(dtype, copy=False),
+                                       siteIds, formFactors, chunkSize, backend)
+        intensity[start:stop] = perpendicular_intensity(qVecs[start:stop], MTotal)
+        if(progress is not None):
+            progress(stop, len(hkl))
+    return intensity
+
+def intensities(crystalObj, hkl, chunkSize=None, workers=None, symmetry=None, nufft=None, dtype=None, progress=None, backend=None):
+    """
+    Computes the diffracted intensity for an arbitrary list of Miller indices.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices to be simulated.
+    chunkSize : INT, optional
+        Number of scattering vectors per block, by default chosen from CHUNK_BYTES.
+    workers : INT, optional
+        Number of worker processes, None or 1 computes in this process and -1 uses every core. A streamed supercell
+        (createModulation(mode='stream')) is always computed in this process.
+    symmetry : BOOL or LIST, optional
+        Compute each set of symmetry-equivalent Miller indices only once. True infers the magnetic point group from the
+        crystal, otherwise a list of rotations (3x3 matrices or triplets such as '-y,x,z'), see the symmetry module.
+    nufft : FLOAT, optional
+        Relative tolerance at which to evaluate the structure factor of a supercell with the non-uniform FFT of the
+        nufft module rather than the direct sum, which pays off for large supercells. Computed in this process.
+    dtype : DTYPE, optional
+        np.float32 computes in single precision (complex64 phases), which halves the memory per Q-point and doubles the
+        chunk length. By default the precision of the crystal arrays, see mandyCrystal.createModulation. The
+        non-uniform FFT honours it too, although its FFT is computed in double precision.
+    progress : CALLABLE, optional
+        Called as progress(done, total) each time a block of Miller indices has been computed.
+    backend : STRING, optional
+        Structure-factor kernel, 'numpy', 'numba' or 'python', by default backends.DEFAULT ('auto', the fastest
+        available). Not used by the non-uniform FFT.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each Miller index.
+
+    """
+    hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+    if(symmetry is not None and symmetry is not False):
+        from . import symmetry as SYM
+        unique, inverse = SYM.reduce_hkl(hkl, SYM.symmetry_operations(crystalObj, symmetry), crystalObj.n)
+        return intensities(crystalObj, unique, chunkSize, workers, nufft=nufft, dtype=dtype, progress=progress, backend=backend)[inverse]
+    if(nufft):
+        from . import nufft as NUFFT
+        return NUFFT.intensities(crystalObj, hkl, nufft, chunkSize, progress, dtype)
+    if(getattr(crystalObj, 'stream', None) is not None):
+        return streamed_intensities(crystalObj, hkl, chunkSize, dtype, progress, backend)
+    if(workers is not None and workers != 1):
+        from . import parallel
+        return parallel.intensities(crystalObj, hkl, workers, chunkSize, dtype, progress, backend)
+
+    positions, moments, siteIds = crystal_arrays(crystalObj)
+    # Blocks of one kernel chunk each, such that progress is reported as they complete
+    itemSize = np.dtype(complex_type(positions.dtype if dtype is None else dtype)).itemsize
+    step = chunk_length(len(positions), chunkSize, itemSize)
+    blocks = []
+    for start in range(0, len(hkl), step):
+        stop = min(start+step, len(hkl))
+        blocks.append(intensity_block(hkl[start:stop], crystalObj.reciprocal, positions, moments, siteIds, crystalObj.sites,
+                                      crystalObj.modulation, crystalObj.n, chunkSize, dtype, backend))
+        if(progress is not None):
+            progress(stop, len(hkl))
+    return np.concatenate(blocks) if blocks else np.zeros(0)
+
+def scan_axis(start, stop, step):
+    """
+    Coordinates along one axis of a map, half-open in the manner of np.arange but robust to rounding of (stop-start)/step.
+
+    Parameters
+    ----------
+    start, stop, step : FLOAT
+        Range of the axis in reciprocal lattice units.
+
+    Returns
+    -------
+    NUMPY ARRAY
+        Coordinates start, start+step, ... < stop.
+
+    """
+    count = int(np.ceil((stop-start)/step - 1e-9))
+    return start + step*np.arange(max(count,0))
+
+def map_axes(axes):
+    """
+    Resolves each map axis, given as an array of coordinates or a (start, stop, step) tuple, to an array of coordinates.
+    """
+    return [scan_axis(*axis) if isinstance(axis, tuple) else np.asarray(axis, dtype=float).ravel() for axis in axes]
+
+def map_hkl(axes, vectors=None, origin=(0,0,0)):
+    """
+    Builds the Miller indices of a 1D/2D/3D map spanned by the given vectors.
+
+    Parameters
+    ----------
+    axes : LIST
+        One entry per map dimension, either an array of coordinates or a (start, stop, step) tuple.
+    vectors : LIST, optional
+        hkl direction of each map axis, by default the h, k, l directions in order.
+    origin : ARRAY-LIKE (3,)
+        Miller index at which all coordinates are zero.
+
+    Returns
+    -------
+    hkl : NUMPY ARRAY (n0,n1,...,3)
+        Miller index of every map pixel.
+
+    """
+    coords = map_axes(axes)
+    if(vectors is None):
+        vectors = np.eye(3)[:len(coords)]
+    vectors = np.asarray(vectors, dtype=float).reshape(len(coords),3)
+
+    hkl = np.broadcast_to(np.asarray(origin, dtype=float), tuple(len(c) for c in coords) + (3,)).copy()
+    for i,(coord,vector) in enumerate(zip(coords,vectors)):
+        shape = [1]*len(coords) + [3]
+        shape[i] = len(coord)
+        hkl += (coord[:,None]*vector).reshape(shape)
+    return hkl
+
+def intensity_map(crystalObj, axes, vectors=None, origin=(0,0,0), chunkSize=None, workers=None, symmetry=None, nufft=None, dtype=None, progress=None, backend=None):
+    """
+    Computes the diffracted intensity over a regular 1D/2D/3D grid of reciprocal space in a single batch.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    axes : LIST
+        One entry per map dimension, either an array of coordinates or a (start, stop, step) tuple.
+    vectors : LIST, optional
+        hkl direction of each map axis, by default the h, k, l directions in order.
+        e.g. vectors=[[0,1,0],[0,0,1]], origin=[0,0,0] for the h=0 plane.
+    origin : ARRAY-LIKE (3,)
+        Miller index at which all coordinates are zero.
+    chunkSize : INT, optional
+        Number of scattering vectors per block, by default chosen from CHUNK_BYTES.
+    workers : INT, optional
+        Number of worker processes, None or 1 computes in this process and -1 uses every core.
+    symmetry : BOOL or LIST, optional
+        Symmetry reduction of the map points, see intensities.
+    nufft : FLOAT, optional
+        Tolerance of the non-uniform FFT, see intensities.
+    dtype : DTYPE, optional
+        np.float32 for single precision, see intensities.
+    progress : CALLABLE, optional
+        Called as progress(done, total) each time a block of Miller indices has been computed.
+    backend : STRING, optional
+        Structure-factor kernel, see intensities.
+
+    Returns
+    -------
+    intensity : NUMPY ARRAY (n0,n1,...)
+        Intensity of every map pixel.
+    hkl : NUMPY ARRAY (n0,n1,...,3)
+        Miller index of every map pixel.
+
+    """
+    hkl = map_hkl(axes, vectors, origin)
+    intensity = intensities(crystalObj, hkl.reshape(-1,3), chunkSize, workers, symmetry, nufft, dtype, progress, backend)
+    return intensity.reshape(hkl.shape[:-1]), hkl
+
+def powder_hkl(crystalObj, qMax):
+    """
+    Enumerates every reflection with 0 < |Q| <= qMax, sorted by |Q|.
+
+    Without a modulation the Miller indices step by 1/n, such that the satellites of a supercell modulation are
+    included. For an analytic modulation the reflections are the satellites G+q and G-q of every lattice vector G.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    qMax : FLOAT
+        Largest |Q| in inverse Angstroms.
+
+    Returns
+    -------
+    hkl : NUMPY ARRAY (K,3)
+        Miller index of every reflection.
+    qMag : NUMPY ARRAY (K,)
+        |Q| of every reflection, ascending.
+
+    """
+    mod = crystalObj.modulation
+    step = np.ones(3) if mod is not None else 1 / np.asarray(crystalObj.n, dtype=float)
+    shifts = np.zeros((1,3)) if mod is None else np.stack([mod.q, -mod.q])
+
+    # |h_i| = |Q.a_i|/2pi <= qMax|a_i|/2pi, widened by the satellite offset
+    extent = qMax * np.linalg.norm(crystalObj.lattice, axis=1) / (2*np.pi) + np.abs(shifts).max(axis=0)
+    ranges = [np.arange(-count, count+1) * size for count,size in zip(np.floor(extent/step + 1e-9).astype(int), step)]
+    grid = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1,3)
+    hkl = (grid[None,:,:] + shifts[:,None,:]).reshape(-1,3)
+    if(mod is not None):
+        # G+q and G'-q coincide when 2q is a lattice vector
+        hkl = np.unique(np.round(hkl, 12), axis=0)
+
+    qMag = np.linalg.norm(hkl @ crystalObj.reciprocal, axis=1)
+    keep = (qMag > 0) & (qMag <= qMax * (1 + 1e-12))
+    order = np.argsort(qMag[keep], kind='stable')
+    return hkl[keep][order], qMag[keep][order]
+
+def powder_shells(crystalObj, qMax, tol=1e-6, chunkSize=None, workers=None, symmetry=None):
+    """
+    Computes the powder-averaged intensity of every |Q| shell up to qMax.
+
+    Every reflection in the sphere is evaluated in one batch and the intensities of reflections with the same |Q|
+    (within a relative tolerance tol) are summed, such that the multiplicity is included in the shell intensity.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    qMax : FLOAT
+        Largest |Q| in inverse Angstroms.
+    tol : FLOAT, optional
+        Relative difference in |Q| below which reflections belong to the same shell.
+    chunkSize, workers, symmetry
+        Passed on to intensities.
+
+    Returns
+    -------
+    intensity : NUMPY ARRAY (S,)
+        Summed intensity of each shell.
+    qShells : NUMPY ARRAY (S,)
+        |Q| of each shell, ascending.
+    multiplicity : NUMPY ARRAY (S,)
+        Number of reflections in each shell.
+
+    """
+    hkl, qMag = powder_hkl(crystalObj, qMax)
+    if(len(hkl)==0):
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)
+    intensity = intensities(crystalObj, hkl, chunkSize, workers, symmetry)
+
+    starts = np.flatnonzero(np.r_[True, np.diff(qMag) > tol * qMag[1:]])
+    multiplicity = np.diff(np.r_[starts, len(qMag)])
+    qShells = np.add.reduceat(qMag, starts) / multiplicity
+    return np.add.reduceat(intensity, starts), qShells, multiplicity
+
+def powder_pattern(crystalObj, qMax=None, wavelength=None, bins=1000, lorentz=False, tol=1e-6, chunkSize=None, workers=None, symmetry=None):
+    """
+    Computes a binned powder-diffraction pattern, I(|Q|) or, given a wavelength, I(2theta).
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    qMax : FLOAT, optional
+        Largest |Q| in inverse Angstroms, by default (and at most) 4pi/wavelength when a wavelength is given.
+    wavelength : FLOAT, optional
+        Neutron wavelength in Angstroms, the pattern is then binned in 2theta (degrees) rather than |Q|.
+    bins : INT or ARRAY-LIKE, optional
+        Number of equal bins from 0 to the largest |Q| or 2theta, or the bin edges.
+    lorentz : BOOL, optional
+        Apply the powder Lorentz factor 1/(sin(theta)sin(2theta)), only with a wavelength.
+    tol, chunkSize, workers, symmetry
+        Passed on to powder_shells.
+
+    Returns
+    -------
+    intensity : NUMPY ARRAY (B,)
+        Summed shell intensity in each bin.
+    centres : NUMPY ARRAY (B,)
+        Bin centres in inverse Angstroms or degrees 2theta.
+
+    """
+    if(wavelength is None and qMax is None):
+        raise ValueError('Either qMax or wavelength must be given.')
+    if(wavelength is not None):
+        qMax = 4*np.pi/wavelength if qMax is None else min(qMax, 4*np.pi/wavelength)
+
+    intensity, qShells, _ = powder_shells(crystalObj, qMax, tol, chunkSize, workers, symmetry)
+    if(wavelength is None):
+        x, xMax = qShells, qMax
+    else:
+        theta = np.arcsin(np.clip(qShells * wavelength / (4*np.pi), 0, 1))
+        x, xMax = np.degrees(2*theta), np.degrees(2*np.arcsin(min(qMax * wavelength / (4*np.pi), 1)))
+        if(lorentz):
+            intensity = intensity / (np.sin(theta) * np.sin(2*theta))
+
+    pattern, edges = np.histogram(x, bins=bins, range=None if np.ndim(bins) else (0, xMax), weights=intensity)
+    return pattern, 0.5*(edges[1:] + edges[:-1])
+
+def magnetic_calc(crystalObj,millerIndices,chunkSize=None,workers=None,symmetry=None,nufft=None,dtype=None,progress=None,backend=None):
     """
     Performs the diffraction calculation.
-    
+
     Parameters
     ----------
     crystalObj : mandyCrystal object
         Object which contains the crystal on which the simulation is conducted.
     millerIndices : LIST
         List of Miller Indices to be simulated in each direction.
+    chunkSize : INT, optional
+        Number of Miller indices evaluated together, by default chosen such that the phase matrix stays within CHUNK_BYTES.
+    workers : INT, optional
+        Number of worker processes, None or 1 computes in this process and -1 uses every core.
+    symmetry : BOOL or LIST, optional
+        Compute each set of symmetry-equivalent Miller indices only once, see intensities.
+    nufft : FLOAT, optional
+        Tolerance of the non-uniform FFT, see intensities.
+    dtype : DTYPE, optional
+        np.float32 for single precision, see intensities.
+    progress : CALLABLE, optional
+        Called as progress(done, total) each time a block of Miller indices has been computed.
+    backend : STRING, optional
+        Structure-factor kernel, see intensities.
 
     Returns
     -------
@@ -24,72 +647,8 @@ def magnetic_calc(crystalObj,millerIndices):
         List of simulated Miller Indices.
 
     """
-    momentList = []
-    positions = []
-    braggIntensity = []
-    braggPosition = []
-
-    # Find MTotal (total magnetic form factor)
-    MTotal_list=[]
-    # Set unit conversion (p) as unity for now
-    p = 1
-
-    # Recover the magnetic supercell
-    positions = [row[1:4] for row in crystalObj.pos_df.itertuples()]
-
-    moments = [row[0:4] for row in crystalObj.mom_df.itertuples()]
-
-    # Lambda function to recover the site from a given label
-    returnsite = lambda label: [site for site in crystalObj.sites if site.label==label]
-    
-    # Find the Q = 0 value of the form factor such that it can be normalised
-    dictKeys = [site.label for site in crystalObj.sites]
-    dictVals = [RFF.form_factor(site.ion_name,0,site.l_s[0],site.l_s[1]) for site in crystalObj.sites ]
-    normsDict = dict(zip(dictKeys,dictVals))
-
-    for h, hVal in enumerate(millerIndices[0]):
-        for k, kVal in enumerate(millerIndices[1]):
-            for l, lVal in enumerate(millerIndices[2]):
-                # Progress update
-                print('computing ['+str(hVal)+','+str(kVal)+','+str(lVal)+'] ...')
-                # Skip the (000) index as it cannot be seen experimentally and leads to div by zero in the calculations.
-                if(hVal==0 and lVal==kVal and kVal==hVal):
-                    braggIntensity.append( 0.0 )
-                    braggPosition.append([hVal,kVal,lVal])
-                    continue
-
-                # Clear list for calculation of each miller index
-                MTotal_list=[]
-                
-                # Find q in A^-1 for use with the form factor
-                qActual = hVal*crystalObj.b1 + kVal*crystalObj.b2 + lVal*crystalObj.b3
-
-                # Find the magnitude of q, divide by 4pi to match (sin theta / lambda) = (q / 4pi)
-                qMag = np.sqrt(np.dot(qActual,qActual)) / (4 * np.pi)
-                
-                # Calculate the normalised magnetic form factor
-                ffList = [RFF.form_factor(returnsite(mom[0])[0].ion_name, qMag, returnsite(mom[0])[0].l_s[0], returnsite(mom[0])[0].l_s[1]) / normsDict[mom[0]] for mom in moments]
-
-                # Apply normalised magnetic form factor
-                momentList = [np.array(a[1:4])*b for a,b in zip(moments, ffList)]
-                ###momentList = [np.array(a[1:4]) for a,b in zip(moments, ffList)] ### test without form factor
-
-                q = qActual
-                #q = [hVal,kVal,lVal]
-                                
-                # Do vector calculation
-                for i,elem in enumerate(positions):
-                    MTotalCalc = (p * np.array(momentList[i])) * cmath.exp( complex(0, -np.dot (elem , q) ) ) ### removing 2pi factor
-                    # MTotalCalc = (p * np.array(momentList[i])) * cmath.exp( complex(0, -2 * cmath.pi * np.dot (elem , q) ) )
-                    MTotal_list.append(MTotalCalc)
-
-                MTotal = sum(MTotal_list)
-               
-                MTotalOrth = (1/np.dot( q , q )) * np.cross( q , np.cross( MTotal , q ) )
-
-                braggIntensity.append( np.dot( np.conj( MTotalOrth ) , MTotalOrth ) )
-                
-                braggPosition.append([hVal,kVal,lVal])
+    braggPosition = miller_list(millerIndices)
+    # The (000) index cannot be seen experimentally and is returned with zero intensity.
+    braggIntensity = intensities(crystalObj, braggPosition, chunkSize, workers, symmetry, nufft, dtype, progress, backend).tolist()
 
     return braggIntensity, braggPosition
-                
@@ -0,0 +1,177 @@
+import numpy as np
+from dataclasses import dataclass
+from . import diffraction
+
+"""
+Sub-routine to compute the diffraction of magnetic structures with several propagation vectors (arms) and domains.
+
+Each component is a single-k modulation of the unit cell as in mandyCrystal.createModulation(..., mode='analytic'),
+with its own wavevector, modulation plane, envelope and domain weight. Components in the same domain are summed
+coherently, e.g. the arms of a multi-k structure, and domains are summed incoherently with their weights,
+    I(Q) = sum_d w_d |M_perp,d(Q)|^2,   M_d(Q) = sum_{c in d} F_c(Q).
+Every component contributes at its satellites Q+q and Q-q, and
+    exp(-i(Q+-q).r_j) = exp(-iQ.r_j) exp(-+iq.r_j),
+so the factor exp(-+iq.r_j) is folded into the moments of the component and the phase matrix exp(-iQ.r_j) of each
+block of Q is computed once and shared by every component of every domain.
+"""
+
+@dataclass
+class magneticComponent:
+    """
+    One propagation vector of the magnetic structure, see mandyCrystal.createModulation for q, u, v, m1, m2 and rotate.
+
+    weight is the population of the domain and domain a label grouping the components summed coherently, by default
+    each component being a domain of its own.
+    """
+    q: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    m1: float = 1
+    m2: float = 1
+    weight: float = 1.0
+    rotate: bool = False
+    domain: object = None
+
+def as_component(component):
+    """
+    magneticComponent from a magneticComponent, a dict of its fields or a tuple (q, u, v, m1, m2, weight).
+    """
+    if(isinstance(component, magneticComponent)):
+        return component
+    if(isinstance(component, dict)):
+        return magneticComponent(**component)
+    return magneticComponent(*component)
+
+def domain_groups(components):
+    """
+    Groups the components into domains.
+
+    Returns
+    -------
+    LIST
+        (weight, indices) of each domain, in order of first appearance, indices being positions in components.
+    """
+    groups = {}
+    for i,component in enumerate(components):
+        key = ('component', i) if component.domain is None else ('domain', component.domain)
+        groups.setdefault(key, []).append(i)
+    domains = []
+    for key,indices in groups.items():
+        weights = {float(components[i].weight) for i in indices}
+        if(len(weights)!=1):
+            raise ValueError('Components of domain {} have different weights {}.'.format(key[1], sorted(weights)))
+        domains.append((weights.pop(), indices))
+    return domains
+
+def component_moments(crystalObj, components, dtype=float):
+    """
+    Moments of every component folded with its satellite phases, the columns summed over the unit cell in one pass.
+
+    Returns
+    -------
+    NUMPY ARRAY (P,6C)
+        For each component c, columns 6c:6c+3 are c_j exp(-iq.r_j) and 6c+3:6c+6 are c_j* exp(+iq.r_j), with
+        c_j = m_j*(m1*u + i*m2*v) the complex amplitude on position j of the unit cell.
+    """
+    positions = crystalObj.cellPositions
+    moments = crystalObj.siteMoments[crystalObj.cellSiteIds]
+    columns = []
+    for component in components:
+        qCart = np.asarray(component.q, dtype=float) @ crystalObj.reciprocal
+        envelope = component.m1*np.asarray(component.u, dtype=float) + 1j*component.m2*np.asarray(component.v, dtype=float)
+        amplitude = (np.linalg.norm(moments, axis=1)[:,None] if component.rotate else moments) * envelope
+        phase = np.exp(-1j * (positions @ qCart))[:,None]
+        columns += [amplitude * phase, np.conj(amplitude) * np.conj(phase)]
+    return np.concatenate(columns, axis=1).astype(diffraction.complex_type(dtype))
+
+def domain_block(hkl, crystalObj, components, domains, columns, n, chunkSize=None, dtype=float, backend=None):
+    """
+    Intensity summed over the domains for a block of Miller indices, see domain_intensities.
+    """
+    hkl = np.asarray(hkl, dtype=dtype)
+    reciprocal = np.asarray(crystalObj.reciprocal, dtype=dtype)
+    positions = np.asarray(crystalObj.cellPositions, dtype=dtype)
+    qVecs = hkl @ reciprocal
+    qMag = np.sqrt(np.einsum('ij,ij->i', qVecs, qVecs)) / (4 * np.pi)
+    # Form factors are evaluated at Q itself, as for the analytic modulation
+    formFactors = diffraction.normalised_form_factors(crystalObj.sites, qMag)
+
+    # Unit cell sums at every satellite of every component, from one shared phase matrix per block
+    sums = diffraction.structure_factor(qVecs, positions, columns, crystalObj.cellSiteIds, formFactors, chunkSize, backend)
+    sums = sums.reshape(len(hkl), len(components), 2, 3)
+
+    # Re[c exp(-iq.R)] = ( c exp(-iq.R) + c* exp(+iq.R) ) / 2, each satellite multiplied by its lattice sum
+    MComponents = np.zeros((len(hkl), len(components), 3), dtype=sums.dtype)
+    for c,component in enumerate(components):
+        modHkl = np.asarray(component.q, dtype=hkl.dtype)
+        for harmonic,sign in enumerate((1,-1)):
+            MComponents[:,c] += 0.5 * sums[:,c,harmonic] * diffraction.lattice_sum(hkl + sign*modHkl, n)[:,None]
+
+    intensity = np.zeros(len(hkl), dtype=hkl.dtype)
+    for weight,indices in domains:
+        intensity += weight * diffraction.perpendicular_intensity(qVecs, MComponents[:,indices].sum(axis=1))
+    return intensity
+
+def domain_intensities(crystalObj, hkl, components, n=None, chunkSize=None, dtype=None, progress=None, backend=None):
+    """
+    Computes the diffracted intensity of a multi-k, multi-domain magnetic structure for a list of Miller indices.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Built crystal, whose unit cell and site moments are modulated by the components. Any modulation made with
+        createModulation is ignored.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices to be simulated.
+    components : LIST
+        magneticComponent objects, dicts of their fields or tuples (q, u, v, m1, m2, weight).
+    n : ARRAY-LIKE (3,), optional
+        Number of unit cells over which the structure is summed, by default crystalObj.n.
+    chunkSize : INT, optional
+        Number of scattering vectors per block, by default chosen from diffraction.CHUNK_BYTES.
+    dtype : DTYPE, optional
+        np.float32 for single precision, see diffraction.intensities.
+    progress : CALLABLE, optional
+        Called as progress(done, total) each time a block of Miller indices has been computed.
+    backend : STRING, optional
+        Structure-factor kernel, see diffraction.intensities.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each Miller index, the weighted sum over the domains.
+    """
+    components = [as_component(component) for component in components]
+    if(not components):
+        raise ValueError('At least one magnetic component is needed.')
+    domains = domain_groups(components)
+    hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+    n = crystalObj.n if n is None else n
+    dtype = np.dtype(float if dtype is None else dtype)
+    columns = component_moments(crystalObj, components, dtype)
+
+    # The phase matrix of a block is shared by every component, so the block length follows the unit cell alone
+    step = diffraction.chunk_length(len(crystalObj.cellPositions) + columns.shape[1], chunkSize, np.dtype(columns.dtype).itemsize)
+    blocks = []
+    for start in range(0, len(hkl), step):
+        stop = min(start+step, len(hkl))
+        blocks.append(domain_block(hkl[start:stop], crystalObj, components, domains, columns, n, chunkSize, dtype, backend))
+        if(progress is not None):
+            progress(stop, len(hkl))
+    return np.concatenate(blocks) if blocks else np.zeros(0)
+
+def domain_map(crystalObj, axes, components, vectors=None, origin=(0,0,0), n=None, chunkSize=None, dtype=None, progress=None, backend=None):
+    """
+    Computes a 1D/2D/3D map of a multi-k, multi-domain magnetic structure, see diffraction.intensity_map for the
+    definition of the map and domain_intensities for the other parameters.
+
+    Returns
+    -------
+    intensity : NUMPY ARRAY (n0,n1,...)
+        Intensity of every map pixel.
+    hkl : NUMPY ARRAY (n0,n1,...,3)
+        Miller index of every map pixel.
+    """
+    hkl = diffraction.map_hkl(axes, vectors, origin)
+    intensity = domain_intensities(crystalObj, hkl.reshape(-1,3), components, n, chunkSize, dtype, progress, backend)
+    return intensity.reshape(hkl.shape[:-1]), hkl
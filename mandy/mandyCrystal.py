@@ -1,14 +1,118 @@
-import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
-import cmath
+import csv
 import math
 import os
 import pathlib
-from dataclasses import dataclass,field
-from crystals import Crystal
-from gemmi import cif
+import hashlib
+import logging
+from dataclasses import dataclass,asdict
+from . import profiling
 
+# pandas, crystals and matplotlib are imported where they are used, such that importing this module stays cheap
+
+# Built unit cells are cached here, keyed by the content of the CIF and site name files
+CACHE_DIR = pathlib.Path(os.environ.get('MANDY_CACHE_DIR', pathlib.Path.home().joinpath('.mandy','cells')))
+# Part of the cache key, bumped whenever the cached arrays change
+CACHE_VERSION = 1
+# Default number of positions generated per block of a streamed supercell, see createModulation(mode='stream')
+STREAM_POSITIONS = 2**16
+
+logger = logging.getLogger(__name__)
+
+_atomicSymbols = None
+
+def atomic_symbols():
+    """
+    NUMPY ARRAY of element symbols indexed by atomic number, read once from atomic_data.csv.
+    """
+    global _atomicSymbols
+    if(_atomicSymbols is None):
+        csvFilePath = pathlib.Path(__file__).parent.joinpath("atomic_data.csv")
+        with open(csvFilePath,'r') as file:
+            rows = list(csv.DictReader(file))
+        symbols = np.full(max(int(row['AtomicNumber']) for row in rows)+1, '', dtype=object)
+        for row in rows:
+            symbols[int(row['AtomicNumber'])] = row['Symbol']
+        _atomicSymbols = symbols.astype(str)
+    return _atomicSymbols
+
+def cell_cache_key(cifPath, sitePath):
+    """
+    SHA-256 of the CIF and site name file contents, under which the built unit cell is cached.
+    """
+    digest = hashlib.sha256('mandy-cell-v{}'.format(CACHE_VERSION).encode())
+    for path in (cifPath, sitePath):
+        digest.update(pathlib.Path(path).read_bytes())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def write_cell_cache(path, cell):
+    """
+    Stores the arrays of a built unit cell as a .npz file, through a temporary file such that readers never see a partial one.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmpPath = path.with_suffix('.tmp{}'.format(os.getpid()))
+        with open(tmpPath,'wb') as file:
+            np.savez(file, **cell)
+        os.replace(tmpPath, path)
+    except OSError as e:
+        logger.warning('Could not write unit cell cache %s : %s', path, e)
+
+
+def modulated_supercell(lattice, cellPositions, cellSiteIds, siteMoments, n, q, u, v, m1=1, m2=1, rotate=False, dtype=float, start=0, stop=None):
+    """
+    Tiles the unit cell n times and evaluates the modulated moment on every position, see mandyCrystal.createModulation.
+
+    Cells are numbered (iz*n2 + iy)*n1 + ix, and only cells start:stop are generated, by default all of them, such that
+    a supercell can also be produced in blocks.
+
+    Parameters
+    ----------
+    lattice : NUMPY ARRAY (3,3)
+        Lattice vectors as rows.
+    cellPositions, cellSiteIds
+        Cartesian positions (P,3) and site indices (P,) of the unit cell.
+    siteMoments : NUMPY ARRAY (S,3)
+        Moment of each site.
+    n : ARRAY-LIKE (3,)
+        Number of unit cells along each lattice vector.
+    q : NUMPY ARRAY (3,)
+        Cartesian wavevector of the modulation.
+    u, v, m1, m2, rotate
+        Modulation plane, envelope and mode, see createModulation.
+    dtype : DTYPE, optional
+        Floating point type of the returned positions and moments, which are always evaluated in double precision.
+    start, stop : INT, optional
+        Range of cells to generate.
+
+    Returns
+    -------
+    positions : NUMPY ARRAY (N,3)
+        Cartesian positions, site fastest then a, b, c.
+    siteIds : NUMPY ARRAY (N,)
+        Site of each position.
+    moments : NUMPY ARRAY (N,3)
+        Modulated moment on each position.
+    """
+    with profiling.stage('supercell'):
+        # Lattice translations of the unit cells in the range, a-direction fastest
+        n = [int(size) for size in n]
+        index = np.arange(start, n[0]*n[1]*n[2] if stop is None else stop)
+        cells = np.stack([index % n[0], (index // n[0]) % n[1], index // (n[0]*n[1])], axis=1) @ lattice
+
+        # Tile the unit cell onto every translation, positions are ordered site-fastest within each cell
+        positions = (cells[:,None,:] + cellPositions[None,:,:]).reshape(-1,3)
+        siteIds = np.tile(cellSiteIds, len(cells))
+
+        # Modulated moment Re[ c exp(-iq.R) ] = Re(c) cos(q.R) + Im(c) sin(q.R), with c = m*(m1*u + i*m2*v) ### removing 2pi factor
+        cellMoments = siteMoments[cellSiteIds]
+        if(rotate):
+            cellMoments = np.linalg.norm(cellMoments, axis=1)[:,None]
+        amplitude = np.tile(cellMoments * (m1*np.asarray(u) + 1j*m2*np.asarray(v)), (len(cells),1))
+        phase = positions @ q
+        moments = amplitude.real*np.cos(phase)[:,None] + amplitude.imag*np.sin(phase)[:,None]
+        return positions.astype(dtype, copy=False), siteIds, moments.astype(dtype, copy=False)
 
 @dataclass
 class site:
@@ -37,141 +141,271 @@ class site:
     label: str = 'Fe2a'
 
 
+@dataclass
+class streamedSupercell:
+    """
+    A modulated supercell which is generated block by block when it is summed over rather than held in memory, see
+    createModulation(mode='stream').
+
+    The unit cell arrays and the modulation are as for modulated_supercell, with q Cartesian. blockCells is the number
+    of unit cells per block.
+    """
+    lattice: np.ndarray
+    cellPositions: np.ndarray
+    cellSiteIds: np.ndarray
+    siteMoments: np.ndarray
+    n: np.ndarray
+    q: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    m1: float = 1
+    m2: float = 1
+    rotate: bool = False
+    blockCells: int = 1
+    dtype: type = float
+
+    @property
+    def cells(self):
+        return int(np.prod(self.n))
+
+    @property
+    def size(self):
+        """
+        Number of positions in the supercell.
+        """
+        return self.cells * len(self.cellPositions)
+
+    def blocks(self):
+        """
+        Generates (positions, siteIds, moments) for consecutive blocks of cells, in the order of modulated_supercell.
+        """
+        for start in range(0, self.cells, self.blockCells):
+            yield modulated_supercell(self.lattice, self.cellPositions, self.cellSiteIds, self.siteMoments, self.n, self.q, self.u,
+                                      self.v, self.m1, self.m2, self.rotate, self.dtype, start, min(start+self.blockCells, self.cells))
+
+@dataclass
+class modulation:
+    """
+    Encapsulates a single-k moment modulation, m(R) = Re[ m * (m1*u + i*m2*v) * exp(-iq.R) ].
+
+    Parameters
+    ----------
+    q      : numpy array
+        wavevector of the modulation in fractional (reciprocal lattice) units.
+    u,v    : numpy array
+        vectors specifying the plane of the modulation.
+    m1,m2  : float
+        envelope controls of the modulation.
+    rotate : bool
+        use |m| rather than m as the amplitude, such that the moment rotates in the (u,v) plane.
+    Returns
+    -------
+    self : modulation
+        dataclass representing a modulation.
+    """
+
+    q: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    m1: float = 1
+    m2: float = 1
+    rotate: bool = False
+
+
 class mandyCrystal:
-    def __init__(self,cifpath:str,sites:list):
+    def __init__(self,cifpath:str,sites:list,sitepath:str=None):
         self.cifPath = cifpath
         self.sites = sites
-        #self.n = np.array([1,1,1])
+        # Site name file, by default '<cif name>SiteNames.dat' in the current working directory
+        self.sitePath = sitepath
+        self.n = np.array([1,1,1])
+        # Set by createModulation(mode='analytic'), in which case positions/moments hold only the unit cell
+        self.modulation = None
+        # Set by createModulation(mode='stream'), in which case the supercell is only generated while it is summed over
+        self.stream = None
+        # (mode, modulation) of the last createModulation whatever its mode, described by metadata()
+        self.appliedModulation = None
     
-    def build(self):    
+    def build(self, cache: bool = True):
         """
         Builds the crystal for use in calculations.
         
         Parameters
         ----------
-        cifPath : STRING
-            File path of the CIF file to build a crystal from.
+        cache : BOOL
+            Reuse the unit cell built previously from identical CIF and site name files, see CACHE_DIR.
     
         Returns
         -------
-        pos_df : PANDAS DATAFRAME
-            dataframe containing unit cell positions indexed by site name.
-        mom_df : PANDAS DATAFRAME
-            dataframe containing the moments associated with each type of site.
+        positions : NUMPY ARRAY (N,3)
+            cartesian unit cell positions, also kept as cellPositions.
+        siteIds : NUMPY ARRAY (N,)
+            index into sites for each position, also kept as cellSiteIds.
+        moments : NUMPY ARRAY (N,3)
+            the moment on each position, taken from its site.
         len : NUMPY ARRAY (3,1)
             lattice parameters of the crystal.
         ang : NUMPY ARRAY (3,1)
             lattice angles of the crystal.
         """
-        print('Building Crystal')
-        print('----------------------------------------------------------------------------------------------')
-       
-        #Read the cif file and save it in a block, standard procedure when working with gemmi
-        doc = cif.read_file(self.cifPath)
-        block = doc.sole_block()
-        # Read CIF file to facilitate extraction of lattice parameters
+        logger.info('Building Crystal')
+        logger.info('----------------------------------------------------------------------------------------------')
+        for site in self.sites:
+            logger.info('%s', site)
+
+        sitePath = self.site_name_path()
+        cachePath = CACHE_DIR.joinpath(cell_cache_key(self.cifPath, sitePath) + '.npz') if(cache and os.path.exists(sitePath)) else None
+
+        if(cachePath is not None and cachePath.exists()):
+            with np.load(cachePath, allow_pickle=False) as data:
+                cell = {key:data[key] for key in data.files}
+            logger.info('Loaded unit cell from cache %s', cachePath)
+        else:
+            with profiling.stage('cif_parse'):
+                cell = self.parse_cell(sitePath)
+            if(cache):
+                write_cell_cache(CACHE_DIR.joinpath(cell_cache_key(self.cifPath, sitePath) + '.npz'), cell)
+
+        # Storing lattice parameters
+        self.a1, self.a2, self.a3 = cell['lattice']
+        self.b1, self.b2, self.b3 = cell['reciprocal']
+        reciprocalLengths = cell['reciprocalParameters'][0:3]
+        reciprocalAngles = cell['reciprocalParameters'][3:6]
+        self.cellFractional = cell['fractional']
+        self.symbols = cell['symbols'].tolist()
+        newIndex = cell['labels'].tolist()
+
+        # Structure-of-arrays description of the unit cell, site ids index into self.sites
+        siteIndex = {site.label:i for i,site in enumerate(self.sites)}
+        missing = sorted(set(newIndex) - set(siteIndex))
+        if(missing):
+            raise ValueError('Site names {} have no corresponding magnetic site.'.format(missing))
+
+        self.indices = newIndex
+        self.siteMoments = np.array([site.moment for site in self.sites], dtype=float)
+        self.cellPositions = np.ascontiguousarray(cell['positions'], dtype=float)
+        self.cellSiteIds = np.array([siteIndex[label] for label in newIndex], dtype=np.intp)
+        self.positions = self.cellPositions
+        self.siteIds = self.cellSiteIds
+        self.moments = self.siteMoments[self.siteIds]
+        self.modulation = None
+        self.stream = None
+        self.appliedModulation = None
+        self.reciprocalLengths = reciprocalLengths
+        self.reciprocalAngles = reciprocalAngles
+
+        # The table needs pandas, so it is only built when it will be shown
+        if(logger.isEnabledFor(logging.INFO)):
+            logger.info('\n%s', self.pos_df)
+        logger.info('----------------------------------------------------------------------------------------------')
+
+    def site_name_path(self):
+        """
+        Path of the site name file, by default '<cif name>SiteNames.dat' in the current working directory.
+        """
+        if(self.sitePath is not None):
+            return str(self.sitePath)
+        cifFileName = pathlib.Path(self.cifPath).stem
+        filename = '{}SiteNames.dat'.format( cifFileName ) # File name based upon the CIF file.
+        return os.path.join(os.getcwd(),filename)   # Join the file name and cwd in an operating-system independent manner
+
+    def parse_cell(self, sitePath):
+        """
+        Reads the unit cell from the CIF file and labels its positions from the site name file, prompting for the labels
+        and writing the file if it does not exist.
+
+        Returns
+        -------
+        DICT
+            lattice and reciprocal (3,3) with vectors as rows, reciprocalParameters (6,), fractional and cartesian
+            positions (N,3), atomicNumbers, symbols and labels (N,).
+        """
+        from crystals import Crystal
+
+        # Read CIF file once, crystals expands the asymmetric unit and provides the lattice
         crystalData = Crystal.from_cif(self.cifPath)
-        crystalArray = np.array(crystalData)
-        # Storing lattice parameters 
-        self.a1, self.a2, self.a3 = crystalData.lattice_vectors
-        self.b1, self.b2, self.b3 = crystalData.reciprocal_vectors
-        
-        reciprocalLengths = np.array(crystalData.reciprocal.lattice_parameters[0:3])
-        reciprocalAngles = np.array(crystalData.reciprocal.lattice_parameters[3:6])
-        
+        crystalArray = np.array(crystalData).astype(float)
+        atomicNumbers = crystalArray[:,0].astype(int)
+        fractional = np.ascontiguousarray(crystalArray[:,1:4])
+        lattice = np.array(crystalData.lattice_vectors, dtype=float)
 
-        # Produce list of lists containing the information of each magnetic site
-        momentData = []
-        for site in self.sites:
-            print(site)
-            momentData.append([site.label,site.moment[0],site.moment[1],site.moment[2]])
-
-        ### Construct the pandas dataframes 
-        # name the corresponding columns and also, make element to be the index
-        mom_df = pd.DataFrame(momentData, columns=['Element','m1','m2','m3'])
-        mom_df = mom_df.set_index('Element')
-        # Recover the index labels by mom_df.index.tolist()
-        print(mom_df)
-        
-        pos_df = pd.DataFrame(crystalArray,columns=['Element','x','y','z'])
-        pos_df = pos_df.set_index('Element')
-        print('----------------------------------------------------------------------------------------------')
-        
-        # Mainly work with crystals package here to take the coordinates with their atomic number and just change 9 -> 'F', 28 -> 'Ni', etc
-        csvFilePath = pathlib.Path(__file__).parent.joinpath("atomic_data.csv")
-        atomicData = pd.read_csv(csvFilePath)
-        atomicData = atomicData.set_index('AtomicNumber')
-        
-        #Create this empty list that will contain all the symbols and later we will set this as an index for df2
-        symbForPos = []
-        for index, row2 in atomicData.iterrows():
-            #print(index)
-            for index2, rows in pos_df.iterrows():
-                #print(j[0])
-                if index == index2:
-                    #create a new column that contains the symbol
-                    symbForPos.append(row2['Symbol'])
-                    
-        #Print to see all the coresponding symbols and finally atach them to the df and make them an index, exacly as planned!      
-        pos_df['symbols'] = symbForPos 
-        pos_df = pos_df.set_index('symbols')
-        print(pos_df)
-        
         # Produce labels for the sites
-        # Try to find a site name file in the current working directory (cwd)
-    
-        #Create an emty list where the new names will be stored
-        newIndex = []
-        
-        cifFileName = self.cifPath[self.cifPath.rfind('/')+1:-4]
-        filename = '{}SiteNames.dat'.format( cifFileName ) # File name based upon the CIF file.
-        filepath = os.path.join(os.getcwd(),filename)   # Join the file name and cwd in an operating-system independent manner
-        
         try:
-            file = open(filepath,'r' )
-            for line in file:
-                newIndex.append(line.strip(f'\n'))
-            file.close()
-            
-        except FileNotFoundError:    
-            for ind, j in pos_df.iterrows():  # Iterate over indices and coordinates called j, ind = index
-                coordinates = [j['x'], j['y'], j['z']]
-            
+            with open(sitePath,'r') as file:
+                newIndex = [line.strip() for line in file if line.strip()]
+
+        except FileNotFoundError:
+            newIndex = []
+            for coordinates in fractional.tolist():
                 print("moment label for : "+str(coordinates))
-                user_input = input()
-                newIndex.append(user_input)
-                #Save the coords in a list 
-               
-            file = open('{}SiteNames.dat'.format( cifFileName  ),'w' )
-            [file.write(line + '\n') for line in newIndex]
-            file.close()
-        
-        print('----------------------------------------------------------------------------------------------')
-        
-        # Convert fractional coordinates to cartesian coordinates
-
-        pos_df.reset_index(inplace=True,drop=True)
-        for i,row in enumerate(pos_df.itertuples()):
-             cartesianArray = np.array((np.array(pos_df.loc[i].x).dot(self.a1)) + (np.array(pos_df.loc[i].y).dot(self.a2)) + (np.array(pos_df.loc[i].z).dot(self.a3)))
-             pos_df.at[i,'x'] = cartesianArray[0]
-             pos_df.at[i,'y'] = cartesianArray[1]
-             pos_df.at[i,'z'] = cartesianArray[2]
-            
-        pos_df['site_name'] = newIndex   #create a new column called newIndex
-        pos_df = pos_df.set_index('site_name') #Now change its index to newIndex  
-        
-        print(pos_df)  #I have created new dataframce with the corresponding names that I can use 
-        #All that need to be done is add Fe2a and Fe6h to the magnetic data and you can combine them
-        print('----------------------------------------------------------------------------------------------')
-        
-        self.indices = newIndex
-        self.pos_df = pos_df
-        self.mom_df = mom_df
-        self.reciprocalLengths = reciprocalLengths
-        self.reciprocalAngles = reciprocalAngles
-        
+                newIndex.append(input())
+
+            with open(sitePath,'w') as file:
+                [file.write(line + '\n') for line in newIndex]
+
+        if(len(newIndex)!=len(fractional)):
+            raise ValueError('Site name file {} has {} names for {} positions.'.format(sitePath, len(newIndex), len(fractional)))
+
+        return {'lattice': lattice,
+                'reciprocal': np.array(crystalData.reciprocal_vectors, dtype=float),
+                'reciprocalParameters': np.array(crystalData.reciprocal.lattice_parameters, dtype=float),
+                'fractional': fractional,
+                # Convert fractional coordinates to cartesian coordinates
+                'positions': fractional @ lattice,
+                'atomicNumbers': atomicNumbers,
+                'symbols': atomic_symbols()[atomicNumbers],
+                'labels': np.array(newIndex, dtype=str)}
+
+    @property
+    def lattice(self):
+        """
+        NUMPY ARRAY (3,3) whose rows are the lattice vectors a1, a2, a3.
+        """
+        return np.array([self.a1, self.a2, self.a3], dtype=float)
+
+    @property
+    def reciprocal(self):
+        """
+        NUMPY ARRAY (3,3) whose rows are the reciprocal lattice vectors b1, b2, b3.
+        """
+        return np.array([self.b1, self.b2, self.b3], dtype=float)
+
+    def metadata(self):
+        """
+        Describes the crystal and its modulation with JSON-serialisable types, for storing alongside results.
+
+        Returns
+        -------
+        DICT
+            cif path, sites, supercell size and modulation (its mode, q, u, v, m1, m2 and rotate, None if the crystal is
+            not modulated).
+        """
+        jsonable = lambda val: np.asarray(val).tolist() if isinstance(val, (np.ndarray, np.generic)) else val
+        return {'cif': str(self.cifPath),
+                'sites': [{key:jsonable(val) for key,val in asdict(site).items()} for site in self.sites],
+                'n': np.asarray(self.n).tolist(),
+                'modulation': None if self.appliedModulation is None else
+                              dict(mode=self.appliedModulation[0], **{key:jsonable(val) for key,val in asdict(self.appliedModulation[1]).items()})}
+
+    @property
+    def pos_df(self):
+        """
+        PANDAS DATAFRAME view of the positions, indexed by site name.
+        """
+        import pandas as pd
+        labels = np.array([site.label for site in self.sites])[self.siteIds]
+        return pd.DataFrame(self.positions, columns=['x','y','z'], index=pd.Index(labels, name='site_name'))
+
+    @property
+    def mom_df(self):
+        """
+        PANDAS DATAFRAME view of the moment on each position, indexed by site name.
+        """
+        import pandas as pd
+        return pd.DataFrame(self.moments, columns=['m1','m2','m3'], index=self.pos_df.index)
+
    
-    def createModulation(self, q, u, v, m1=1, m2=1, n=None, rotate: bool = False):
+    def createModulation(self, q, u, v, m1=1, m2=1, n=None, rotate: bool = False, mode: str = 'supercell', dtype=None, blockCells=None):
         """
         default value of n set to ceiling function of 1 / q
         default direction is in c
@@ -185,12 +419,27 @@ class mandyCrystal:
             envelope controls of the modulation
         n
             numpy array of the unit cells
+        mode
+            'supercell' tiles the unit cell n times and stores the modulated moments in positions/moments.
+            'analytic' keeps the unit cell and stores the modulation, the diffraction sum over the n cells is then evaluated in closed form.
+            'stream' keeps the unit cell and stores a streamedSupercell in stream, the supercell is then generated block
+            by block while the diffraction sum is accumulated, such that memory is bounded by the block rather than the
+            supercell. Only diffraction.intensities and the routines built on it accept such a crystal.
+        dtype
+            np.float32 stores positions and moments in single precision, halving the memory of large supercells, and
+            makes the diffraction routines compute in single precision by default. By default double precision.
+        blockCells
+            number of unit cells per block in 'stream' mode, by default about STREAM_POSITIONS positions per block.
 
         Returns
         -------
         None.
 
        """
+        if(mode not in ('supercell','analytic','stream')):
+            raise ValueError('Unknown modulation mode "{}", expected "supercell", "analytic" or "stream".'.format(mode))
+
+        qFrac = np.asarray(q, dtype=float)
         # convert from fractional coords
         q = q[0]*self.b1 + q[1]*self.b2 + q[2]*self.b3
 
@@ -201,50 +450,39 @@ class mandyCrystal:
                 tempN += [None]                         # Pad out the list since not using append here.
                 if(q[i]>=0.01):
                     tempN[i] = math.ceil(1/q[i])     # Set value based upon the propagation vector, prevent fractional unit cells from being produced with ceiling function.
-                    print('Using n{}={}'.format(['x','y','z'][i],tempN[i]))
+                    logger.info('Using n%s=%d', ['x','y','z'][i], tempN[i])
                 else:                                   # Prevent automatically generating 100s of unit cells
                     tempN[i] = 1
-                    print('q < 0.01 ({0}-dir), setting n{0}=1 to prevent generation of 100s of unit cells. If this is a mistake please specify the kwarg "n" ([3,1] numpy array).'.format(*['x','y','z'][i]))
+                    logger.warning('q < 0.01 ({0}-dir), setting n{0}=1 to prevent generation of 100s of unit cells. If this is a mistake please specify the kwarg "n" ([3,1] numpy array).'.format(*['x','y','z'][i]))
             self.n = np.array(tempN)
         else:
             self.n = n
 
-        values = [ np.array(row3[1:4]) for row3 in self.pos_df.itertuples() ]    
+        dtype = float if dtype is None else dtype
+        self.modulation = None
+        self.stream = None
+        self.appliedModulation = (mode, modulation(qFrac, np.asarray(u, dtype=float), np.asarray(v, dtype=float), m1, m2, rotate))
+        if(mode in ('analytic','stream')):
+            self.positions = self.cellPositions.astype(dtype, copy=False)
+            self.siteIds = self.cellSiteIds
+            self.moments = self.siteMoments[self.cellSiteIds].astype(dtype, copy=False)
+        if(mode=='analytic'):
+            self.modulation = self.appliedModulation[1]
+            return
+        if(mode=='stream'):
+            blockCells = max(1, STREAM_POSITIONS // len(self.cellPositions)) if blockCells is None else int(blockCells)
+            self.stream = streamedSupercell(self.lattice, self.cellPositions, self.cellSiteIds, self.siteMoments, np.asarray(self.n), q,
+                                            np.asarray(u, dtype=float), np.asarray(v, dtype=float), m1, m2, rotate, blockCells, dtype)
+            return
 
-        # Add unit cells in a,b,c directions
-        values += [row + self.a1*(ix+1) for ix in range(self.n[0]-1) for row in values if self.n[0]>1] 
-        values += [row + self.a2*(iy+1) for iy in range(self.n[1]-1) for row in values if self.n[1]>1] 
-        values += [row + self.a3*(iz+1) for iz in range(self.n[2]-1) for row in values if self.n[2]>1] 
- 
-        reIndex = pd.Index(self.indices*np.prod(self.n), name = 'site_name')      # self.indices*n tiles the indices n times to allign with the supercell
+        self.positions, self.siteIds, self.moments = modulated_supercell(self.lattice, self.cellPositions, self.cellSiteIds, self.siteMoments,
+                                                                         self.n, q, u, v, m1, m2, rotate, dtype)
 
-        self.pos_df = pd.DataFrame(values, columns=['x','y','z'], index = reIndex)  # Updating positions dataframe to contain the supercell
-        
-        
-        # Assigning the correct moments to each position in the supercell
-        momentList = []
-        if(rotate):
-            for row in self.pos_df.itertuples():
-                m = np.array( self.mom_df.loc[ row[0] ] )  # Recover moment from dataframe
-                moment = np.linalg.norm(m) * (m1*u + 1j*m2*v) * cmath.exp( complex(0, -(np.dot(q,row[1:4]))) ) ### removing 2pi factor
-                momentList.append(moment.real)
-        else:
-            for row in self.pos_df.itertuples():
-                m = np.array( self.mom_df.loc[ row[0] ] )  # Recover moment from dataframe
-                moment = (m) * (m1*u + 1j*m2*v) * cmath.exp( complex(0, -(np.dot(q,row[1:4]))) ) ### moment * modulation | removing 2pi factor
-                # moment = np.linalg.norm(m) * (m1*u + 1j*m2*v) * cmath.exp( complex(0, -(np.dot(q,row[1:4]))) ) ### removing 2pi factor
-                # moment = np.linalg.norm(m) * (m1*u + 1j*m2*v) * cmath.exp( complex(0, -2*cmath.pi * (np.dot(q,row[1:4]))) )
-                momentList.append(moment.real)
-         
-        self.mom_df = pd.DataFrame(momentList, columns=['m1','m2','m3'],index=self.pos_df.index.copy())  # Updating positions dataframe to contain the supercell, copy over the indices from pos_df  
-        
     def plotCrystal(self, moment_scale = 1):
-            x = np.array(self.pos_df.x)
-            y = np.array(self.pos_df.y)
-            z = np.array(self.pos_df.z)
-            u = np.array(self.mom_df.m1)
-            v = np.array(self.mom_df.m2)
-            w = np.array(self.mom_df.m3)
+            import matplotlib.pyplot as plt
+
+            x, y, z = self.positions.T
+            u, v, w = self.moments.T
 
             fig = plt.figure()
             ax = plt.axes(projection='3d')
@@ -0,0 +1,174 @@
+import numpy as np
+from . import diffraction
+from . import profiling
+from .resolution import fast_length
+
+"""
+Sub-routine to evaluate the structure factor of large supercells with a non-uniform FFT.
+
+A supercell built by createModulation is the unit cell tiled on the integer grid of cell translations T, so that
+    F(Q) = sum_p f_p(|Q|) exp(-iQ.c_p) D_p(h),   D_p(h) = sum_T m_{p,T} exp(-2pi i h.T)
+with c_p the positions in the unit cell. Each D_p is a trigonometric polynomial in h, which is evaluated at arbitrary
+Miller indices as a type-2 non-uniform FFT: the moments are deconvolved by the Fourier transform of a spreading kernel,
+transformed onto a grid oversampled by OVERSAMPLING with one FFT, and interpolated onto each h with the kernel. The
+cost is O(N_atoms log N_atoms) for the FFT and O(w^3) per Miller index for the interpolation, with the kernel width w
+set by the requested tolerance, rather than O(N_atoms) per Miller index for the direct sum.
+"""
+
+OVERSAMPLING = 2.0
+
+def kernel_parameters(tol):
+    """
+    Width (grid points) and shape parameter of the 'exponential of semicircle' kernel giving a relative error below tol.
+
+    One digit per grid point and two points more, calibrated against the direct sum on the Cr and NbFe2 examples,
+    where the error of the intensities relative to the strongest reflection stays an order of magnitude below tol.
+    """
+    width = int(min(max(np.ceil(np.log10(1/tol)) + 2, 2), 16))
+    return width, 2.30*width
+
+def spreading_kernel(u, width, beta):
+    """
+    Kernel exp(beta*(sqrt(1-z^2)-1)), z = 2u/width, at offsets u in grid points, zero for |u| >= width/2.
+    """
+    z = 2*np.asarray(u, dtype=float)/width
+    inside = np.abs(z) < 1
+    return np.where(inside, np.exp(beta*(np.sqrt(np.where(inside, 1-z*z, 0)) - 1)), 0.0)
+
+def kernel_transform(t, size, width, beta):
+    """
+    Fourier transform of the kernel at the modes t of a grid of size points, by Gauss-Legendre quadrature.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(4*width + 32)
+    nodes, weights = nodes[nodes>0], weights[nodes>0]
+    profile = np.exp(beta*(np.sqrt(1 - nodes**2) - 1))
+    # The kernel is even, so its transform is the cosine integral over [0, width/2], twice
+    return width * np.cos(np.pi * np.outer(t, nodes) * width / size) @ (weights * profile)
+
+def tiled_cell(crystalObj):
+    """
+    Splits the moments of a tiled supercell into the unit cell grid.
+
+    Returns
+    -------
+    cellMoments : NUMPY ARRAY (n1,n2,n3,P,3)
+        Moment on position p of the cell at translation (i,j,k).
+    """
+    n = tuple(int(size) for size in crystalObj.n)
+    P = len(crystalObj.cellPositions)
+    positions, moments, _ = diffraction.crystal_arrays(crystalObj)
+    if(len(positions)!=np.prod(n)*P):
+        raise ValueError('The non-uniform FFT needs the supercell of createModulation, {} positions is not {} cells of {}.'.format(len(positions), np.prod(n), P))
+    # Positions are ordered site fastest, then a, b, c
+    translations = np.stack(np.meshgrid(np.arange(n[2]), np.arange(n[1]), np.arange(n[0]), indexing='ij')[::-1], -1) @ crystalObj.lattice
+    expected = translations[:,:,:,None,:] + crystalObj.cellPositions
+    if(not np.allclose(positions.reshape(expected.shape), expected, atol=1e-6)):
+        raise ValueError('The non-uniform FFT needs the supercell of createModulation, the positions are not a tiled unit cell.')
+    return np.ascontiguousarray(moments.reshape(n[2],n[1],n[0],P,3).transpose(2,1,0,3,4))
+
+class latticeTransform:
+    """
+    Oversampled, deconvolved FFT of the moments of a tiled supercell, from which D_p(h) is interpolated.
+
+    Parameters
+    ----------
+    cellMoments : NUMPY ARRAY (n1,n2,n3,C)
+        Values on the grid of cell translations, C components transformed together.
+    tol : FLOAT
+        Requested relative accuracy.
+    dtype : DTYPE, optional
+        Floating point type in which the oversampled transform is kept and interpolated, the FFT itself being computed
+        in double precision.
+    """
+
+    def __init__(self, cellMoments, tol=1e-6, dtype=float):
+        self.n = np.array(cellMoments.shape[:3])
+        self.width, self.beta = kernel_parameters(tol)
+        self.size = np.array([fast_length(max(int(np.ceil(OVERSAMPLING*length)), 2*self.width)) for length in self.n])
+        # Translations are centred, T = centre + t, to keep the modes small
+        self.centre = self.n // 2
+
+        grid = np.zeros(tuple(self.size) + cellMoments.shape[3:], dtype=complex)
+        index = []
+        deconvolved = cellMoments.astype(complex)
+        for axis,(length,size) in enumerate(zip(self.n, self.size)):
+            t = np.arange(length) - self.centre[axis]
+            shape = [1]*deconvolved.ndim
+            shape[axis] = length
+            deconvolved = deconvolved / kernel_transform(t, size, self.width, self.beta).reshape(shape)
+            index.append(t % size)
+        grid[np.ix_(*index)] = deconvolved
+        self.grid = np.fft.fftn(grid, axes=(0,1,2)).astype(diffraction.complex_type(dtype), copy=False)
+
+    def evaluate(self, hkl):
+        """
+        D(h) = sum_T values_T exp(-2pi i h.T) at Miller indices hkl (K,3), returned as (K,C).
+        """
+        hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+        offsets = np.arange(self.width)
+        indices, weights = [], []
+        for axis,size in enumerate(self.size):
+            u = size * hkl[:,axis]
+            first = np.ceil(u - self.width/2).astype(np.int64)
+            points = first[:,None] + offsets
+            weights.append(spreading_kernel(u[:,None] - points, self.width, self.beta).astype(self.grid.real.dtype, copy=False))
+            indices.append(points % size)
+        block = self.grid[indices[0][:,:,None,None], indices[1][:,None,:,None], indices[2][:,None,None,:]]
+        values = np.einsum('ka,kb,kc,kabc...->k...', weights[0], weights[1], weights[2], block)
+        return values * np.exp(-2j*np.pi * (hkl @ self.centre)).astype(self.grid.dtype)[:,None]
+
+def intensities(crystalObj, hkl, tol=1e-6, chunkSize=None, progress=None, dtype=None):
+    """
+    Computes the diffracted intensity of a tiled supercell with the non-uniform FFT.
+
+    Crystals with an analytic modulation are evaluated in closed form by diffraction.intensities, which is already
+    cheaper than any transform.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Crystal with a supercell from createModulation (or an unmodulated unit cell).
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices to be simulated.
+    tol : FLOAT, optional
+        Relative accuracy of the structure factor.
+    chunkSize : INT, optional
+        Number of Miller indices interpolated together.
+    progress : CALLABLE, optional
+        Called as progress(done, total) after each block of Miller indices, see diffraction.intensities.
+    dtype : DTYPE, optional
+        np.float32 keeps the oversampled transform, the interpolation and the result in single precision, halving their
+        memory, the FFT itself being computed in double precision. By default the precision of the crystal arrays.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each Miller index.
+    """
+    hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+    if(crystalObj.modulation is not None):
+        return diffraction.intensities(crystalObj, hkl, chunkSize, progress=progress, dtype=dtype)
+
+    cellMoments = tiled_cell(crystalObj)
+    dtype = np.dtype(crystalObj.positions.dtype if dtype is None else dtype)
+    complexType = diffraction.complex_type(dtype)
+    P = cellMoments.shape[3]
+    with profiling.stage('phase_sum'):
+        transform = latticeTransform(cellMoments.reshape(cellMoments.shape[:3] + (P*3,)), tol, dtype)
+
+    reciprocal = crystalObj.reciprocal
+    qVecs = hkl @ reciprocal
+    MTotal = np.empty((len(hkl),3), dtype=complexType)
+    # Interpolation gathers w^3 grid points of every component per Miller index
+    step = chunkSize or max(1, diffraction.CHUNK_BYTES // (np.dtype(complexType).itemsize * transform.width**3 * P*3))
+    for start in range(0, len(hkl), step):
+        stop = min(start+step, len(hkl))
+        q = qVecs[start:stop]
+        formFactors = diffraction.normalised_form_factors(crystalObj.sites, np.linalg.norm(q, axis=1)/(4*np.pi))[:,crystalObj.cellSiteIds]
+        with profiling.stage('phase_sum'):
+            lattice = transform.evaluate(hkl[start:stop]).reshape(-1,P,3)
+            basis = (formFactors * np.exp(-1j * (q @ crystalObj.cellPositions.T))).astype(complexType, copy=False)
+            MTotal[start:stop] = np.einsum('kp,kpa->ka', basis, lattice)
+        if(progress is not None):
+            progress(stop, len(hkl))
+    return diffraction.perpendicular_intensity(qVecs.astype(dtype, copy=False), MTotal)
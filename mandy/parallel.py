@@ -0,0 +1,134 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from . import diffraction
+
+"""
+Sub-routine to distribute the diffraction calculation over a pool of worker processes.
+"""
+
+# Number of tasks handed to each worker, more tasks give better load balancing at the cost of scheduling overhead
+TASKS_PER_WORKER = 4
+
+# Arrays attached from shared memory and the small crystal metadata, set in each worker by _attach
+_shared = {}
+
+def worker_count(workers):
+    """
+    Resolves the requested number of workers, -1 (or 0) meaning every available core.
+    """
+    if(workers is None or workers < 1):
+        return os.cpu_count() or 1
+    return int(workers)
+
+def share_array(array):
+    """
+    Copies an array into a new shared memory block.
+
+    Parameters
+    ----------
+    array : NUMPY ARRAY
+        Array to be shared with the workers.
+
+    Returns
+    -------
+    shm : SharedMemory
+        The shared memory block, to be closed and unlinked by the caller.
+    spec : TUPLE
+        (name, shape, dtype) from which a worker can attach to the array.
+
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes,1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _attach(specs, metadata):
+    """
+    Worker initializer, attaches to the shared arrays once per process rather than once per task.
+    """
+    for key,(name,shape,dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _shared['metadata'] = metadata
+
+def _run(start, stop):
+    """
+    Computes the intensities of hkl[start:stop] into the shared output array.
+    """
+    arrays = {key:val[1] for key,val in _shared.items() if key != 'metadata'}
+    meta = _shared['metadata']
+    arrays['intensity'][start:stop] = diffraction.intensity_block(arrays['hkl'][start:stop], meta['reciprocal'],
+                                                                  arrays['positions'], arrays['moments'], arrays['siteIds'],
+                                                                  meta['sites'], meta['modulation'], meta['n'], meta['chunkSize'], meta['dtype'], meta['backend'])
+    return start, stop
+
+def task_bounds(count, workers, chunkSize=None):
+    """
+    Splits count scattering vectors into contiguous [start, stop) ranges, in order.
+    """
+    size = max(1, -(-count // (workers*TASKS_PER_WORKER)))
+    if(chunkSize is not None):
+        # No point in splitting below the kernel's own block length
+        size = max(size, int(chunkSize))
+    return [(start, min(start+size, count)) for start in range(0, count, size)]
+
+def intensities(crystalObj, hkl, workers=-1, chunkSize=None, dtype=None, progress=None, backend=None):
+    """
+    Computes the diffracted intensity for a list of Miller indices using a pool of worker processes.
+
+    The crystal arrays and the Miller indices are placed in shared memory once, each worker attaches to them on
+    start-up and writes its block of results into a shared output array, so nothing but block bounds are sent per task
+    and the result is in the same order as hkl whichever worker finishes first.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices to be simulated.
+    workers : INT, optional
+        Number of worker processes, -1 uses every core.
+    chunkSize : INT, optional
+        Number of scattering vectors per block within a worker, by default chosen from diffraction.CHUNK_BYTES.
+    dtype : DTYPE, optional
+        Floating point type of the calculation, see diffraction.intensities.
+    progress : CALLABLE, optional
+        Called as progress(done, total) each time a worker completes a block, see diffraction.intensities.
+    backend : STRING, optional
+        Structure-factor kernel used by the workers, see diffraction.intensities.
+
+    Returns
+    -------
+    NUMPY ARRAY (M,)
+        Intensity for each Miller index.
+
+    """
+    hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+    workers = worker_count(workers)
+    positions, moments, siteIds = diffraction.crystal_arrays(crystalObj)
+
+    blocks = {}
+    try:
+        for key,array in (('positions',positions), ('moments',moments), ('siteIds',siteIds), ('hkl',hkl), ('intensity',np.zeros(len(hkl)))):
+            blocks[key] = share_array(array)
+        specs = {key:spec for key,(shm,spec) in blocks.items()}
+        metadata = {'reciprocal':crystalObj.reciprocal, 'sites':crystalObj.sites, 'modulation':crystalObj.modulation,
+                    'n':crystalObj.n, 'chunkSize':chunkSize, 'dtype':dtype, 'backend':backend}
+
+        bounds = task_bounds(len(hkl), workers, chunkSize)
+        with ProcessPoolExecutor(max_workers=min(workers, max(len(bounds),1)), initializer=_attach, initargs=(specs, metadata)) as pool:
+            done = 0
+            for future in as_completed([pool.submit(_run, start, stop) for start,stop in bounds]):
+                start, stop = future.result()
+                done += stop - start
+                if(progress is not None):
+                    progress(done, len(hkl))
+
+        name,shape,dtype = specs['intensity']
+        return np.ndarray(shape, dtype=dtype, buffer=blocks['intensity'][0].buf).copy()
+    finally:
+        for shm,_ in blocks.values():
+            shm.close()
+            shm.unlink()
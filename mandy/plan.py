@@ -0,0 +1,174 @@
+import numpy as np
+from . import diffraction
+from . import profiling
+
+"""
+Sub-routine to precompute the moment-independent parts of the diffraction calculation for a fixed geometry and Q set.
+"""
+
+# Upper bound (in bytes) on the per-position phase matrices a plan keeps, above which they are recomputed in chunks
+PLAN_BYTES = 2**30
+
+class scatteringPlan:
+    """
+    Caches everything in the structure factor that does not depend on the moments, for a crystal and a list of
+    Miller indices, such that intensities for new moments cost one small matrix product.
+
+    The structure factor is written as a sum over harmonics h of phase sums times moment amplitudes,
+        F(Q) = sum_h sum_j P_h(Q,j) a_h(j)
+    where P_h includes the phase exp(-iQ_h.r_j), the normalised form factor and (for an analytic modulation) the
+    lattice sum. Without a modulation there is a single harmonic with Q_h = Q and a(j) = m_j. With an analytic
+    modulation the harmonics are the Q+q and Q-q satellites with a_+ = c/2 and a_- = c*/2, c = m*(m1*u + i*m2*v).
+
+    Summing P_h over the positions of each site gives the per-site reduction S_h(Q,s), which is always kept and is
+    all that is needed when every position of a site carries the site moment. The full per-position matrices are kept
+    only while they fit in maxBytes, otherwise they are recomputed in chunks on each call.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices to be simulated.
+    maxBytes : INT, optional
+        Memory allowed for the per-position phase matrices, by default PLAN_BYTES. 0 never keeps them.
+    chunkSize : INT, optional
+        Number of scattering vectors per block while building or recomputing, by default chosen from diffraction.CHUNK_BYTES.
+    """
+
+    def __init__(self, crystalObj, hkl, maxBytes=None, chunkSize=None):
+        self.hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+        self.reciprocal = crystalObj.reciprocal
+        self.qVecs = self.hkl @ self.reciprocal
+        self.chunkSize = chunkSize
+
+        # Projection perpendicular to Q, (000) is given zero intensity
+        qSquared = np.einsum('ij,ij->i', self.qVecs, self.qVecs)
+        self.nonZero = qSquared > 0
+        self.qHat = np.zeros_like(self.qVecs)
+        self.qHat[self.nonZero] = self.qVecs[self.nonZero] / np.sqrt(qSquared[self.nonZero])[:,None]
+
+        # Normalised form factor of each site, evaluated at Q itself
+        qMag = np.sqrt(qSquared) / (4 * np.pi)
+        self.formFactors = diffraction.normalised_form_factors(crystalObj.sites, qMag)
+
+        self.positions, _, self.siteIds = diffraction.crystal_arrays(crystalObj)
+        self.nSites = len(crystalObj.sites)
+        self.modulation = crystalObj.modulation
+        self.n = np.asarray(crystalObj.n)
+
+        # Default moments: the site moments when the modulation is analytic, the moment on each position otherwise
+        self.defaultMoments = crystalObj.siteMoments if self.modulation is not None else crystalObj.moments
+
+        # Scattering vector and lattice sum of each harmonic
+        if(self.modulation is None):
+            self.harmonics = [(self.qVecs, None)]
+        else:
+            qMod = self.modulation.q @ self.reciprocal
+            self.harmonics = [(self.qVecs + sign*qMod, diffraction.lattice_sum(self.hkl + sign*self.modulation.q, self.n)) for sign in (1,-1)]
+
+        maxBytes = PLAN_BYTES if maxBytes is None else maxBytes
+        keepPhases = len(self.harmonics) * len(self.qVecs) * len(self.positions) * 16 <= maxBytes
+
+        # One-hot (N,S) matrix reducing positions onto their sites
+        siteMatrix = np.zeros((len(self.positions), self.nSites))
+        siteMatrix[np.arange(len(self.positions)), self.siteIds] = 1
+
+        self.siteSums = []
+        self.phases = [] if keepPhases else None
+        step = diffraction.chunk_length(len(self.positions), chunkSize)
+        for qShift, latticeSum in self.harmonics:
+            siteSum = np.empty((len(qShift), self.nSites), dtype=complex)
+            phase = np.empty((len(qShift), len(self.positions)), dtype=complex) if keepPhases else None
+            for start in range(0, len(qShift), step):
+                stop = min(start+step, len(qShift))
+                block = self.phase_block(qShift, latticeSum, start, stop)
+                siteSum[start:stop] = block @ siteMatrix
+                if(keepPhases):
+                    phase[start:stop] = block
+            self.siteSums.append(siteSum)
+            if(keepPhases):
+                self.phases.append(phase)
+
+    def phase_block(self, qShift, latticeSum, start, stop):
+        """
+        P_h for scattering vectors start:stop of one harmonic, shape (stop-start, N).
+        """
+        with profiling.stage('phase_sum'):
+            block = np.exp(-1j * (qShift[start:stop] @ self.positions.T))
+            block *= self.formFactors[start:stop][:,self.siteIds]
+            if(latticeSum is not None):
+                block *= latticeSum[start:stop,None]
+            return block
+
+    def amplitudes(self, moments):
+        """
+        Moment amplitude a_h of each harmonic for site or position moments, see the class description.
+        """
+        moments = np.asarray(moments)
+        if(self.modulation is None):
+            return [moments]
+        mod = self.modulation
+        if(mod.rotate):
+            moments = np.linalg.norm(moments, axis=1)[:,None]
+        amplitude = moments * (mod.m1*mod.u + 1j*mod.m2*mod.v)
+        return [0.5*amplitude, 0.5*np.conj(amplitude)]
+
+    def structure_factor(self, moments=None, perSite=None):
+        """
+        Evaluates the structure factor for new moments.
+
+        Parameters
+        ----------
+        moments : ARRAY-LIKE (S,3) or (N,3), optional
+            One moment per site (applied to every position of that site, before any analytic modulation), or one
+            moment per position of the crystal. By default the moments the crystal held when the plan was built.
+        perSite : BOOL, optional
+            Whether moments are given per site, by default inferred from their length (per site if it matches both).
+
+        Returns
+        -------
+        MTotal : NUMPY ARRAY (M,3)
+            Complex structure factor for each scattering vector.
+        """
+        if(moments is None):
+            moments, perSite = self.defaultMoments, self.modulation is not None
+        moments = np.asarray(moments)
+        if(perSite is None):
+            perSite = len(moments)==self.nSites
+        if(len(moments)!=(self.nSites if perSite else len(self.positions))):
+            raise ValueError('Expected {} site moments or {} position moments, got {}.'.format(self.nSites, len(self.positions), len(moments)))
+
+        MTotal = np.zeros((len(self.qVecs),3), dtype=complex)
+        for h,((qShift,latticeSum),amplitude) in enumerate(zip(self.harmonics, self.amplitudes(moments))):
+            if(perSite):
+                MTotal += self.siteSums[h] @ amplitude
+            elif(self.phases is not None):
+                MTotal += self.phases[h] @ amplitude
+            else:
+                step = diffraction.chunk_length(len(self.positions), self.chunkSize)
+                for start in range(0, len(qShift), step):
+                    stop = min(start+step, len(qShift))
+                    MTotal[start:stop] += self.phase_block(qShift, latticeSum, start, stop) @ amplitude
+        return MTotal
+
+    def project(self, MTotal):
+        """
+        Component of the structure factor perpendicular to Q, M - q^(q^.M).
+        """
+        with profiling.stage('projection'):
+            return MTotal - self.qHat * np.einsum('ij,ij->i', self.qHat, MTotal)[:,None]
+
+    def intensities(self, moments=None, perSite=None):
+        """
+        Evaluates the diffracted intensity |M_perp|^2 for new moments, see structure_factor.
+
+        Returns
+        -------
+        NUMPY ARRAY (M,)
+            Intensity for each Miller index.
+        """
+        MTotalOrth = self.project(self.structure_factor(moments, perSite))
+        intensity = np.einsum('ij,ij->i', np.conj(MTotalOrth), MTotalOrth).real
+        intensity[~self.nonZero] = 0.0
+        return intensity
@@ -0,0 +1,99 @@
+import time
+import contextlib
+from dataclasses import dataclass, field
+
+"""
+Sub-routine to record the wall time and number of calls of each stage of a calculation.
+
+The stages are 'cif_parse' (reading the unit cell in mandyCrystal.build), 'supercell' (tiling and modulating the unit
+cell), 'form_factor', 'phase_sum' (the structure factor sum, or its non-uniform FFT) and 'projection' (perpendicular
+to Q). They are only timed inside a profile() block, otherwise stage() does nothing:
+
+    with md.profiling.profile() as report:
+        md.diffraction.magnetic_calc(crystal, Q)
+    print(report)
+
+Stages run in the worker processes of the parallel module are not recorded, only the wall time of the whole block.
+"""
+
+STAGES = ('cif_parse', 'supercell', 'form_factor', 'phase_sum', 'projection')
+
+# Reports of the profile() blocks currently open, every stage is recorded in each of them
+_active = []
+
+@dataclass
+class stageTiming:
+    """
+    Accumulated wall time (s) and number of calls of one stage.
+    """
+    seconds: float = 0.0
+    calls: int = 0
+
+@dataclass
+class profileReport:
+    """
+    Timings of every stage run inside a profile() block, and the wall time of the whole block.
+    """
+    stages: dict = field(default_factory=dict)
+    wall: float = 0.0
+
+    def add(self, name, seconds):
+        timing = self.stages.setdefault(name, stageTiming())
+        timing.seconds += seconds
+        timing.calls += 1
+
+    @property
+    def total(self):
+        """
+        Wall time spent in the recorded stages.
+        """
+        return sum(timing.seconds for timing in self.stages.values())
+
+    def as_dict(self):
+        """
+        {stage: {'seconds':..., 'calls':...}} with 'wall' the time of the whole block, e.g. for saving as JSON.
+        """
+        report = {name:{'seconds':timing.seconds, 'calls':timing.calls} for name,timing in self.stages.items()}
+        report['wall'] = self.wall
+        return report
+
+    def __str__(self):
+        # Known stages in order of the calculation, then any others
+        names = [name for name in STAGES if name in self.stages] + [name for name in self.stages if name not in STAGES]
+        lines = ['{:<12s} {:>8s} {:>12s} {:>7s}'.format('stage', 'calls', 'seconds', 'share')]
+        for name in names:
+            timing = self.stages[name]
+            share = timing.seconds / self.wall if self.wall > 0 else 0.0
+            lines.append('{:<12s} {:>8d} {:>12.4f} {:>6.1f}%'.format(name, timing.calls, timing.seconds, 100*share))
+        lines.append('{:<12s} {:>8s} {:>12.4f}'.format('wall', '', self.wall))
+        return '\n'.join(lines)
+
+@contextlib.contextmanager
+def profile():
+    """
+    Records the stages run inside the block into the profileReport it yields.
+    """
+    report = profileReport()
+    _active.append(report)
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.wall = time.perf_counter() - start
+        _active.remove(report)
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times the block as one call of the named stage in every open profile() block.
+    """
+    if(not _active):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for report in _active:
+            report.add(name, seconds)
@@ -0,0 +1,238 @@
+import numpy as np
+from dataclasses import dataclass
+from . import plan as _plan
+
+"""
+Sub-routine to refine site moments, modulation amplitudes and a scale factor against observed intensities.
+
+The structure factor is linear in the site moments (and, for an analytic modulation, in m1 and m2), so the
+intensities and their exact derivatives follow from the per-site phase sums of a scatteringPlan, which are computed
+once. The fit is a damped Gauss-Newton (Levenberg-Marquardt) iteration on the weighted residuals.
+"""
+
+AXES = ('x','y','z')
+
+@dataclass
+class refinementResult:
+    """
+    Outcome of a refinement, the fitted values of every parameter (free or fixed) and the statistics of the fit.
+    """
+    moments: np.ndarray
+    m1: float
+    m2: float
+    scale: float
+    names: list
+    values: np.ndarray
+    errors: np.ndarray
+    covariance: np.ndarray
+    chi2: float
+    reducedChi2: float
+    calculated: np.ndarray
+    iterations: int
+    converged: bool
+
+class intensityModel:
+    """
+    Intensities and their Jacobian as a function of the site moments, m1, m2 and a scale factor.
+
+    Writing the structure factor as F(Q) = sum_s mu_s * K_s(Q), with mu_s the moment of site s (|m_s| on every
+    component when the modulation rotates the moments), the per-site factor is K_s = S_s for an unmodulated crystal
+    and K_s = m1*u*(S+_s + S-_s)/2 + i*m2*v*(S+_s - S-_s)/2 for an analytic modulation, S being the per-site phase
+    sums of the plan. The intensity is I = scale*|M_perp|^2 and every derivative is 2*scale*Re[M_perp* . dF].
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Built crystal, unmodulated or with an analytic modulation (createModulation(..., mode='analytic')).
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices of the observations.
+    plan : scatteringPlan, optional
+        Precomputed plan for crystalObj and hkl, built if not given.
+    chunkSize : INT, optional
+        Number of scattering vectors per block while building the plan.
+    """
+
+    def __init__(self, crystalObj, hkl, plan=None, chunkSize=None):
+        if(crystalObj.modulation is None and not np.allclose(crystalObj.moments, crystalObj.siteMoments[crystalObj.siteIds])):
+            raise ValueError('The moments of a supercell modulation cannot be refined per site, use createModulation(..., mode=\'analytic\').')
+
+        # Only the per-site sums are used, so the plan need not keep the per-position phases
+        self.plan = _plan.scatteringPlan(crystalObj, hkl, maxBytes=0, chunkSize=chunkSize) if plan is None else plan
+        self.modulation = crystalObj.modulation
+        self.nSites = len(crystalObj.sites)
+        self.labels = [site.label for site in crystalObj.sites]
+        self.names = ['{}:{}'.format(label, axis) for label in self.labels for axis in AXES] + ['m1','m2','scale']
+
+        # (S_t, w_t) pairs such that K = sum_t coeff_t * S_t * w_t, with coefficients (1,) or (m1,m2)
+        if(self.modulation is None):
+            self.basis = [(self.plan.siteSums[0], np.ones(3))]
+        else:
+            plus, minus = self.plan.siteSums
+            self.basis = [(0.5*(plus + minus), self.modulation.u), (0.5j*(plus - minus), self.modulation.v)]
+
+    def initial_parameters(self, crystalObj, scale=1.0):
+        """
+        Parameter vector (3S site moments, m1, m2, scale) of the crystal as built.
+        """
+        m1, m2 = (1.0, 1.0) if self.modulation is None else (self.modulation.m1, self.modulation.m2)
+        return np.concatenate([np.ravel(crystalObj.siteMoments), [m1, m2, scale]]).astype(float)
+
+    def unpack(self, parameters):
+        """
+        Splits a parameter vector into (moments (S,3), m1, m2, scale).
+        """
+        parameters = np.asarray(parameters, dtype=float)
+        return parameters[:3*self.nSites].reshape(self.nSites,3), parameters[-3], parameters[-2], parameters[-1]
+
+    def evaluate(self, parameters, jacobian=False):
+        """
+        Parameters
+        ----------
+        parameters : ARRAY-LIKE (3S+3,)
+            Site moments (site by site, x,y,z), m1, m2 and scale.
+        jacobian : BOOL, optional
+            Whether to also return the derivatives of the intensities.
+
+        Returns
+        -------
+        intensity : NUMPY ARRAY (M,)
+            Scaled intensity for each Miller index.
+        jac : NUMPY ARRAY (M,3S+3)
+            Derivative of each intensity with respect to each parameter, only if jacobian is True.
+        """
+        moments, m1, m2, scale = self.unpack(parameters)
+        rotate = self.modulation is not None and self.modulation.rotate
+        norms = np.linalg.norm(moments, axis=1)
+        mu = np.repeat(norms[:,None], 3, axis=1) if rotate else moments
+
+        coeffs = (1.0,) if self.modulation is None else (m1, m2)
+        K = sum(coeff * siteSum[:,:,None] * w for coeff,(siteSum,w) in zip(coeffs, self.basis))
+        MTotalOrth = self.plan.project(np.einsum('qsa,sa->qa', K, mu))
+        MConj = np.conj(MTotalOrth)
+        square = np.einsum('ij,ij->i', MConj, MTotalOrth).real
+        square[~self.plan.nonZero] = 0.0
+        if(not jacobian):
+            return scale * square
+
+        jac = np.zeros((len(square), len(self.names)))
+        if(rotate):
+            # d|m_s|/dm_s = m_s/|m_s|, taken as zero for a vanishing moment
+            unit = np.divide(moments, norms[:,None], out=np.zeros_like(moments), where=norms[:,None]>0)
+            jac[:,:3*self.nSites] = (2*scale*np.einsum('qa,qsa->qs', MConj, K).real[:,:,None] * unit).reshape(len(square),-1)
+        else:
+            jac[:,:3*self.nSites] = (2*scale*(MConj[:,None,:] * K).real).reshape(len(square),-1)
+        if(self.modulation is not None):
+            for t,(siteSum,w) in enumerate(self.basis):
+                jac[:,3*self.nSites+t] = 2*scale*np.einsum('qa,qa->q', MConj, (siteSum @ mu) * w).real
+        jac[:,-1] = square
+        jac[~self.plan.nonZero] = 0.0
+        return scale * square, jac
+
+def free_mask(model, moments=True, m1=False, m2=False, scale=True):
+    """
+    Boolean mask over the parameter vector of model selecting the refined parameters.
+
+    moments may be a single BOOL or an ARRAY-LIKE (S,3) of BOOL choosing individual moment components.
+    m1 and m2 are fixed for an unmodulated crystal, on which they have no effect.
+    """
+    momentMask = np.broadcast_to(np.asarray(moments, dtype=bool), (model.nSites,3))
+    hasModulation = model.modulation is not None
+    return np.concatenate([momentMask.ravel(), [bool(m1) and hasModulation, bool(m2) and hasModulation, bool(scale)]])
+
+def refine(crystalObj, hkl, observed, sigma=None, moments=True, m1=False, m2=False, scale=True, initialScale=None,
+           maxIter=100, tol=1e-10, plan=None, chunkSize=None):
+    """
+    Fits the site moments, modulation amplitudes and a scale factor to observed intensities by least squares.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Built crystal, unmodulated or with an analytic modulation, whose site moments, m1 and m2 are the starting point.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices of the observations.
+    observed : ARRAY-LIKE (M,)
+        Observed intensities.
+    sigma : ARRAY-LIKE (M,), optional
+        Uncertainty of each observation, by default 1 (unweighted).
+    moments : BOOL or ARRAY-LIKE (S,3) of BOOL, optional
+        Which site moment components are refined, by default all of them.
+    m1, m2, scale : BOOL, optional
+        Whether the modulation amplitudes and the scale factor are refined.
+    initialScale : FLOAT, optional
+        Starting (or, if scale is not refined, fixed) scale factor, by default 1 for a fixed scale and the least-squares
+        scale of the starting intensities otherwise.
+    maxIter : INT, optional
+        Maximum number of iterations.
+    tol : FLOAT, optional
+        Convergence threshold on the relative decrease of chi^2.
+    plan : scatteringPlan, optional
+        Precomputed plan for crystalObj and hkl.
+    chunkSize : INT, optional
+        Number of scattering vectors per block while building the plan.
+
+    Returns
+    -------
+    refinementResult
+        Fitted parameters, standard errors and covariance of the refined parameters, and fit statistics.
+    """
+    model = intensityModel(crystalObj, hkl, plan, chunkSize)
+    observed = np.asarray(observed, dtype=float).ravel()
+    sigma = np.ones_like(observed) if sigma is None else np.broadcast_to(np.asarray(sigma, dtype=float), observed.shape)
+    if(len(observed)!=len(model.plan.hkl)):
+        raise ValueError('Expected {} observations, got {}.'.format(len(model.plan.hkl), len(observed)))
+
+    parameters = model.initial_parameters(crystalObj)
+    if(initialScale is None and not scale):
+        initialScale = 1.0
+    elif(initialScale is None):
+        start = model.evaluate(parameters) / sigma**2
+        denominator = np.dot(start, model.evaluate(parameters))
+        initialScale = np.dot(start, observed) / denominator if denominator > 0 else 1.0
+    parameters[-1] = initialScale
+
+    free = free_mask(model, moments, m1, m2, scale)
+    if(not free.any()):
+        raise ValueError('No parameters to refine.')
+
+    def residuals(parameters):
+        intensity, jac = model.evaluate(parameters, jacobian=True)
+        return (intensity - observed) / sigma, jac[:,free] / sigma[:,None]
+
+    r, J = residuals(parameters)
+    chi2 = np.dot(r, r)
+    damping = 1e-3
+    converged = False
+    for iteration in range(1, maxIter+1):
+        A = J.T @ J
+        g = J.T @ r
+        improved = False
+        while(damping < 1e12):
+            # Marquardt scaling of the damping, with a floor for parameters that do not affect the fit
+            step = np.linalg.lstsq(A + damping*np.diag(np.diag(A) + 1e-12*np.trace(A)), -g, rcond=None)[0]
+            trial = parameters.copy()
+            trial[free] += step
+            rTrial, JTrial = residuals(trial)
+            chi2Trial = np.dot(rTrial, rTrial)
+            if(chi2Trial <= chi2):
+                improved = True
+                break
+            damping *= 10
+        if(not improved):
+            converged = True
+            break
+        decrease = chi2 - chi2Trial
+        parameters, r, J, chi2 = trial, rTrial, JTrial, chi2Trial
+        damping = max(damping/10, 1e-12)
+        if(decrease <= tol*max(chi2, np.finfo(float).tiny) or chi2 == 0):
+            converged = True
+            break
+
+    dof = max(len(observed) - int(free.sum()), 1)
+    reducedChi2 = chi2 / dof
+    covariance = np.linalg.pinv(J.T @ J) * reducedChi2
+    moments, m1Fit, m2Fit, scaleFit = model.unpack(parameters)
+    return refinementResult(moments=moments.copy(), m1=float(m1Fit), m2=float(m2Fit), scale=float(scaleFit),
+                            names=[name for name,isFree in zip(model.names, free) if isFree], values=parameters[free],
+                            errors=np.sqrt(np.clip(np.diag(covariance), 0, None)), covariance=covariance,
+                            chi2=float(chi2), reducedChi2=float(reducedChi2), calculated=model.evaluate(parameters),
+                            iterations=iteration, converged=converged)
@@ -1,49 +1,175 @@
-import requests
+import os
+import pathlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 term_letters = 'SPDFGHIKLMNOQRTUVWXYZ'
 
-def find_L_S(name):
+# Formatted URL of the NIST ASD ionisation energy query, {} is replaced by the ion name
+NIST_URL = 'https://physics.nist.gov/cgi-bin/ASD/ie.pl?spectra={}%2B&submit=Retrieve+Data&units=1&format=3&order=0&ion_charge_out=on&el_name_out=on&level_out=on&e_out=0'
+
+# Term symbols shipped with the package, and the user's cache which grows as new ions are retrieved
+BUNDLED_CACHE = pathlib.Path(__file__).parent.joinpath("TermSymbols.dat")
+USER_CACHE = pathlib.Path(os.environ.get('MANDY_TERM_CACHE', pathlib.Path.home().joinpath('.mandy','TermSymbols.dat')))
+
+# When True, ions missing from the caches raise a LookupError instead of querying NIST
+OFFLINE = os.environ.get('MANDY_OFFLINE','0').lower() not in ('','0','false','no')
+
+# Request timeout in seconds
+TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+_cache = None
+_cacheLock = threading.Lock()
+
+def read_cache(path):
+    """
+    Reads a term symbol cache file of '<ion> <term>' lines, '#' starting a comment.
+    """
+    terms = {}
+    try:
+        with open(path,'r') as file:
+            for line in file:
+                fields = line.split('#')[0].split()
+                if(len(fields)==2):
+                    terms[fields[0]] = fields[1]
+    except FileNotFoundError:
+        pass
+    return terms
+
+def cached_terms():
+    """
+    Returns the term symbols known without a network request, the user's cache taking precedence over the bundled one.
+    """
+    global _cache
+    if(_cache is None):
+        _cache = read_cache(BUNDLED_CACHE)
+        _cache.update(read_cache(USER_CACHE))
+    return _cache
+
+def store_term(name, termSymbol):
+    """
+    Adds a retrieved term symbol to the in-memory and user caches.
+    """
+    with _cacheLock:
+        cached_terms()[name] = termSymbol
+        try:
+            USER_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            with open(USER_CACHE,'a') as file:
+                file.write('{} {}\n'.format(name, termSymbol))
+        except OSError as e:
+            logger.warning('Could not write term symbol cache %s : %s', USER_CACHE, e)
+
+def parse_response(name, text):
+    """
+    Extracts the ground-state term symbol, e.g. '5D', from the text returned by the NIST ASD.
+    """
+    if('Unrecognized token.' in text):
+        raise NameError('Unrecognised Token "{}".'.format(name))
+
+    x = text.splitlines()[1].split('\t') # Remove formatting
+    x = [elem.replace('"','') for elem in x] # Remove quotation marks
+    x = list(filter(None,x))[:-1] # Remove empty elements and ionisation energy collumn
+    logger.info('Retrieving term symbol: %s', x) # Log finding : |Ion Charge|Element|Ground-state level|
+
+    x = x[-1] # Leave only the term symbol
+    return x[:x.find('<')] # Strip out the J component
+
+def fetch_term(name):
+    """
+    Queries the NIST ASD for the ground-state term symbol of an ion, raising on network errors or unknown ions.
+    """
+    # requests is only needed, and imported, when an ion is missing from the caches
+    import requests
+    response = requests.get(NIST_URL.format(name), timeout=TIMEOUT) # Send request to NIST database
+    return parse_response(name, response.text)
+
+def term_symbol(name, offline=None):
     """
     Parameters
     ----------
     name : STRING
         Name of the Ion, e.g. 'Fe2' or 'Nb0'.
+    offline : BOOL, optional
+        Raise a LookupError for ions missing from the caches rather than querying NIST, by default OFFLINE.
 
     Returns
     -------
-    L : INT
-        Total angular momentum quantum number.
-    S : FLOAT
-        Total spin quantum number.
+    termSymbol : STRING
+        Ground-state term symbol without the J component, e.g. '5D'.
     """
+    offline = OFFLINE if offline is None else offline
+    terms = cached_terms()
+    if(name in terms):
+        return terms[name]
+    if(offline):
+        raise LookupError('No cached term symbol for "{}" and offline mode is enabled, add it to {}.'.format(name, USER_CACHE))
+    import requests
 
-    url = 'https://physics.nist.gov/cgi-bin/ASD/ie.pl?spectra={}%2B&submit=Retrieve+Data&units=1&format=3&order=0&ion_charge_out=on&el_name_out=on&level_out=on&e_out=0'.format(name) # Formatted URL
-    
     try:
-        x = requests.get(url) # Send request to NIST database
-        if('Unrecognized token.' in x.text):
-            raise NameError('Unrecognised Token "{}".'.format(name))
-            
-        x = x.text.splitlines()[1].split('\t') # Remove formatting
-        x = [elem.replace('"','') for elem in x] # Remove quotation marks
-        x = list(filter(None,x))[:-1] # Remove empty elements and ionisation energy collumn
-        print('Retrieving term symbol: ' + str(x)) # Print finding : |Ion Charge|Element|Ground-state level|
-        
-        x = x[-1] # Leave only the term symbol
-        termSymbol = x[:x.find('<')] # Strip out the J component
-        
+        termSymbol = fetch_term(name)
+        store_term(name, termSymbol)
+
     except requests.exceptions.RequestException as e:
-        print('Could not reach NIST database :\n',e)
+        logger.warning('Could not reach NIST database : %s. Using L,S = 1', e)
         termSymbol = '3P'
-        print('Using L,S = 1')
-        
+
     except NameError as e:
-        print(e)
+        logger.warning('%s Using L,S = 1', e)
         termSymbol = '3P'
-        print('Using L,S = 1')
 
+    return termSymbol
 
-    # Interpreting the term symbol
+def term_to_L_S(termSymbol):
+    """
+    Interprets a term symbol, e.g. '5D', as the quantum numbers (L,S).
+    """
     S = (float(termSymbol[0]) - 1) / 2
     L = term_letters.index(termSymbol[1])
-    return (L,S)
\ No newline at end of file
+    return (L,S)
+
+def find_L_S(name, offline=None):
+    """
+    Parameters
+    ----------
+    name : STRING
+        Name of the Ion, e.g. 'Fe2' or 'Nb0'.
+    offline : BOOL, optional
+        Raise a LookupError for ions missing from the caches rather than querying NIST, by default OFFLINE.
+
+    Returns
+    -------
+    L : INT
+        Total angular momentum quantum number.
+    S : FLOAT
+        Total spin quantum number.
+    """
+    return term_to_L_S(term_symbol(name, offline))
+
+def find_L_S_batch(names, offline=None, workers=8):
+    """
+    Resolves the quantum numbers of many ions, querying NIST concurrently for those missing from the caches.
+
+    Parameters
+    ----------
+    names : LIST
+        Names of the Ions, e.g. ['Fe2','Nb0'].
+    offline : BOOL, optional
+        Raise a LookupError for ions missing from the caches rather than querying NIST, by default OFFLINE.
+    workers : INT, optional
+        Maximum number of simultaneous requests.
+
+    Returns
+    -------
+    DICT
+        Mapping of each name to (L,S).
+    """
+    unique = list(dict.fromkeys(names))
+    terms = {name:cached_terms()[name] for name in unique if name in cached_terms()}
+    missing = [name for name in unique if name not in terms]
+    if(missing):
+        with ThreadPoolExecutor(max_workers=max(1,min(workers,len(missing)))) as pool:
+            terms.update(zip(missing, pool.map(lambda name: term_symbol(name, offline), missing)))
+    return {name:term_to_L_S(terms[name]) for name in unique}
@@ -0,0 +1,179 @@
+import numpy as np
+from . import diffraction
+
+"""
+Sub-routine to convolve simulated maps with an instrument resolution function by FFT.
+
+Kernels are sampled on the grid of the map, either a Gaussian resolution ellipsoid or any user-supplied array. A
+kernel which varies with Q is applied block by block, each block being convolved with the kernel at its centre and
+the results overlap-added, which also allows maps held in memory-mapped files (e.g. from scanstore) to be convolved
+one block at a time into another memory-mapped file.
+"""
+
+# Default number of map points per block for blockwise convolution
+BLOCK_POINTS = 2**18
+
+def fast_length(n):
+    """
+    Smallest length >= n whose only prime factors are 2, 3 and 5, for which FFTs are fast.
+    """
+    best = 2**int(np.ceil(np.log2(max(n,1))))
+    p5 = 1
+    while(p5 < best):
+        p35 = p5
+        while(p35 < best):
+            size = p35
+            while(size < n):
+                size *= 2
+            best = min(best, size)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def fft_convolve(data, kernel):
+    """
+    Full linear convolution of two arrays with the same number of dimensions, of shape data.shape + kernel.shape - 1.
+    """
+    shape = tuple(a+b-1 for a,b in zip(data.shape, kernel.shape))
+    fftShape = tuple(fast_length(size) for size in shape)
+    axes = tuple(range(data.ndim))
+    product = np.fft.rfftn(data, fftShape, axes) * np.fft.rfftn(kernel, fftShape, axes)
+    return np.fft.irfftn(product, fftShape, axes)[tuple(slice(0,size) for size in shape)]
+
+def map_covariance(covariance, vectors, reciprocal):
+    """
+    Converts a resolution ellipsoid given as a Cartesian covariance of Q (3,3, inverse Angstroms squared) into the
+    covariance (d,d) of the map coordinates, the section of the ellipsoid through the plane (or line) of the map.
+
+    Parameters
+    ----------
+    covariance : ARRAY-LIKE (3,3)
+        Covariance of Q in Cartesian coordinates.
+    vectors : ARRAY-LIKE (d,3)
+        hkl direction of each map axis.
+    reciprocal : NUMPY ARRAY (3,3)
+        Reciprocal lattice vectors as rows, mandyCrystal.reciprocal.
+    """
+    axes = np.asarray(vectors, dtype=float).reshape(-1,3) @ reciprocal
+    return np.linalg.inv(axes @ np.linalg.inv(covariance) @ axes.T)
+
+def gaussian_kernel(covariance, steps, nSigma=3.0):
+    """
+    Normalised Gaussian kernel sampled on the map grid.
+
+    Parameters
+    ----------
+    covariance : ARRAY-LIKE (d,d)
+        Covariance in map coordinates (the units of the map axes), see map_covariance.
+    steps : ARRAY-LIKE (d,)
+        Grid step along each map axis.
+    nSigma : FLOAT, optional
+        Half-width of the kernel in standard deviations along each axis.
+
+    Returns
+    -------
+    NUMPY ARRAY
+        Kernel with odd length along every axis and unit sum.
+    """
+    covariance = np.atleast_2d(np.asarray(covariance, dtype=float))
+    steps = np.asarray(steps, dtype=float).ravel()
+    halfWidth = np.ceil(nSigma * np.sqrt(np.diag(covariance)) / np.abs(steps) - 1e-9).astype(int)
+    offsets = np.stack(np.meshgrid(*[np.arange(-w, w+1)*step for w,step in zip(halfWidth, steps)], indexing='ij'), -1)
+    exponent = np.einsum('...i,ij,...j->...', offsets, np.linalg.inv(covariance), offsets)
+    kernel = np.exp(-0.5*exponent)
+    return kernel / kernel.sum()
+
+def block_shape(shape, kernelShape, points=BLOCK_POINTS):
+    """
+    Block of roughly points map points with equal sides, at least as wide as the kernel and clipped to the map.
+    """
+    side = max(1, int(round(points ** (1/len(shape)))))
+    return tuple(min(length, max(side, size)) for length,size in zip(shape, kernelShape))
+
+def convolve_map(intensity, axes, kernel=None, covariance=None, vectors=None, origin=(0,0,0), blockShape=None, out=None, nSigma=3.0):
+    """
+    Convolves a 1D/2D/3D map, e.g. from diffraction.intensity_map or scanstore, with a resolution kernel.
+
+    The kernel is either given directly or built from a Gaussian covariance. Either may be a function of the Miller
+    index, in which case the map is convolved in blocks, each with the kernel at the centre of the block, and the
+    results are overlap-added. Blocks are also used when blockShape or out is given, which bounds the memory in use
+    to a few blocks for maps that are memory mapped.
+
+    Parameters
+    ----------
+    intensity : ARRAY-LIKE (n0,n1,...)
+        The map, may be a memory-mapped array.
+    axes : LIST
+        Coordinates of the map, see diffraction.intensity_map. Must be evenly spaced.
+    kernel : ARRAY-LIKE or CALLABLE, optional
+        Kernel sampled on the map grid (centred on the middle element), or a function of the Miller index (3,)
+        returning one.
+    covariance : ARRAY-LIKE (d,d) or CALLABLE, optional
+        Covariance of a Gaussian kernel in map coordinates (see map_covariance), or a function of the Miller index
+        returning one. Used when kernel is not given.
+    vectors, origin
+        Map definition, see diffraction.intensity_map, used to give the Miller index of each block to the functions.
+    blockShape : TUPLE, optional
+        Number of map points per block along each axis.
+    out : ARRAY-LIKE or STRING, optional
+        Array to accumulate the result in, or the path of a .npy file created for it as a memory map.
+    nSigma : FLOAT, optional
+        Half-width of Gaussian kernels in standard deviations.
+
+    Returns
+    -------
+    NUMPY ARRAY (n0,n1,...)
+        The convolved map, the same shape as intensity (out if given).
+    """
+    coords = diffraction.map_axes(axes)
+    shape = tuple(len(coord) for coord in coords)
+    if(tuple(np.shape(intensity))!=shape):
+        raise ValueError('Map of shape {} does not match axes of shape {}.'.format(np.shape(intensity), shape))
+    for coord in coords:
+        if(len(coord)>2 and not np.allclose(np.diff(coord), coord[1]-coord[0])):
+            raise ValueError('Resolution convolution needs evenly spaced axes.')
+    steps = np.array([coord[1]-coord[0] if len(coord)>1 else 1.0 for coord in coords])
+    vectors = np.eye(3)[:len(coords)] if vectors is None else np.asarray(vectors, dtype=float).reshape(len(coords),3)
+
+    if(kernel is None and covariance is None):
+        raise ValueError('Either kernel or covariance must be given.')
+    source = kernel if kernel is not None else covariance
+    def kernel_at(hkl):
+        value = source(hkl) if callable(source) else source
+        return np.asarray(value, dtype=float) if kernel is not None else gaussian_kernel(value, steps, nSigma)
+
+    if(isinstance(out, str) or hasattr(out, '__fspath__')):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=float, shape=shape)
+    blockwise = callable(source) or blockShape is not None or out is not None
+
+    if(not blockwise):
+        constant = kernel_at(None)
+        full = fft_convolve(np.asarray(intensity, dtype=float), constant)
+        centre = tuple(size//2 for size in constant.shape)
+        return full[tuple(slice(c, c+length) for c,length in zip(centre, shape))]
+
+    if(out is None):
+        out = np.zeros(shape)
+    else:
+        out[...] = 0
+    if(blockShape is None):
+        blockShape = block_shape(shape, kernel_at(diffraction.map_hkl([coord[[len(coord)//2]] for coord in coords], vectors, origin).reshape(3)).shape)
+
+    for block in np.ndindex(*[-(-length // size) for length,size in zip(shape, blockShape)]):
+        region = tuple(slice(i*size, min((i+1)*size, length)) for i,size,length in zip(block, blockShape, shape))
+        centre = diffraction.map_hkl([coord[[(sl.start + sl.stop - 1)//2]] for coord,sl in zip(coords, region)], vectors, origin).reshape(3)
+        blockKernel = kernel_at(centre)
+        full = fft_convolve(np.asarray(intensity[region], dtype=float), blockKernel)
+
+        # Full-convolution index f of the block lands on map index start - kernelCentre + f
+        target, within = [], []
+        for sl,size,length,kernelSize in zip(region, full.shape, shape, blockKernel.shape):
+            start = sl.start - kernelSize//2
+            low, high = max(start, 0), min(start + size, length)
+            target.append(slice(low, high))
+            within.append(slice(low - start, high - start))
+        out[tuple(target)] += full[tuple(within)]
+
+    if(hasattr(out, 'flush')):
+        out.flush()
+    return out
@@ -0,0 +1,195 @@
+import json
+import pathlib
+import numpy as np
+from dataclasses import dataclass
+from . import scanstore
+
+"""
+Sub-routine to store diffraction results in an indexed, memory-mapped format.
+
+A result store is a directory holding
+    results.json   : shape of the intensities, resolution of the index and the crystal and modulation metadata.
+    hkl.npy        : the Miller indices (M,3), in the order they were computed.
+    intensity.npy  : the intensities (M,), or (rows,M) for several calculations over the same Miller indices such as
+                     the jobs of a sweep, the last axis following hkl.
+    keys.npy       : the Miller indices rounded to multiples of the resolution, as (h,k,l) integer records sorted
+                     lexicographically.
+    order.npy      : the position in hkl of every sorted key.
+Every array is opened as a memory map, so a store of any size can be sliced and queried without being read in full,
+and a Miller index is found by binary search in keys, in O(log M).
+
+    store = md.results.save_results('scan', hkl, intensity, crystal.metadata())
+    store = md.results.open_results('scan')
+    store.lookup([[0,1,0.05], [0,1,1.95]])
+"""
+
+RESULTS = 'results.json'
+HKL = 'hkl.npy'
+INTENSITY = scanstore.INTENSITY
+KEYS = 'keys.npy'
+ORDER = 'order.npy'
+
+# Miller indices closer than this (in reciprocal lattice units) share an index key
+HKL_RESOLUTION = 1e-6
+
+KEY_TYPE = np.dtype([('h','<i8'), ('k','<i8'), ('l','<i8')])
+
+def hkl_keys(hkl, resolution=HKL_RESOLUTION):
+    """
+    Index keys of Miller indices (M,3), their (h,k,l) rounded to multiples of resolution as records of KEY_TYPE.
+    """
+    rounded = np.rint(np.asarray(hkl, dtype=float).reshape(-1,3) / resolution).astype('<i8')
+    return np.ascontiguousarray(rounded).view(KEY_TYPE).ravel()
+
+@dataclass
+class resultStore:
+    """
+    Memory-mapped contents of a result store, see the module description.
+
+    hkl (M,3), intensity (M,) or (rows,M), keys (M,) and order (M,) are memory maps, metadata is the crystal and
+    modulation metadata given when the store was created and resolution the resolution of the index.
+    """
+    path: pathlib.Path
+    hkl: np.ndarray
+    intensity: np.ndarray
+    keys: np.ndarray
+    order: np.ndarray
+    metadata: dict
+    resolution: float = HKL_RESOLUTION
+
+    def __len__(self):
+        return len(self.hkl)
+
+    def find(self, hkl):
+        """
+        Positions in hkl of Miller indices (K,3), -1 for those not in the store.
+        """
+        query = hkl_keys(hkl, self.resolution)
+        sortedIndex = np.searchsorted(self.keys, query)
+        found = sortedIndex < len(self.keys)
+        found[found] = self.keys[sortedIndex[found]] == query[found]
+        rows = np.full(len(query), -1, dtype=np.int64)
+        rows[found] = self.order[sortedIndex[found]]
+        return rows
+
+    def lookup(self, hkl):
+        """
+        Intensities of Miller indices (K,3), (K,) or (rows,K).
+
+        Raises
+        ------
+        KeyError
+            If any of the Miller indices is not in the store.
+        """
+        hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+        rows = self.find(hkl)
+        if((rows<0).any()):
+            raise KeyError('Miller indices {} are not in the store.'.format(hkl[rows<0].tolist()))
+        return self.intensity[..., rows]
+
+def write_index(path, hkl, resolution=HKL_RESOLUTION):
+    """
+    Writes the sorted keys and their order for the Miller indices (M,3) of a store.
+    """
+    path = pathlib.Path(path)
+    keys = hkl_keys(hkl, resolution)
+    # lexsort sorts by its last key first, so l, k, h gives the order of the (h,k,l) records
+    order = np.lexsort((keys['l'], keys['k'], keys['h']))
+    np.save(path.joinpath(KEYS), keys[order])
+    np.save(path.joinpath(ORDER), order.astype(np.int64))
+
+def create_results(path, hkl, rows=None, metadata=None, resolution=HKL_RESOLUTION):
+    """
+    Creates a store for the intensities of the Miller indices hkl, to be filled through the memory map returned.
+
+    Parameters
+    ----------
+    path : STRING
+        Directory of the store, created if it does not exist.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices of the results.
+    rows : INT, optional
+        Number of calculations stored over hkl, by default one with intensity of shape (M,).
+    metadata : DICT, optional
+        JSON-serialisable description of the calculation, e.g. mandyCrystal.metadata().
+    resolution : FLOAT, optional
+        Miller indices closer than resolution are treated as the same by the index.
+
+    Returns
+    -------
+    NUMPY MEMMAP (M,) or (rows,M)
+        The intensities, zero and opened for writing.
+    """
+    path = pathlib.Path(path)
+    hkl = np.ascontiguousarray(hkl, dtype=float).reshape(-1,3)
+    shape = (len(hkl),) if rows is None else (int(rows), len(hkl))
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path.joinpath(HKL), hkl)
+    write_index(path, hkl, resolution)
+    intensity = np.lib.format.open_memmap(path.joinpath(INTENSITY), mode='w+', dtype=float, shape=shape)
+    intensity.flush()
+    # The description is written last, its presence marks a usable store
+    scanstore.write_json(path.joinpath(RESULTS), {'shape': list(shape), 'resolution': resolution, 'metadata': metadata})
+    return intensity
+
+def save_results(path, hkl, intensity, metadata=None, resolution=HKL_RESOLUTION):
+    """
+    Saves intensities and their Miller indices as a result store, e.g. the output of diffraction.magnetic_calc.
+
+    Parameters
+    ----------
+    path : STRING
+        Directory of the store, created if it does not exist and overwritten if it does.
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices, any shape ending in 3 being flattened.
+    intensity : ARRAY-LIKE (M,) or (rows,M)
+        Intensity of every Miller index, or of every Miller index in each of several calculations.
+    metadata : DICT, optional
+        JSON-serialisable description of the calculation, e.g. mandyCrystal.metadata().
+    resolution : FLOAT, optional
+        Miller indices closer than resolution are treated as the same by the index.
+
+    Returns
+    -------
+    resultStore
+        The store, opened read-only.
+    """
+    hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+    intensity = np.asarray(intensity, dtype=float)
+    intensity = intensity.reshape(-1) if intensity.ndim<2 or intensity.size==len(hkl) else intensity.reshape(-1,len(hkl))
+    if(intensity.shape[-1]!=len(hkl)):
+        raise ValueError('{} intensities given for {} Miller indices.'.format(intensity.shape[-1], len(hkl)))
+    path = pathlib.Path(path)
+    # An existing store is marked unusable before it is overwritten
+    path.joinpath(RESULTS).unlink(missing_ok=True)
+    stored = create_results(path, hkl, None if intensity.ndim==1 else len(intensity), metadata, resolution)
+    stored[...] = intensity
+    stored.flush()
+    del stored
+    return open_results(path)
+
+def open_results(path, mode='r'):
+    """
+    Opens a result store lazily as memory maps.
+
+    Parameters
+    ----------
+    path : STRING
+        Directory of the store.
+    mode : STRING, optional
+        'r' opens the intensities read-only, 'r+' for writing.
+
+    Returns
+    -------
+    resultStore
+    """
+    path = pathlib.Path(path)
+    with open(path.joinpath(RESULTS)) as file:
+        description = json.load(file)
+    return resultStore(path=path,
+                       hkl=np.load(path.joinpath(HKL), mmap_mode='r'),
+                       intensity=np.load(path.joinpath(INTENSITY), mmap_mode=mode),
+                       keys=np.load(path.joinpath(KEYS), mmap_mode='r'),
+                       order=np.load(path.joinpath(ORDER), mmap_mode='r'),
+                       metadata=description['metadata'],
+                       resolution=description['resolution'])
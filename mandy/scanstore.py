@@ -0,0 +1,154 @@
+import os
+import json
+import pathlib
+import numpy as np
+from . import diffraction
+
+"""
+Sub-routine to stream reciprocal-space maps to disk tile by tile, such that large scans can be resumed and read lazily.
+
+A store is a directory holding
+    manifest.json  : axes, vectors, origin, tile shape and crystal metadata of the scan.
+    intensity.npy  : the full map, written through a memory map one tile at a time.
+    tiles.npy      : one flag per tile, set once the tile has been flushed to intensity.npy.
+"""
+
+MANIFEST = 'manifest.json'
+INTENSITY = 'intensity.npy'
+TILES = 'tiles.npy'
+
+# Default number of map points per tile
+TILE_POINTS = 2**16
+
+def default_tile_shape(shape):
+    """
+    Tile of roughly TILE_POINTS points with equal sides, clipped to the map shape.
+    """
+    side = max(1, int(round(TILE_POINTS ** (1/len(shape)))))
+    return tuple(min(side, length) for length in shape)
+
+def write_json(path, data):
+    """
+    Writes JSON through a temporary file such that an interrupted write never leaves a truncated manifest.
+    """
+    path = pathlib.Path(path)
+    tmpPath = path.with_suffix(path.suffix + '.tmp')
+    with open(tmpPath, 'w') as file:
+        json.dump(data, file, indent=1)
+    os.replace(tmpPath, path)
+
+def create_store(path, coords, vectors, origin, tileShape, metadata=None):
+    """
+    Creates an empty store, or checks that an existing one describes the same scan so that it can be resumed.
+
+    Returns
+    -------
+    intensity : NUMPY MEMMAP
+        The map, opened for writing.
+    tiles : NUMPY MEMMAP
+        Completion flag of each tile, opened for writing.
+    """
+    path = pathlib.Path(path)
+    shape = tuple(len(coord) for coord in coords)
+    manifest = {'shape': list(shape),
+                'tile_shape': list(tileShape),
+                'axes': [coord.tolist() for coord in coords],
+                'vectors': np.asarray(vectors, dtype=float).tolist(),
+                'origin': np.asarray(origin, dtype=float).tolist(),
+                'metadata': metadata}
+    tileGrid = tuple(-(-length // size) for length,size in zip(shape, tileShape))
+
+    if(path.joinpath(MANIFEST).exists()):
+        with open(path.joinpath(MANIFEST)) as file:
+            existing = json.load(file)
+        same = lambda a,b: np.shape(a)==np.shape(b) and np.allclose(a, b)
+        for key in ('shape','tile_shape','vectors','origin','axes'):
+            pairs = zip(existing[key], manifest[key]) if key=='axes' else [(existing[key], manifest[key])]
+            if(len(existing[key])!=len(manifest[key]) or not all(same(a,b) for a,b in pairs)):
+                raise ValueError('Store "{}" holds a different scan ({} differs), use a new path to start a new scan.'.format(path, key))
+        # Compared as read back from JSON, where tuples become lists
+        if(existing.get('metadata')!=json.loads(json.dumps(manifest['metadata']))):
+            raise ValueError('Store "{}" holds a different scan (metadata differs), use a new path to start a new scan.'.format(path))
+        return np.load(path.joinpath(INTENSITY), mmap_mode='r+'), np.load(path.joinpath(TILES), mmap_mode='r+')
+
+    path.mkdir(parents=True, exist_ok=True)
+    intensity = np.lib.format.open_memmap(path.joinpath(INTENSITY), mode='w+', dtype=float, shape=shape)
+    tiles = np.lib.format.open_memmap(path.joinpath(TILES), mode='w+', dtype=np.uint8, shape=tileGrid)
+    intensity.flush()
+    tiles.flush()
+    # The manifest is written last, its presence marks a usable store
+    write_json(path.joinpath(MANIFEST), manifest)
+    return intensity, tiles
+
+def scan_to_store(crystalObj, path, axes, vectors=None, origin=(0,0,0), tileShape=None, chunkSize=None, workers=None, nufft=None):
+    """
+    Computes a 1D/2D/3D map as diffraction.intensity_map does, streaming each completed tile to the store at path.
+
+    Tiles already completed in an existing store at path are skipped, so an interrupted scan is resumed by
+    repeating the same call.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Object which contains the crystal on which the simulation is conducted.
+    path : STRING
+        Directory of the store, created if it does not exist.
+    axes, vectors, origin
+        Map definition, see diffraction.intensity_map.
+    tileShape : TUPLE, optional
+        Number of points per tile along each axis, by default roughly TILE_POINTS points per tile.
+    chunkSize, workers, nufft
+        Passed on to diffraction.intensities for each tile.
+
+    Returns
+    -------
+    intensity : NUMPY MEMMAP (n0,n1,...)
+        The completed map, opened read-only.
+    manifest : DICT
+        Axes, vectors, origin and crystal metadata of the scan.
+
+    """
+    coords = diffraction.map_axes(axes)
+    if(vectors is None):
+        vectors = np.eye(3)[:len(coords)]
+    shape = tuple(len(coord) for coord in coords)
+    tileShape = default_tile_shape(shape) if tileShape is None else tuple(int(size) for size in tileShape)
+
+    intensity, tiles = create_store(path, coords, vectors, origin, tileShape, crystalObj.metadata())
+
+    for tile in np.ndindex(tiles.shape):
+        if(tiles[tile]):
+            continue
+        region = tuple(slice(i*size, min((i+1)*size, length)) for i,size,length in zip(tile, tileShape, shape))
+        tileAxes = [coord[sl] for coord,sl in zip(coords, region)]
+        intensity[region], _ = diffraction.intensity_map(crystalObj, tileAxes, vectors, origin, chunkSize, workers, nufft=nufft)
+        # Flush the data before marking the tile complete, a crash in between only repeats this tile
+        intensity.flush()
+        tiles[tile] = 1
+        tiles.flush()
+
+    del intensity, tiles
+    return open_store(path)
+
+def open_store(path):
+    """
+    Opens a store lazily as a read-only memory-mapped array.
+
+    Parameters
+    ----------
+    path : STRING
+        Directory of the store.
+
+    Returns
+    -------
+    intensity : NUMPY MEMMAP (n0,n1,...)
+        The map, tiles that have not been completed read as zero.
+    manifest : DICT
+        Axes, vectors, origin and crystal metadata of the scan, with 'complete' set to whether every tile is done.
+
+    """
+    path = pathlib.Path(path)
+    with open(path.joinpath(MANIFEST)) as file:
+        manifest = json.load(file)
+    manifest['complete'] = bool(np.load(path.joinpath(TILES), mmap_mode='r').all())
+    return np.load(path.joinpath(INTENSITY), mmap_mode='r'), manifest
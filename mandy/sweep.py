@@ -0,0 +1,367 @@
+import os
+import sys
+import copy
+import json
+import logging
+import argparse
+import itertools
+import pathlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import diffraction, results
+
+"""
+Sub-routine to run parameter sweeps, the `mandy` command line entry point.
+
+A sweep is described by a JSON config holding one calculation and a grid of parameters to vary over it:
+
+    {"cif": "Chromium.cif",
+     "sitepath": "ChromiumSiteNames.dat",
+     "sites": [{"moment": [1,0,0], "ion_name": "Cr1", "label": "Cr"},
+               {"moment": [-1,0,0], "ion_name": "Cr1", "label": "Cr0"}],
+     "modulation": {"q": [0,0,0.05], "u": [1,0,0], "v": [0,0,0], "n": [2,2,22]},
+     "Q": {"miller": [[0], [1], {"start": 0, "stop": 2.5, "step": 0.025}]},
+     "grid": {"modulation.q": [[0,0,0.05], [0,0,0.0625]], "modulation.m1": [0.5, 1.0]},
+     "options": {"dtype": "float32"}}
+
+cif and sitepath are relative to the config file, sitepath defaulting to '<cif name>SiteNames.dat' beside the CIF,
+and l_s of each site is looked up with requestNIST.find_L_S when it is not given. modulation holds the arguments of
+mandyCrystal.createModulation (mode, dtype and blockCells included) and may be omitted for an unmodulated crystal.
+Q is one of
+    "miller" : per-direction lists as for diffraction.magnetic_calc,
+    "hkl"    : a list of [h,k,l],
+    "axes"   : map axes with optional "vectors" and "origin", as for diffraction.intensity_map,
+where any list of coordinates may be given as {"start", "stop", "step"}. options are passed on to
+diffraction.intensities (chunkSize, symmetry, nufft, dtype, backend).
+
+Every key of grid is a dotted path into the config, list entries by their index (e.g. "sites.0.moment"), and the
+jobs are the Cartesian product of the grid values, the last key varying fastest. Jobs are spread over a pool of
+worker processes, each of which keeps the crystals it has built so that jobs differing only in their modulation or
+options reuse them. The output directory is a result store (see the results module) whose intensities (jobs,M)
+hold one row per job, written through a memory map, and whose metadata are the config, the grid keys and the
+parameters of every job, alongside
+    jobs.npy       : one flag per job, set once its row has been flushed to intensity.npy.
+Rerunning a sweep into the same directory skips the jobs already completed.
+"""
+
+JOBS = 'jobs.npy'
+
+# Number of built crystals each worker keeps for reuse
+CRYSTAL_CACHE = 4
+
+logger = logging.getLogger(__name__)
+
+# Built crystals of this process, keyed by crystal_key, and the Miller indices of the sweep, set by _init
+_crystals = {}
+_hkl = None
+
+def as_json(data):
+    """
+    data as read back from JSON, tuples becoming lists and numpy arrays and scalars their Python equivalents.
+    """
+    return json.loads(json.dumps(data, default=lambda val: np.asarray(val).tolist()))
+
+def load_config(path):
+    """
+    Reads a sweep config, resolving its file paths relative to the config file.
+
+    Parameters
+    ----------
+    path : STRING
+        Path of the JSON config.
+
+    Returns
+    -------
+    DICT
+        The config, with absolute cif and sitepath and its defaults filled in, see prepare_config.
+    """
+    path = pathlib.Path(path)
+    with open(path) as file:
+        config = json.load(file)
+    return prepare_config(config, path.resolve().parent)
+
+def prepare_config(config, folder='.'):
+    """
+    Checks a sweep config, fills in its defaults and resolves its file paths.
+
+    Parameters
+    ----------
+    config : DICT
+        Sweep config, left unchanged.
+    folder : STRING, optional
+        Directory relative to which cif and sitepath are given, by default the current working directory.
+
+    Returns
+    -------
+    DICT
+        A copy of the config in JSON types, see as_json, with absolute cif and sitepath and modulation, grid and
+        options set.
+    """
+    config = as_json(config)
+    for key in ('cif', 'sites', 'Q'):
+        if(key not in config):
+            raise ValueError('Sweep config has no "{}" entry.'.format(key))
+    folder = pathlib.Path(folder).resolve()
+    config['cif'] = str(folder.joinpath(config['cif']))
+    if(config.get('sitepath')):
+        config['sitepath'] = str(folder.joinpath(config['sitepath']))
+    else:
+        cifPath = pathlib.Path(config['cif'])
+        config['sitepath'] = str(cifPath.with_name('{}SiteNames.dat'.format(cifPath.stem)))
+    # Without the site name file the build would prompt for the labels, which a worker process cannot answer
+    if(not os.path.exists(config['sitepath'])):
+        raise FileNotFoundError('Site name file "{}" not found, create it by building the crystal once interactively.'.format(config['sitepath']))
+    config.setdefault('modulation', None)
+    config.setdefault('grid', {})
+    config.setdefault('options', {})
+    return config
+
+def coordinates(values):
+    """
+    Array of coordinates from a list, or from a {"start", "stop", "step"} range as for diffraction.scan_axis.
+    """
+    if(isinstance(values, dict)):
+        return diffraction.scan_axis(values['start'], values['stop'], values['step'])
+    return np.asarray(values, dtype=float).ravel()
+
+def sweep_hkl(Q):
+    """
+    Miller indices (M,3) of the Q entry of a sweep config.
+    """
+    if('miller' in Q):
+        return np.array(diffraction.miller_list([coordinates(values).tolist() for values in Q['miller']]), dtype=float).reshape(-1,3)
+    if('hkl' in Q):
+        return np.asarray(Q['hkl'], dtype=float).reshape(-1,3)
+    if('axes' in Q):
+        axes = [coordinates(values) for values in Q['axes']]
+        return diffraction.map_hkl(axes, Q.get('vectors'), Q.get('origin', (0,0,0))).reshape(-1,3)
+    raise ValueError('The Q entry of a sweep config needs "miller", "hkl" or "axes".')
+
+def set_path(config, key, value):
+    """
+    Sets the entry of config at a dotted path such as "modulation.q" or "sites.0.moment".
+    """
+    *parents, last = key.split('.')
+    target = config
+    for part in parents:
+        target = target[int(part)] if isinstance(target, list) else target[part]
+    if(isinstance(target, list)):
+        target[int(last)] = value
+    else:
+        target[last] = value
+
+def expand_jobs(config):
+    """
+    Expands the grid of a sweep config into its jobs.
+
+    Returns
+    -------
+    params : LIST
+        {key: value} of the grid values of each job.
+    configs : LIST
+        Config of each job, the grid values set and the l_s of every site resolved.
+    """
+    from . import requestNIST
+
+    keys = list(config['grid'])
+    params = [dict(zip(keys, values)) for values in itertools.product(*[config['grid'][key] for key in keys])]
+    configs = []
+    for param in params:
+        job = copy.deepcopy({key:val for key,val in config.items() if key!='grid'})
+        for key,value in param.items():
+            set_path(job, key, value)
+        configs.append(job)
+
+    # Quantum numbers are looked up once here rather than in every worker
+    sites = [site for job in configs for site in job['sites'] if site.get('l_s') is None]
+    terms = requestNIST.find_L_S_batch([site.get('ion_name', 'Fe2') for site in sites]) if sites else {}
+    for site in sites:
+        site['l_s'] = list(terms[site.get('ion_name', 'Fe2')])
+    return params, configs
+
+def crystal_key(config):
+    """
+    Key of the built crystal of a job, jobs with the same key share it.
+    """
+    return json.dumps({key:config[key] for key in ('cif', 'sitepath', 'sites')}, sort_keys=True)
+
+def job_crystal(config):
+    """
+    Crystal of a job, built once per process and kept in _crystals, then modulated as the job asks.
+    """
+    from . import mandyCrystal as mc
+
+    key = crystal_key(config)
+    crystalObj = _crystals.pop(key, None)
+    fresh = crystalObj is None
+    if(fresh):
+        sites = [mc.site(site['moment'], tuple(site['l_s']), site.get('ion_name', 'Fe2'), site.get('label', 'Fe2a')) for site in config['sites']]
+        crystalObj = mc.mandyCrystal(config['cif'], sites, config['sitepath'])
+        crystalObj.build()
+        while(len(_crystals) >= CRYSTAL_CACHE):
+            _crystals.pop(next(iter(_crystals)))
+    # Most recently used last, such that the oldest is dropped first
+    _crystals[key] = crystalObj
+
+    mod = config['modulation']
+    if(mod is None):
+        if(not fresh):
+            # Undo the modulation of a previous job, the unit cell being read back from the build cache
+            crystalObj.build()
+    else:
+        mod = dict(mod)
+        if(mod.get('n') is not None):
+            mod['n'] = np.array(mod['n'])
+        if(mod.get('dtype') is not None):
+            mod['dtype'] = np.dtype(mod['dtype']).type
+        crystalObj.createModulation(**mod)
+    return crystalObj
+
+def run_job(config, hkl=None):
+    """
+    Intensities (M,) of one job over the Miller indices of the sweep.
+    """
+    hkl = _hkl if hkl is None else hkl
+    options = dict(config['options'])
+    if(options.get('dtype') is not None):
+        options['dtype'] = np.dtype(options['dtype']).type
+    return diffraction.intensities(job_crystal(config), hkl, **options)
+
+def _init(hkl):
+    """
+    Worker initializer, receives the Miller indices once per process rather than once per job.
+    """
+    global _hkl
+    _hkl = hkl
+
+def _run(index, config):
+    return index, run_job(config)
+
+def create_output(path, config, params, hkl):
+    """
+    Creates an empty sweep output, or checks that an existing one holds the same sweep so that it can be resumed.
+
+    Returns
+    -------
+    intensity : NUMPY MEMMAP (jobs,M)
+        The results, opened for writing.
+    jobs : NUMPY MEMMAP (jobs,)
+        Completion flag of each job, opened for writing.
+    """
+    path = pathlib.Path(path)
+    # Compared and stored as read back from JSON, such that the config of a resumed sweep compares equal
+    metadata = as_json({'config':config, 'keys':list(config['grid']), 'params':params})
+    if(path.joinpath(results.RESULTS).exists()):
+        existing = results.open_results(path, 'r+')
+        if(existing.metadata['config']!=metadata['config'] or not np.array_equal(existing.hkl, hkl)):
+            raise ValueError('Output "{}" holds a different sweep, use a new path to start a new sweep.'.format(path))
+        return existing.intensity, np.load(path.joinpath(JOBS), mmap_mode='r+')
+
+    path.mkdir(parents=True, exist_ok=True)
+    jobs = np.lib.format.open_memmap(path.joinpath(JOBS), mode='w+', dtype=np.uint8, shape=(len(params),))
+    jobs.flush()
+    intensity = results.create_results(path, hkl, len(params), metadata)
+    return intensity, jobs
+
+def run_sweep(config, path, workers=-1, progress=None):
+    """
+    Runs every job of a sweep not yet completed in the output at path.
+
+    Parameters
+    ----------
+    config : DICT or STRING
+        Sweep config, or the path of its JSON file, see load_config. The paths of a dict are relative to the current
+        working directory.
+    path : STRING
+        Output directory, created if it does not exist.
+    workers : INT, optional
+        Number of worker processes, -1 uses every core and None or 1 runs the jobs in this process.
+    progress : CALLABLE, optional
+        Called as progress(done, total) each time a job completes, counting the jobs completed by earlier runs.
+
+    Returns
+    -------
+    results.resultStore
+        See open_sweep.
+    """
+    from . import parallel
+
+    config = load_config(config) if isinstance(config, (str, pathlib.Path)) else prepare_config(config)
+    params, configs = expand_jobs(config)
+    hkl = sweep_hkl(config['Q'])
+    intensity, jobs = create_output(path, config, params, hkl)
+
+    # Jobs sharing a crystal are queued together, such that each worker builds each crystal as few times as possible
+    pending = sorted(np.flatnonzero(jobs[:]==0).tolist(), key=lambda index: crystal_key(configs[index]))
+    done = len(params) - len(pending)
+    logger.info('Sweep of %d jobs over %d Q-points, %d already completed', len(params), len(hkl), done)
+
+    def store(index, result):
+        nonlocal done
+        intensity[index] = result
+        # Flush the data before marking the job complete, a crash in between only repeats this job
+        intensity.flush()
+        jobs[index] = 1
+        jobs.flush()
+        done += 1
+        logger.info('Job %d %s completed (%d of %d)', index, params[index], done, len(params))
+        if(progress is not None):
+            progress(done, len(params))
+
+    if(workers is None or workers==1 or len(pending)<=1):
+        for index in pending:
+            store(index, run_job(configs[index], hkl))
+    else:
+        workers = min(parallel.worker_count(workers), len(pending))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(hkl,)) as pool:
+            for future in as_completed([pool.submit(_run, index, configs[index]) for index in pending]):
+                store(*future.result())
+
+    return open_sweep(path)
+
+def open_sweep(path):
+    """
+    Opens a sweep output lazily as a read-only result store.
+
+    Parameters
+    ----------
+    path : STRING
+        Output directory of the sweep.
+
+    Returns
+    -------
+    results.resultStore
+        hkl (M,3) and intensity (jobs,M) of every job, the rows of jobs not completed reading as zero. Its metadata
+        are the config, keys and params of every job as written by run_sweep, with completed the flag of every job and
+        complete whether every job is done.
+    """
+    store = results.open_results(path)
+    completed = np.load(pathlib.Path(path).joinpath(JOBS)).astype(bool)
+    store.metadata['completed'] = completed.tolist()
+    store.metadata['complete'] = bool(completed.all())
+    return store
+
+def main(argv=None):
+    """
+    Entry point of the `mandy` command, runs or resumes the sweep of a config file.
+    """
+    parser = argparse.ArgumentParser(prog='mandy', description='Runs a parameter sweep of magnetic neutron diffraction calculations.')
+    parser.add_argument('config', help='JSON file describing the sweep.')
+    parser.add_argument('-o', '--output', help='Output directory, by default "<config name>_sweep" beside the config. '
+                                               'An existing output of the same sweep is resumed.')
+    parser.add_argument('-w', '--workers', type=int, default=-1, help='Number of worker processes, -1 (default) uses every core.')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only report errors.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+    # The crystal tables logged by every build would drown the progress of the sweep
+    logging.getLogger('mandy.mandyCrystal').setLevel(logging.WARNING)
+
+    configPath = pathlib.Path(args.config)
+    output = args.output if args.output else str(configPath.with_name(configPath.stem + '_sweep'))
+    store = run_sweep(str(configPath), output, args.workers)
+    logger.info('Results of %d jobs over %d Q-points in %s', store.intensity.shape[0], len(store), output)
+    return 0 if store.metadata['complete'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import numpy as np
+from . import mandyCrystal as MC
+
+"""
+Sub-routine to reduce lists of Miller indices to those unique under the magnetic point group, such that each
+symmetry-equivalent reflection is only computed once.
+
+Rotations are integer matrices R acting on fractional coordinates as columns, x' = Rx (as in gemmi), and act on Miller
+indices as rows, h' = hR^-1. The structure factor is a sum over the n-cell box of the crystal, which is periodic
+only on the grid of Miller indices in steps of 1/n, so only indices on that grid are reduced and any other index
+is computed as given.
+"""
+
+# Fractional coordinates are compared on a grid of this many points per box length
+POSITION_GRID = 10**6
+
+def space_group_rotations(cifPath):
+    """
+    Distinct rotation parts of the space-group operations declared in a CIF file, read with gemmi.
+
+    Returns
+    -------
+    NUMPY ARRAY (G,3,3) or None
+        Integer rotations, None when the file declares no symmetry beyond P1.
+    """
+    import gemmi
+    try:
+        spaceGroup = gemmi.read_small_structure(str(cifPath)).spacegroup
+    except Exception:
+        return None
+    if(spaceGroup is None or spaceGroup.number==1):
+        return None
+    rotations = np.array([op.rot for op in spaceGroup.operations().sym_ops]) // gemmi.Op.DEN
+    return np.unique(rotations, axis=0)
+
+def lattice_rotations(lattice, tol=1e-4):
+    """
+    Holohedry of the lattice, every integer rotation with entries in {-1,0,1} which preserves the metric A A^T.
+
+    Parameters
+    ----------
+    lattice : NUMPY ARRAY (3,3)
+        Lattice vectors as rows.
+    tol : FLOAT, optional
+        Relative tolerance on the metric.
+    """
+    metric = lattice @ lattice.T
+    entries = np.array(np.meshgrid(*[[-1,0,1]]*9, indexing='ij')).reshape(9,-1).T.reshape(-1,3,3)
+    entries = entries[np.abs(np.linalg.det(entries)).round()==1]
+    image = np.einsum('gji,jk,gkl->gil', entries, metric, entries)
+    keep = np.all(np.abs(image - metric) <= tol*np.abs(metric).max(), axis=(1,2))
+    return entries[keep]
+
+def magnetic_structure(crystalObj):
+    """
+    Positions, moments and form-factor species of one period of the magnetic structure, the n-cell box.
+    """
+    if(getattr(crystalObj, 'stream', None) is not None):
+        raise ValueError('Symmetry reduction needs the supercell in memory, use createModulation(mode=\'supercell\') or (mode=\'analytic\').')
+    if(crystalObj.modulation is None):
+        positions, moments, siteIds = crystalObj.positions, crystalObj.moments, crystalObj.siteIds
+    else:
+        mod = crystalObj.modulation
+        positions, siteIds, moments = MC.modulated_supercell(crystalObj.lattice, crystalObj.cellPositions, crystalObj.cellSiteIds,
+                                                             crystalObj.siteMoments, crystalObj.n, mod.q @ crystalObj.reciprocal,
+                                                             mod.u, mod.v, mod.m1, mod.m2, mod.rotate)
+    # Sites scatter identically when they share an ion and quantum numbers
+    speciesKeys = [(site.ion_name, tuple(site.l_s)) for site in crystalObj.sites]
+    species = np.array([speciesKeys.index(key) for key in speciesKeys])
+    return positions, moments, species[siteIds]
+
+def position_keys(fractional):
+    """
+    Integer key of fractional box coordinates, identical for coordinates equal modulo the box.
+    """
+    grid = np.round(np.mod(fractional, 1) * POSITION_GRID).astype(np.int64) % POSITION_GRID
+    return (grid[...,0]*POSITION_GRID + grid[...,1])*POSITION_GRID + grid[...,2]
+
+def magnetic_point_group(crystalObj, rotations=None, tol=1e-4):
+    """
+    Infers the rotations which leave the magnetic structure of a crystal unchanged.
+
+    A rotation is kept if, combined with some translation and optionally time reversal, it maps every position of the
+    n-cell box onto a position of the same species (modulo the box) whose moment is the rotated axial moment. Such a
+    rotation leaves |M_perp|^2 unchanged at every Miller index on the grid of the box.
+
+    Parameters
+    ----------
+    crystalObj : mandyCrystal object
+        Built crystal, with or without a modulation.
+    rotations : ARRAY-LIKE (G,3,3), optional
+        Candidate rotations, by default those of the space group in the CIF file or, for a P1 file, of the lattice.
+    tol : FLOAT, optional
+        Relative tolerance on the moments and the lattice metric.
+
+    Returns
+    -------
+    NUMPY ARRAY (K,3,3)
+        Integer rotations of the magnetic point group, acting on fractional coordinates.
+    """
+    lattice = crystalObj.lattice
+    if(rotations is None):
+        rotations = space_group_rotations(crystalObj.cifPath)
+        if(rotations is None):
+            rotations = lattice_rotations(lattice, tol)
+    rotations = np.asarray(rotations).reshape(-1,3,3)
+
+    positions, moments, species = magnetic_structure(crystalObj)
+    n = np.asarray(crystalObj.n, dtype=float)
+    box = n[:,None] * lattice
+    fractional = positions @ np.linalg.inv(box)
+    keys = position_keys(fractional)
+    order = np.argsort(keys)
+    sortedKeys = keys[order]
+    momentTol = tol * max(np.abs(moments).max(), 1e-12)
+
+    # Atom 0 must map onto an atom of its species, which fixes the candidate translations
+    targets = np.flatnonzero(species==species[0])
+    probe = np.arange(min(len(positions), 8))
+
+    def matches(images, imageMoments, atoms):
+        # Whether an atom of the same species and moment sits at each image position
+        found = np.clip(np.searchsorted(sortedKeys, position_keys(images)), 0, len(keys)-1)
+        index = order[found]
+        ok = (sortedKeys[found]==position_keys(images)) & (species[index]==species[atoms])
+        ok &= np.all(np.abs(moments[index] - imageMoments) <= momentTol, axis=-1)
+        return ok
+
+    kept = []
+    for R in rotations:
+        W = R.T.astype(float)
+        # The rotation must map the box lattice onto itself
+        boxW = (n[:,None] * W) / n[None,:]
+        if(np.any(np.abs(boxW - np.round(boxW)) > 1e-9)):
+            continue
+        cartesian = np.linalg.inv(lattice) @ W @ lattice
+        images = fractional @ boxW
+        for timeReversal in (1,-1):
+            imageMoments = timeReversal * np.linalg.det(W) * (moments @ cartesian)
+            translations = fractional[targets] - images[0]
+            ok = matches(images[probe][None,:,:] + translations[:,None,:], imageMoments[probe][None,:,:], probe[None,:]).all(axis=1)
+            if(any(matches(images + t, imageMoments, np.arange(len(images))).all() for t in translations[ok])):
+                kept.append(R)
+                break
+    return np.array(kept, dtype=int).reshape(-1,3,3)
+
+def parse_operations(operations):
+    """
+    Rotations from operations given as 3x3 matrices or coordinate triplets such as '-y,x,z' (a magnetic time-reversal
+    mark, "'" or a trailing ',-1', is accepted and ignored as it does not change intensities).
+    """
+    rotations = []
+    for op in operations:
+        if(isinstance(op, str)):
+            import gemmi
+            fields = op.replace("'", '').split(',')
+            parsed = gemmi.Op(','.join(fields[:3]))
+            rotations.append(np.array(parsed.rot) // gemmi.Op.DEN)
+        else:
+            rotations.append(np.asarray(op, dtype=int).reshape(3,3))
+    return np.array(rotations, dtype=int).reshape(-1,3,3)
+
+def hkl_operations(rotations):
+    """
+    Matrices H acting on Miller indices as rows, h' = hH, for rotations of fractional coordinates, with Friedel pairs
+    (-H) added since moments are real.
+    """
+    rotations = np.asarray(rotations).reshape(-1,3,3)
+    inverse = np.round(np.linalg.inv(rotations)).astype(int) if len(rotations) else np.eye(3, dtype=int)[None]
+    return np.unique(np.concatenate([inverse, -inverse, np.eye(3, dtype=int)[None]]), axis=0)
+
+def reduce_hkl(hkl, operations, n=(1,1,1)):
+    """
+    Reduces Miller indices to one representative per orbit of the operations.
+
+    Parameters
+    ----------
+    hkl : ARRAY-LIKE (M,3)
+        Miller indices.
+    operations : ARRAY-LIKE (G,3,3)
+        Matrices acting on Miller indices as rows, see hkl_operations.
+    n : ARRAY-LIKE (3,), optional
+        Size of the box in unit cells, only indices in steps of 1/n are reduced.
+
+    Returns
+    -------
+    unique : NUMPY ARRAY (U,3)
+        Representative Miller indices to be computed.
+    inverse : NUMPY ARRAY (M,)
+        Index into unique of each Miller index, such that result[inverse] expands the results back.
+    """
+    hkl = np.asarray(hkl, dtype=float).reshape(-1,3)
+    n = np.asarray(n, dtype=float)
+    scaled = hkl * n
+    onGrid = np.all(np.abs(scaled - np.round(scaled)) < 1e-9, axis=1)
+
+    representative = hkl.copy()
+    if(onGrid.any()):
+        # Integer images of every index on the box grid, the lexicographically largest represents the orbit
+        grid = np.round(scaled[onGrid]).astype(np.int64)
+        # Operations in steps of the box grid, only those mapping the grid onto itself are used
+        gridOperations = np.asarray(operations, dtype=float) * n[None,None,:] / n[None,:,None]
+        gridOperations = gridOperations[np.all(np.abs(gridOperations - np.round(gridOperations)) < 1e-9, axis=(1,2))]
+        images = np.einsum('mi,gij->mgj', grid, np.round(gridOperations).astype(np.int64))
+        offset = np.abs(images).max() + 1
+        code = ((images[...,0]+offset)*(2*offset+1) + images[...,1]+offset)*(2*offset+1) + images[...,2]+offset
+        best = images[np.arange(len(grid)), np.argmax(code, axis=1)]
+        representative[onGrid] = best / n
+
+    unique, inverse = np.unique(np.round(representative, 12), axis=0, return_inverse=True)
+    return unique, inverse.ravel()
+
+def symmetry_operations(crystalObj, symmetry):
+    """
+    Resolves the symmetry option of diffraction.intensities into operations on Miller indices.
+
+    True infers the magnetic point group of the crystal, a list of rotations or triplets is used as given.
+    """
+    if(symmetry is True):
+        return hkl_operations(magnetic_point_group(crystalObj))
+    return hkl_operations(parse_operations(symmetry))
@@ -0,0 +1,68 @@
+import pathlib
+import numpy as np
+import pytest
+from mandy import mandyCrystal as mc
+from mandy import requestNIST
+
+"""
+The Cr and NbFe2 crystals of the Examples directory, shared by the tests and benchmarks/benchmark.py.
+"""
+
+EXAMPLES = pathlib.Path(__file__).resolve().parent.parent.joinpath('Examples')
+
+def chromium():
+    """
+    Unit cell of the Cr SDW example.
+    """
+    ls = requestNIST.find_L_S('Cr1', offline=True)
+    sites = [mc.site([1,0,0], ls, ion_name='Cr1', label='Cr'), mc.site([-1,0,0], ls, ion_name='Cr1', label='Cr0')]
+    folder = EXAMPLES.joinpath('Cr')
+    return mc.mandyCrystal(str(folder.joinpath('Chromium.cif')), sites, str(folder.joinpath('ChromiumSiteNames.dat')))
+
+def niobium_iron():
+    """
+    Unit cell of the NbFe2 example.
+    """
+    sites = [mc.site([0,0,-0.5], requestNIST.find_L_S('Nb0', offline=True), ion_name='Nb0', label='Nb'),
+             mc.site([0,0,1.0], requestNIST.find_L_S('Fe2', offline=True), ion_name='Fe2', label='Fe2a'),
+             mc.site([0,0,-2.835], requestNIST.find_L_S('Fe2', offline=True), ion_name='Fe2', label='Fe6h')]
+    folder = EXAMPLES.joinpath('NbFe2')
+    return mc.mandyCrystal(str(folder.joinpath('NbFe2_mp-568901_primitive.cif')), sites,
+                           str(folder.joinpath('NbFe2_mp-568901_primitiveSiteNames.dat')))
+
+# Unit cell factory, propagation vector q and modulation direction u of every example
+CRYSTALS = {'Cr':(chromium, np.array([0,0,0.05]), np.array([1,0,0])),
+            'NbFe2':(niobium_iron, np.array([0,0,0.1]), np.array([0,0,1]))}
+
+def built(name, n=None, dtype=None, q=None, m1=1, cache=False):
+    """
+    Built example crystal, with its modulation over n cells when n is given.
+
+    Parameters
+    ----------
+    name : STRING
+        Key of CRYSTALS.
+    n : ARRAY-LIKE (3,), optional
+        Number of unit cells of the supercell, by default the unit cell is returned unmodulated.
+    dtype : NUMPY DTYPE, optional
+        Precision of the modulation, passed to createModulation.
+    q : ARRAY-LIKE (3,), optional
+        Propagation vector replacing the one of the example.
+    m1 : FLOAT, optional
+        Amplitude of the modulation along u.
+    cache : BOOL, optional
+        Passed to build, the tests build without the symmetry cache.
+    """
+    factory, exampleQ, u = CRYSTALS[name]
+    crystalObj = factory()
+    crystalObj.build(cache=cache)
+    if(n is not None):
+        crystalObj.createModulation(np.array(exampleQ if q is None else q, dtype=float), u, np.zeros(3), m1, 1, np.array(n), dtype=dtype)
+    return crystalObj
+
+@pytest.fixture(scope='session')
+def example_crystal():
+    """
+    built, see above.
+    """
+    return built
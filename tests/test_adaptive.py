@@ -0,0 +1,32 @@
+import logging
+import numpy as np
+import pytest
+from mandy import diffraction, adaptive
+
+"""
+Adaptive scans of the Cr SDW must not step over its peaks.
+"""
+
+@pytest.fixture(scope='module')
+def chromium(example_crystal):
+    crystalObj = example_crystal('Cr', (2,2,20))
+    return crystalObj
+
+def test_supercell_satellites_seeded(chromium):
+    seeds = adaptive.reflection_seeds(chromium, [0,1,-0.2], [0,1,0.2])
+    assert sorted(np.round(seeds[:,2], 6).tolist()) == [-0.05, 0.0, 0.05]
+
+def test_refines_around_narrow_peaks(chromium, caplog):
+    # Coarse cells of 8 steps, 0.2 r.l.u. along l, are four times the peak width 1/20 r.l.u.
+    axes = [-0.5 + 0.025*np.arange(80), -0.15 + 0.025*np.arange(98)]
+    kwargs = dict(vectors=[[0,1,0],[0,0,1]], origin=[0,0,0])
+    full = diffraction.intensity_map(chromium, axes, **kwargs)[0]
+    with caplog.at_level(logging.INFO, logger='mandy.adaptive'):
+        scan = adaptive.adaptive_map(chromium, axes, levels=3, relative=1e-2, **kwargs)
+    assert 'seeding the predicted reflections' in caplog.text
+    assert scan.evaluations < 0.6 * np.prod(scan.shape)
+    resampled = scan.resample()
+    # Every pixel of the reflections and their first fringes is evaluated exactly, the faint tails are interpolated
+    peaks = full > 3e-2 * full.max()
+    assert np.abs(resampled - full)[peaks].max() <= 1e-9 * full.max()
+    assert np.abs(resampled - full).max() <= 3e-2 * full.max()
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from mandy import backends
+
+"""
+Agreement of every structure-factor kernel with the pure-Python reference.
+"""
+
+@pytest.fixture(params=['numpy', 'numba', 'python'])
+def name(request):
+    if(request.param not in backends.available_backends()):
+        pytest.skip('backend "{}" is not available'.format(request.param))
+    return request.param
+
+def test_double_precision(name):
+    errors = backends.check_backends([name])
+    assert errors[name] <= 1e-10
+
+def test_single_precision(name):
+    rng = np.random.default_rng(1)
+    qVecs = rng.uniform(-5, 5, (40,3))
+    positions = rng.uniform(-20, 20, (30,3))
+    moments = rng.normal(size=(30,6)) + 1j*rng.normal(size=(30,6))
+    siteIds = rng.integers(0, 3, 30)
+    formFactors = rng.uniform(0, 1, (40,3))
+    reference = np.empty((40,6), dtype=np.complex128)
+    backends.python_kernel(qVecs, positions, moments, siteIds, formFactors, reference)
+    single = np.empty((40,6), dtype=np.complex64)
+    backends.get_backend(name)(qVecs.astype(np.float32), positions.astype(np.float32), moments.astype(np.complex64), siteIds,
+                               formFactors.astype(np.float32), single)
+    assert np.abs(single - reference).max() <= 1e-4 * np.abs(reference).max()
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        backends.get_backend('no-such-kernel')
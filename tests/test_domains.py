@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from mandy import diffraction, domains
+
+"""
+Batched multi-domain intensities of the Cr SDW against plain supercell calculations of each domain.
+"""
+
+# A box commensurate with both propagation vectors
+N = (20,20,20)
+
+@pytest.fixture(scope='module')
+def chromium(example_crystal):
+    rng = np.random.default_rng(0)
+    # Random Miller indices, the satellites of (010) along l and random indices on the grid of the box
+    hkl = np.concatenate([rng.uniform(-2, 2, (300,3)), diffraction.map_hkl([np.arange(-1, 1.001, 0.025)], [[0,0,1]], [0,1,0]),
+                          np.round(rng.uniform(-2, 2, (200,3))*20)/20])
+    return example_crystal('Cr'), hkl
+
+def supercell(example_crystal, hkl, q, u):
+    crystalObj = example_crystal('Cr')
+    crystalObj.createModulation(np.array(q, dtype=float), np.array(u), np.zeros(3), 1, 1, np.array(N))
+    return diffraction.intensities(crystalObj, hkl)
+
+def test_domains_sum_incoherently(example_crystal, chromium):
+    crystalObj, hkl = chromium
+    components = [{'q': [0,0,0.05], 'u': [1,0,0], 'v': [0,0,0], 'weight': 0.7},
+                  {'q': [0.05,0,0], 'u': [0,1,0], 'v': [0,0,0], 'weight': 0.3}]
+    expected = sum(component['weight'] * supercell(example_crystal, hkl, component['q'], component['u']) for component in components)
+    batch = domains.domain_intensities(crystalObj, hkl, components, n=N)
+    assert np.allclose(batch, expected, rtol=1e-9, atol=1e-9*expected.max())
+
+def test_domain_sums_coherently(example_crystal, chromium):
+    # Two halves of a modulation in one domain add up to the whole, in two domains to half its intensity
+    crystalObj, hkl = chromium
+    half = {'q': [0,0,0.05], 'u': [1,0,0], 'v': [0,0,0], 'm1': 0.5}
+    expected = supercell(example_crystal, hkl, half['q'], half['u'])
+    coherent = domains.domain_intensities(crystalObj, hkl, [dict(half, domain='a'), dict(half, domain='a')], n=N)
+    assert np.allclose(coherent, expected, rtol=1e-9, atol=1e-9*expected.max())
+    incoherent = domains.domain_intensities(crystalObj, hkl, [half, half], n=N)
+    assert np.allclose(incoherent, expected/2, rtol=1e-9, atol=1e-9*expected.max())
@@ -0,0 +1,20 @@
+import subprocess
+import sys
+import pathlib
+
+"""
+Regression test of the import time of mandy, the diffraction module must not pull in the heavy dependencies.
+"""
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ('pandas', 'matplotlib', 'crystals', 'gemmi', 'requests')
+
+def test_diffraction_import_is_light():
+    code = 'import sys, mandy.diffraction; print(",".join(m for m in {} if m in sys.modules))'.format(HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=str(ROOT), capture_output=True, text=True, check=True).stdout
+    assert output.strip() == ''
+
+def test_package_import_is_lazy():
+    code = 'import sys, mandy; print(",".join(m for m in sys.modules if m.startswith("mandy.")))'
+    output = subprocess.run([sys.executable, '-c', code], cwd=str(ROOT), capture_output=True, text=True, check=True).stdout
+    assert output.strip() == ''
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from mandy import diffraction
+
+"""
+Accuracy of the non-uniform FFT against the direct structure factor sum.
+"""
+
+@pytest.fixture(scope='module')
+def chromium(example_crystal):
+    crystalObj = example_crystal('Cr', (4,4,22))
+    rng = np.random.default_rng(0)
+    # Random Miller indices and a line through the satellites of the (010) reflection
+    hkl = np.concatenate([rng.uniform(-2, 2, (1000,3)), diffraction.map_hkl([np.arange(-1, 1.001, 0.025)], [[0,0,1]], [0,1,0])])
+    return crystalObj, hkl, diffraction.intensities(crystalObj, hkl)
+
+@pytest.mark.parametrize('tol', [1e-2, 1e-3, 1e-6])
+def test_tolerance(chromium, tol):
+    crystalObj, hkl, direct = chromium
+    error = np.abs(diffraction.intensities(crystalObj, hkl, nufft=tol) - direct).max() / direct.max()
+    assert error <= tol
+
+def test_single_precision(chromium):
+    crystalObj, hkl, direct = chromium
+    single = diffraction.intensities(crystalObj, hkl, nufft=1e-4, dtype=np.float32)
+    assert single.dtype == np.float32
+    assert np.abs(single - direct).max() <= 1e-4 * direct.max()
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from mandy import diffraction, parallel
+
+"""
+Intensities computed over a pool of worker processes against the serial supercell calculation.
+"""
+
+@pytest.fixture(scope='module')
+def hkl():
+    rng = np.random.default_rng(0)
+    # Random Miller indices and a line through the satellites of the (010) reflection
+    return np.concatenate([rng.uniform(-2, 2, (500,3)), diffraction.map_hkl([np.arange(-1, 1.001, 0.025)], [[0,0,1]], [0,1,0])])
+
+@pytest.mark.parametrize('name,n', [('Cr', (2,2,20)), ('NbFe2', (2,2,10))])
+def test_workers(example_crystal, hkl, name, n):
+    crystalObj = example_crystal(name, n)
+    serial = diffraction.intensities(crystalObj, hkl)
+    done = []
+    # A small chunkSize splits the Miller indices into many tasks, finishing in any order
+    pooled = diffraction.intensities(crystalObj, hkl, chunkSize=16, workers=2, progress=lambda count, total: done.append((count, total)))
+    assert np.allclose(pooled, serial, rtol=1e-12, atol=1e-12*serial.max())
+    # One report per task of the pool, rather than per block of the serial loop
+    assert len(done) == len(parallel.task_bounds(len(hkl), 2, 16))
+    assert done[-1] == (len(hkl), len(hkl))
+
+def test_analytic_workers(example_crystal, hkl):
+    crystalObj = example_crystal('Cr')
+    crystalObj.createModulation(np.array([0,0,0.05]), [1,0,0], np.zeros(3), 1, 1, np.array([2,2,20]), mode='analytic')
+    serial = diffraction.intensities(crystalObj, hkl)
+    assert np.allclose(diffraction.intensities(crystalObj, hkl, workers=2), serial, rtol=1e-12, atol=1e-12*serial.max())
+    # The analytic modulation matches the supercell it describes
+    supercell = diffraction.intensities(example_crystal('Cr', (2,2,20)), hkl)
+    assert np.allclose(serial, supercell, rtol=1e-9, atol=1e-9*supercell.max())
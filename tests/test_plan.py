@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from mandy import diffraction, plan
+from conftest import chromium
+
+"""
+Intensities of a precomputed scattering plan against the direct supercell calculation, for the moments it was built
+with and for new ones.
+"""
+
+def miller_indices(rng):
+    # Random Miller indices and a line through the satellites of the (010) reflection
+    return np.concatenate([rng.uniform(-2, 2, (300,3)), diffraction.map_hkl([np.arange(-1, 1.001, 0.025)], [[0,0,1]], [0,1,0])])
+
+@pytest.mark.parametrize('maxBytes', [None, 0])
+def test_position_moments(example_crystal, maxBytes):
+    # maxBytes=0 recomputes the phase matrices on every call rather than keeping them
+    rng = np.random.default_rng(0)
+    crystalObj = example_crystal('NbFe2', (2,2,10))
+    hkl = miller_indices(rng)
+    scattering = plan.scatteringPlan(crystalObj, hkl, maxBytes=maxBytes)
+    assert (scattering.phases is None) == (maxBytes==0)
+    direct = diffraction.intensities(crystalObj, hkl)
+    assert np.allclose(scattering.intensities(), direct, rtol=1e-9, atol=1e-9*direct.max())
+
+    crystalObj.moments = rng.normal(size=crystalObj.moments.shape)
+    direct = diffraction.intensities(crystalObj, hkl)
+    assert np.allclose(scattering.intensities(crystalObj.moments), direct, rtol=1e-9, atol=1e-9*direct.max())
+
+def test_site_moments(example_crystal):
+    # With u=(1,1,1) the analytic modulation scales every component of the site moments alike
+    q, u, n = np.array([0,0,0.05]), np.array([1,1,1]), np.array([2,2,20])
+    hkl = miller_indices(np.random.default_rng(1))
+    crystalObj = example_crystal('Cr')
+    crystalObj.createModulation(q, u, np.zeros(3), 1, 1, n, mode='analytic')
+    scattering = plan.scatteringPlan(crystalObj, hkl)
+
+    siteMoments = np.array([[2,0.5,0], [-0.5,0,1]])
+    supercell = chromium()
+    for site,moment in zip(supercell.sites, siteMoments):
+        site.moment = moment.tolist()
+    supercell.build(cache=False)
+    supercell.createModulation(q, u, np.zeros(3), 1, 1, n)
+    direct = diffraction.intensities(supercell, hkl)
+    assert np.allclose(scattering.intensities(siteMoments), direct, rtol=1e-9, atol=1e-9*direct.max())
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from mandy import diffraction
+
+"""
+Validation of single-precision intensities against double precision on the Cr and NbFe2 examples.
+"""
+
+# Largest relative difference of float32 from float64 intensities, relative to the strongest reflection
+TOLERANCE = 1e-4
+
+@pytest.mark.parametrize('name', ['Cr', 'NbFe2'])
+def test_single_precision(example_crystal, name):
+    axes = [np.linspace(-1,1,21), np.linspace(-1,1,21), np.linspace(-2,2,41)]
+    result = {}
+    for dtype in (None, np.float32):
+        crystalObj = example_crystal(name, (2,2,22), dtype)
+        result[dtype] = diffraction.intensity_map(crystalObj, axes)[0]
+    assert result[np.float32].dtype == np.float32
+    assert np.abs(result[np.float32] - result[None]).max() <= TOLERANCE * np.abs(result[None]).max()
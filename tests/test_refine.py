@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from mandy import diffraction, refine
+from conftest import chromium
+
+"""
+Least-squares refinement of an analytic Cr modulation against intensities of supercells with known parameters.
+"""
+
+Q, U, N = np.array([0,0,0.05]), np.array([1,1,1]), np.array([2,2,20])
+SCALE = 3.0
+
+@pytest.fixture(scope='module')
+def hkl():
+    return diffraction.map_hkl([np.arange(-2, 2.01, 0.5), np.arange(-2, 2.01, 0.5), np.arange(-2, 2.001, 0.05)]).reshape(-1,3)
+
+def observed(hkl, siteMoments, m1=1):
+    # Scaled intensities of the supercell with the given site moments, u=(1,1,1) modulating every component alike
+    crystalObj = chromium()
+    for site,moment in zip(crystalObj.sites, siteMoments):
+        site.moment = list(moment)
+    crystalObj.build(cache=False)
+    crystalObj.createModulation(Q, U, np.zeros(3), m1, 1, N)
+    return SCALE * diffraction.intensities(crystalObj, hkl)
+
+def starting_model(example_crystal):
+    crystalObj = example_crystal('Cr')
+    crystalObj.createModulation(Q, U, np.zeros(3), 1, 1, N, mode='analytic')
+    return crystalObj
+
+def test_recovers_moments(example_crystal, hkl):
+    siteMoments = np.array([[2,0.5,0], [-0.5,0,1]])
+    intensity = observed(hkl, siteMoments)
+    result = refine.refine(starting_model(example_crystal), hkl, intensity, scale=False, initialScale=SCALE)
+    assert result.converged
+    assert np.allclose(result.moments, siteMoments, atol=1e-6)
+    assert result.chi2 <= 1e-12 * np.sum(intensity**2)
+
+def test_recovers_amplitude(example_crystal, hkl):
+    result = refine.refine(starting_model(example_crystal), hkl, observed(hkl, [[1,0,0], [-1,0,0]], m1=0.6),
+                           moments=False, m1=True, scale=False, initialScale=SCALE)
+    assert result.converged
+    assert result.names == ['m1']
+    assert result.m1 == pytest.approx(0.6, abs=1e-6)
@@ -0,0 +1,122 @@
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from mandy import requestNIST
+
+"""
+Tests of the term symbol lookup against a local stand-in for the NIST ASD.
+"""
+
+# Ground-state term symbols served by the stand-in, any other ion is an unrecognised token
+TERMS = {'Aa1': '5D', 'Bb2': '4F', 'Cc3': '3P', 'Dd4': '6S'}
+# Time each response is held back, such that concurrent requests overlap
+DELAY = 0.2
+
+class standInNIST(BaseHTTPRequestHandler):
+    """
+    Answers ie.pl queries in the tab-separated format of the NIST ASD, recording the ions requested and the largest
+    number of requests handled at once.
+    """
+    requested = []
+    active = 0
+    maxActive = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        name = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['spectra'][0].rstrip('+')
+        cls = type(self)
+        with cls.lock:
+            cls.requested.append(name)
+            cls.active += 1
+            cls.maxActive = max(cls.maxActive, cls.active)
+        time.sleep(DELAY)
+        if(name in TERMS):
+            body = ('"Ion Charge"\t"El. name"\t"Ground-state Level"\t"Ionization Energy (eV)"\n'
+                    '"{}"\t"{}"\t"{}<sup>o</sup><sub>1</sub>"\t"7.9"\t\n'.format(name[-1], name[:-1], TERMS[name]))
+        else:
+            body = 'Unrecognized token.\n'
+        with cls.lock:
+            cls.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    standInNIST.requested = []
+    standInNIST.active = standInNIST.maxActive = 0
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), standInNIST)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def nist(server, tmp_path, monkeypatch):
+    """
+    requestNIST pointed at the stand-in, with empty bundled and user caches in tmp_path.
+    """
+    monkeypatch.setattr(requestNIST, 'NIST_URL', 'http://127.0.0.1:{}/cgi-bin/ASD/ie.pl?spectra={{}}%2B'.format(server.server_address[1]))
+    monkeypatch.setattr(requestNIST, 'BUNDLED_CACHE', tmp_path.joinpath('bundled.dat'))
+    monkeypatch.setattr(requestNIST, 'USER_CACHE', tmp_path.joinpath('user', 'TermSymbols.dat'))
+    monkeypatch.setattr(requestNIST, 'OFFLINE', False)
+    monkeypatch.setattr(requestNIST, 'TIMEOUT', 5)
+    monkeypatch.setattr(requestNIST, '_cache', None)
+    return requestNIST
+
+def test_fetch(nist):
+    assert nist.term_symbol('Aa1') == '5D'
+    assert nist.find_L_S('Bb2') == (3, 1.5)
+    assert standInNIST.requested == ['Aa1', 'Bb2']
+
+def test_cache_hit_makes_no_request(nist):
+    nist.BUNDLED_CACHE.write_text('# bundled\nAa1 5D\n')
+    assert nist.find_L_S('Aa1') == (2, 2.0)
+    assert standInNIST.requested == []
+
+def test_user_cache_written(nist):
+    nist.term_symbol('Cc3')
+    assert nist.read_cache(nist.USER_CACHE) == {'Cc3': '3P'}
+    # A fresh session finds the ion in the user cache
+    nist._cache = None
+    assert nist.term_symbol('Cc3') == '3P'
+    assert standInNIST.requested == ['Cc3']
+
+def test_batch_is_concurrent(nist):
+    start = time.perf_counter()
+    result = nist.find_L_S_batch(list(TERMS) + ['Aa1'], workers=4)
+    elapsed = time.perf_counter() - start
+    assert result == {name: nist.term_to_L_S(term) for name,term in TERMS.items()}
+    # Each missing ion is requested once, the requests overlapping rather than following each other
+    assert sorted(standInNIST.requested) == sorted(TERMS)
+    assert standInNIST.maxActive > 1
+    assert elapsed < len(TERMS) * DELAY
+
+def test_unknown_token(nist, caplog):
+    assert nist.term_symbol('Zz9') == '3P'
+    assert 'Unrecognised Token' in caplog.text
+    # The fallback is not cached, so a corrected server is asked again
+    assert not nist.USER_CACHE.exists()
+
+def test_connection_failure(nist, server, caplog):
+    port = server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    nist.NIST_URL = 'http://127.0.0.1:{}/cgi-bin/ASD/ie.pl?spectra={{}}%2B'.format(port)
+    assert nist.term_symbol('Aa1') == '3P'
+    assert 'Could not reach NIST database' in caplog.text
+    assert not nist.USER_CACHE.exists()
+
+def test_offline_raises(nist):
+    with pytest.raises(LookupError):
+        nist.term_symbol('Aa1', offline=True)
+    with pytest.raises(LookupError):
+        nist.find_L_S_batch(['Aa1', 'Bb2'], offline=True)
+    assert standInNIST.requested == []
@@ -0,0 +1,48 @@
+import json
+import numpy as np
+import pytest
+from mandy import diffraction, results
+
+"""
+Result stores of supercell intensities, saved, reopened and queried by Miller index.
+"""
+
+@pytest.fixture(scope='module')
+def chromium(example_crystal):
+    crystalObj = example_crystal('Cr', (2,2,20))
+    hkl = diffraction.map_hkl([np.arange(-1, 1.01, 0.5), [0,1], np.arange(-2, 2.001, 0.05)]).reshape(-1,3)
+    return crystalObj, hkl, diffraction.intensities(crystalObj, hkl)
+
+def test_round_trip(chromium, tmp_path):
+    crystalObj, hkl, intensity = chromium
+    results.save_results(tmp_path.joinpath('scan'), hkl, intensity, crystalObj.metadata())
+    store = results.open_results(tmp_path.joinpath('scan'))
+    assert len(store) == len(hkl)
+    assert np.array_equal(store.hkl, hkl)
+    assert np.array_equal(store.intensity, intensity)
+    assert store.metadata == json.loads(json.dumps(crystalObj.metadata()))
+    assert store.metadata['modulation']['mode'] == 'supercell'
+
+def test_lookup(chromium, tmp_path):
+    crystalObj, hkl, intensity = chromium
+    store = results.save_results(tmp_path.joinpath('scan'), hkl, intensity, crystalObj.metadata())
+    rng = np.random.default_rng(0)
+    rows = rng.permutation(len(hkl))[:100]
+    # Indices within the resolution of the index find the same reflection
+    query = hkl[rows] + rng.uniform(-0.1, 0.1, (100,3))*results.HKL_RESOLUTION
+    assert np.array_equal(store.lookup(query), intensity[rows])
+    satellites = [[0,1,0.05], [0,1,-0.05]]
+    assert np.allclose(store.lookup(satellites), diffraction.intensities(crystalObj, satellites), rtol=1e-12, atol=0)
+    assert np.array_equal(store.find([[0,1,0.025], [0.5,0,0.05]]), [-1, np.flatnonzero(np.all(np.isclose(hkl, [0.5,0,0.05]), axis=1))[0]])
+    with pytest.raises(KeyError):
+        store.lookup([[0,1,0.025]])
+
+def test_rows_overwritten(chromium, tmp_path):
+    crystalObj, hkl, intensity = chromium
+    results.save_results(tmp_path.joinpath('scan'), hkl[:10], intensity[:10])
+    # Several calculations over the same Miller indices replace the previous store
+    stacked = np.stack([intensity, 2*intensity])
+    store = results.save_results(tmp_path.joinpath('scan'), hkl, stacked)
+    assert store.intensity.shape == (2, len(hkl))
+    assert store.metadata is None
+    assert np.array_equal(store.lookup(hkl[::7]), stacked[:,::7])
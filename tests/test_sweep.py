@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import pytest
+from mandy import diffraction, sweep
+from conftest import EXAMPLES
+
+"""
+Parameter sweeps of the Cr SDW, checked against direct calculations and resumed after an interruption.
+"""
+
+def cr_config():
+    return {'cif': 'Chromium.cif',
+            'sites': [{'moment': [1,0,0], 'ion_name': 'Cr1', 'label': 'Cr'},
+                      {'moment': [-1,0,0], 'ion_name': 'Cr1', 'label': 'Cr0'}],
+            'modulation': {'q': [0,0,0.05], 'u': [1,0,0], 'v': [0,0,0], 'n': [2,2,22]},
+            'Q': {'miller': [[0], [1], {'start': 0, 'stop': 1, 'step': 0.025}]}}
+
+def test_dict_config_defaults(example_crystal, tmp_path, monkeypatch):
+    # A dict without grid or options, with paths relative to the working directory
+    monkeypatch.chdir(EXAMPLES.joinpath('Cr'))
+    store = sweep.run_sweep(cr_config(), tmp_path.joinpath('out'), workers=1)
+    assert store.intensity.shape == (1, 40)
+    assert store.metadata['complete']
+    assert np.allclose(store.intensity[0], diffraction.intensities(example_crystal('Cr', (2,2,22)), store.hkl), rtol=1e-12, atol=0)
+
+def test_dict_config_resumes(tmp_path, monkeypatch):
+    # Tuples and numpy values do not survive JSON as such, the resumed sweep must still be recognised
+    monkeypatch.chdir(EXAMPLES.joinpath('Cr'))
+    config = cr_config()
+    config['modulation'] = {'q': np.array([0,0,0.05]), 'u': (1,0,0), 'v': np.zeros(3), 'm1': np.float64(1), 'n': (2,2,22)}
+    config['grid'] = {'modulation.m2': [np.float64(0.5), 1.0]}
+    first = sweep.run_sweep(config, tmp_path.joinpath('out'), workers=1)
+    done = []
+    second = sweep.run_sweep(config, tmp_path.joinpath('out'), workers=1, progress=lambda count, total: done.append(count))
+    assert done == []
+    assert second.metadata['complete']
+    assert np.array_equal(first.intensity, second.intensity)
+
+def test_resume(example_crystal, tmp_path):
+    config = cr_config()
+    config['grid'] = {'modulation.q': [[0,0,0.05], [0,0,0.0625]], 'modulation.m1': [0.5, 1.0]}
+    # The paths of a config file are relative to it, the site name file defaulting to the one beside the CIF
+    for name in ('Chromium.cif', 'ChromiumSiteNames.dat'):
+        tmp_path.joinpath(name).write_bytes(EXAMPLES.joinpath('Cr', name).read_bytes())
+    configPath = tmp_path.joinpath('cr.json')
+    configPath.write_text(json.dumps(config))
+
+    output = tmp_path.joinpath('out')
+    store = sweep.run_sweep(str(configPath), output, workers=2)
+    for row,param in enumerate(store.metadata['params']):
+        expected = diffraction.intensities(example_crystal('Cr', (2,2,22), q=param['modulation.q'], m1=param['modulation.m1']), store.hkl)
+        assert np.allclose(store.intensity[row], expected, rtol=1e-12, atol=0)
+
+    # Clearing a flag and a row, as if the sweep had stopped before the job completed, reruns only that job
+    first = np.array(store.intensity)
+    jobs = np.load(output.joinpath(sweep.JOBS), mmap_mode='r+')
+    jobs[2] = 0
+    jobs.flush()
+    intensity = np.load(output.joinpath('intensity.npy'), mmap_mode='r+')
+    intensity[2] = 0
+    intensity[1] = -1
+    intensity.flush()
+    done = []
+    store = sweep.run_sweep(str(configPath), output, workers=1, progress=lambda count, total: done.append(count))
+    assert done == [4]
+    assert np.array_equal(store.intensity[2], first[2])
+    assert np.all(store.intensity[1] == -1)
+
+    # A different sweep is refused
+    config['modulation']['n'] = [2,2,20]
+    configPath.write_text(json.dumps(config))
+    with pytest.raises(ValueError):
+        sweep.run_sweep(str(configPath), output, workers=1)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from mandy import diffraction, symmetry
+
+"""
+Intensities reduced by the magnetic point group against the full supercell calculation.
+"""
+
+def miller_indices(rng):
+    # A grid in steps of the box, on which the reduction applies, and off-grid indices which are computed as given
+    grid = diffraction.map_hkl([np.arange(-1, 1.01, 0.5), np.arange(-1, 1.01, 0.5), np.arange(-1, 1.001, 0.05)]).reshape(-1,3)
+    return np.concatenate([grid, rng.uniform(-2, 2, (50,3))])
+
+@pytest.mark.parametrize('name,n', [('Cr', (2,2,20)), ('NbFe2', (2,2,10))])
+def test_inferred_point_group(example_crystal, name, n):
+    crystalObj = example_crystal(name, n)
+    hkl = miller_indices(np.random.default_rng(0))
+    unique, inverse = symmetry.reduce_hkl(hkl, symmetry.symmetry_operations(crystalObj, True), crystalObj.n)
+    assert len(unique) < 0.7*len(hkl)
+    full = diffraction.intensities(crystalObj, hkl)
+    assert np.allclose(diffraction.intensities(crystalObj, hkl, symmetry=True), full, rtol=1e-9, atol=1e-9*full.max())
+
+def test_given_operations(example_crystal):
+    crystalObj = example_crystal('Cr', (2,2,20))
+    hkl = miller_indices(np.random.default_rng(1))
+    full = diffraction.intensities(crystalObj, hkl)
+    assert np.allclose(diffraction.intensities(crystalObj, hkl, symmetry=['x,-y,z', '-x,y,z']), full, rtol=1e-9, atol=1e-9*full.max())
+    # Swapping a and b is not a symmetry of the SDW, whose moments lie along a and modulation along c
+    assert not np.allclose(diffraction.intensities(crystalObj, hkl, symmetry=['y,x,z']), full, rtol=1e-6, atol=1e-6*full.max())